@@ -3,8 +3,16 @@
 import json
 import os
 import threading
-from llm_adapters import create_llm_adapter
-from embedding_adapters import create_embedding_adapter
+from llm_adapters import create_llm_adapter, configure_llm_failover
+from embedding_adapters import create_embedding_adapter, configure_embedding_batch
+from novel_generator.llm_cache import configure_llm_cache
+from novel_generator.embedding_cache import configure_embedding_cache
+from novel_generator.vectorstore_utils import configure_vector_store
+from rate_limiter import configure_rate_limits
+from http_pool import configure_http_pool
+from novel_generator.common import configure_retry_policy
+from novel_generator.prompt_layout import configure_prompt_layout
+from llm_metrics import configure_metrics
 
 
 def load_config(config_file: str) -> dict:
@@ -26,6 +34,20 @@ def save_config(config_data: dict, config_file: str) -> bool:
     except:
         return False
 
+def apply_runtime_config(config_data: dict):
+    """将 config.json 中与运行时行为相关的配置（缓存、限流、重试、故障转移、提示词布局等）应用到各模块"""
+    config_data = config_data or {}
+    configure_http_pool(config_data.get("http", {}))
+    configure_llm_cache(config_data.get("llm_cache", {}))
+    configure_rate_limits(config_data.get("rate_limits", {}))
+    configure_retry_policy(config_data.get("retry", {}))
+    configure_llm_failover(config_data.get("llm_failover", {}), config_data.get("llm_configs", {}))
+    configure_prompt_layout(config_data.get("prompt_layout", "classic"))
+    configure_metrics(config_data.get("metrics", {}))
+    configure_embedding_batch(config_data.get("embedding_batch", {}))
+    configure_embedding_cache(config_data.get("embedding_cache", {}))
+    configure_vector_store(config_data.get("vector_store", {}))
+
 def test_llm_config(interface_format, api_key, base_url, model_name, temperature, max_tokens, timeout, log_func, handle_exception_func):
     """测试当前的LLM配置是否可用"""
     def task():
@@ -38,7 +60,8 @@ def test_llm_config(interface_format, api_key, base_url, model_name, temperature
                 api_key=api_key,
                 temperature=temperature,
                 max_tokens=max_tokens,
-                timeout=timeout
+                timeout=timeout,
+                backends=[]  # 只测试当前配置，不经由 llm_failover 的备用后端
             )
 
             test_prompt = "Please reply 'OK'"
@@ -1,6 +1,7 @@
 # consistency_checker.py
 # -*- coding: utf-8 -*-
 from llm_adapters import create_llm_adapter
+from novel_generator.common import invoke_with_cleaning
 
 # ============== 增加对“剧情要点/未解决冲突”进行检查的可选引导 ==============
 CONSISTENCY_PROMPT = """\
@@ -35,11 +36,13 @@ def check_consistency(
     plot_arcs: str = "",
     interface_format: str = "OpenAI",
     max_tokens: int = 2048,
-    timeout: int = 600
+    timeout: int = 600,
+    filepath: str = ""
 ) -> str:
     """
     调用模型做简单的一致性检查。可扩展更多提示或校验规则。
     新增: 会额外检查对“未解决冲突或剧情要点”（plot_arcs）的衔接情况。
+    filepath 为项目目录，调用指标写入其中的 llm_metrics.jsonl。
     """
     prompt = CONSISTENCY_PROMPT.format(
         novel_setting=novel_setting,
@@ -59,14 +62,9 @@ def check_consistency(
         timeout=timeout
     )
 
-    # 调试日志
-    print("\n[ConsistencyChecker] Prompt >>>", prompt)
-
-    response = llm_adapter.invoke(prompt)
+    # 批处理模式（novel_generator.batch）下由批处理结果返回
+    response = invoke_with_cleaning(llm_adapter, prompt, stage="consistency", cache_dir=filepath)
     if not response:
         return "审校Agent无回复"
-    
-    # 调试日志
-    print("[ConsistencyChecker] Response <<<", response)
 
     return response
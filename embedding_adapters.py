@@ -1,10 +1,24 @@
 # embedding_adapters.py
 # -*- coding: utf-8 -*-
+import asyncio
+import contextvars
+import hashlib
+import json
 import logging
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from typing import List
+import httpx
 import requests
 from langchain_openai import AzureOpenAIEmbeddings, OpenAIEmbeddings
+from http_pool import get_async_http_client, get_http_client, post as http_post
+from llm_metrics import record_coalesced
+from rate_limiter import estimate_tokens, get_rate_limiter
+from single_flight import SingleFlight
+from mock_backend import MockEmbedding, parse_options as parse_mock_options
 
 def ensure_openai_base_url_has_v1(url: str) -> str:
     """
@@ -19,33 +33,326 @@ def ensure_openai_base_url_has_v1(url: str) -> str:
             url = url.rstrip('/') + '/v1'
     return url
 
+_embedding_flight = SingleFlight("embedding")
+
+# 批量请求的条数与估算 token 上限，按接口格式（小写）覆盖 "default"
+_batch_settings = {
+    "default": {"max_batch_size": 64, "max_batch_tokens": 16000, "max_workers": 4},
+    "gemini": {"max_batch_size": 100},  # batchEmbedContents 单次最多 100 条
+    "siliconflow": {"max_batch_size": 32},
+    "openai": {"max_batch_size": 256},
+    "azure openai": {"max_batch_size": 256}
+}
+# 服务端因请求体过大拒绝后学到的批大小，按 flight_key 记录
+_learned_batch_sizes = {}
+# 不支持 /api/embed 的旧版 Ollama 地址
+_ollama_legacy_urls = set()
+_batch_lock = threading.Lock()
+
+def configure_embedding_batch(settings: dict):
+    """
+    应用 config.json 中的 "embedding_batch"，例如：
+    {"default": {"max_batch_size": 64, "max_batch_tokens": 16000, "max_workers": 4}, "Ollama": {"max_batch_size": 128}}
+    max_workers 为一次调用内同时发出的批量（或逐条）请求数
+    """
+    with _batch_lock:
+        for key, value in (settings or {}).items():
+            if isinstance(value, dict):
+                _batch_settings.setdefault(str(key).strip().lower(), {}).update(value)
+        _learned_batch_sizes.clear()
+
+def _configured_batch_size(fmt: str) -> int:
+    """接口格式 fmt（小写）配置的每批最多条数"""
+    with _batch_lock:
+        conf = dict(_batch_settings["default"])
+        conf.update(_batch_settings.get(fmt, {}))
+    return max(int(conf.get("max_batch_size") or 1), 1)
+
+def _is_payload_too_large(error: Exception) -> bool:
+    """服务端因批量过大（条数或请求体）拒绝请求"""
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    if status == 413:
+        return True
+    if status == 400:
+        message = str(error).lower()
+        try:
+            message += " " + (response.text or "").lower()
+        except Exception:
+            pass
+        return any(marker in message for marker in ("too large", "too many", "too long", "maximum", "exceed", "batch size"))
+    return False
+
+class EmbeddingExecutor:
+    """
+    把逐条（或逐批）的 Embedding 请求分发到有界的线程池 / 协程并发中：
+    结果保持输入顺序，失败的条目按重试策略单独重试，全部完成后在日志中记录吞吐量。
+    """
+    def __init__(self, max_workers: int = 4, label: str = "embedding"):
+        self.max_workers = max(int(max_workers), 1)
+        self.label = label
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(item) -> int:
+        return len(item) if isinstance(item, (list, tuple)) else 1
+
+    def _retry_delay(self, attempt: int, error: Exception, started: float):
+        # 延迟导入，避免 novel_generator 包与本模块循环导入
+        from novel_generator.common import RetryPolicy
+        delay = RetryPolicy().next_delay(attempt, error, started)
+        if delay is not None:
+            with self._lock:
+                self.retries += 1
+        return delay
+
+    def _call(self, func, item):
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return func(item)
+            except Exception as e:
+                delay = self._retry_delay(attempt, e, started)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+
+    async def _acall(self, coro_func, item):
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await coro_func(item)
+            except Exception as e:
+                delay = self._retry_delay(attempt, e, started)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+
+    def _report(self, items: list, started: float):
+        if len(items) <= 1:
+            return
+        elapsed = time.monotonic() - started
+        texts = sum(self._size(item) for item in items)
+        logging.info(
+            f"[Embedding] {self.label}: {texts} texts in {len(items)} requests, {elapsed:.2f}s "
+            f"({texts / elapsed if elapsed > 0 else 0:.1f} texts/s, workers={self.max_workers}, retries={self.retries})"
+        )
+
+    def map(self, func, items: list) -> list:
+        """在线程池中执行 func(item)，任一条目重试后仍失败时取消其余条目并抛出异常"""
+        items = list(items)
+        started = time.monotonic()
+        if len(items) <= 1 or self.max_workers == 1:
+            results = [self._call(func, item) for item in items]
+        else:
+            pool = ThreadPoolExecutor(max_workers=min(self.max_workers, len(items)), thread_name_prefix="embedding")
+            try:
+                # 每个任务各自复制一份 contextvars，保留调用方的阶段等上下文
+                futures = [pool.submit(contextvars.copy_context().run, self._call, func, item) for item in items]
+                results = [future.result() for future in futures]
+            finally:
+                pool.shutdown(wait=True, cancel_futures=True)
+        self._report(items, started)
+        return results
+
+    async def amap(self, coro_func, items: list) -> list:
+        """map 的异步版本，同时在途的请求数不超过 max_workers"""
+        items = list(items)
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def run(item):
+            async with semaphore:
+                return await self._acall(coro_func, item)
+
+        results = list(await asyncio.gather(*(run(item) for item in items)))
+        self._report(items, started)
+        return results
+
 class BaseEmbeddingAdapter:
     """
     Embedding 接口统一基类
+    公共方法负责限流、相同请求的在途合并等通用逻辑，子类实现对应的 _embed_documents / _embed_query /
+    _aembed_documents / _aembed_query。限流按单次 HTTP 请求申请额度：文档在 _send_batch / _asend_batch
+    （或逐条请求的路径）中每批申请一次，查询本身就是一次请求。
     """
+    # 服务商名称；限流配置中以 "embedding:<名称>" 区分
+    provider = ""
+    # 限流器按 (服务商, API Key) 共享，由 create_embedding_adapter 设置
+    limit_key = ""
+
+    # 在途合并的键前缀，由 create_embedding_adapter 按 (接口, base_url, 模型, API Key) 设置；为空时按实例区分
+    flight_key = ""
+
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        raise NotImplementedError
+        def call():
+            return self._embed_documents(texts)
+        return list(_embedding_flight.do(self._request_key("documents", texts), call, self._record_coalesced))
 
     def embed_query(self, query: str) -> List[float]:
+        def call():
+            with self._limited([query]):
+                return self._embed_query(query)
+        return _embedding_flight.do(self._request_key("query", [query]), call, self._record_coalesced)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        async def call():
+            return await self._aembed_documents(texts)
+        return list(await _embedding_flight.ado(self._request_key("documents", texts), call, self._record_coalesced))
+
+    async def aembed_query(self, query: str) -> List[float]:
+        async def call():
+            async with self._alimited([query]):
+                return await self._aembed_query(query)
+        return await _embedding_flight.ado(self._request_key("query", [query]), call, self._record_coalesced)
+
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+    def _embed_query(self, query: str) -> List[float]:
         raise NotImplementedError
 
+    async def _aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        """未实现原生异步请求的后端在线程池中执行同步方法"""
+        return await asyncio.to_thread(self._embed_documents, texts)
+
+    async def _aembed_query(self, query: str) -> List[float]:
+        return await asyncio.to_thread(self._embed_query, query)
+
+    def _request_key(self, kind: str, texts: List[str]) -> str:
+        raw = json.dumps([self.flight_key or id(self), kind, texts], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _record_coalesced(self, waited: float):
+        record_coalesced(f"embedding:{self.provider}", getattr(self, "model_name", ""), waited, stage="embedding")
+
+    def _batch_limits(self) -> tuple:
+        """(每批最多条数, 每批估算 token 上限)；后者为 0 表示不限"""
+        fmt = self.provider.strip().lower()
+        with _batch_lock:
+            conf = dict(_batch_settings["default"])
+            conf.update(_batch_settings.get(fmt, {}))
+            learned = _learned_batch_sizes.get(self.flight_key or id(self))
+        size = max(int(conf.get("max_batch_size") or 1), 1)
+        if learned:
+            size = min(size, learned)
+        return size, int(conf.get("max_batch_tokens") or 0)
+
+    def _executor(self) -> EmbeddingExecutor:
+        with _batch_lock:
+            conf = dict(_batch_settings["default"])
+            conf.update(_batch_settings.get(self.provider.strip().lower(), {}))
+        return EmbeddingExecutor(int(conf.get("max_workers") or 1), self.provider or type(self).__name__)
+
+    def _split_batches(self, texts: List[str]) -> List[List[str]]:
+        """按条数与估算 token 数把 texts 切成若干批，保持原顺序"""
+        max_size, max_tokens = self._batch_limits()
+        batches = []
+        current, current_tokens = [], 0
+        for text in texts:
+            cost = estimate_tokens(text)
+            if current and (len(current) >= max_size or (max_tokens and current_tokens + cost > max_tokens)):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(text)
+            current_tokens += cost
+        if current:
+            batches.append(current)
+        return batches
+
+    def _learn_batch_size(self, size: int):
+        with _batch_lock:
+            key = self.flight_key or id(self)
+            previous = _learned_batch_sizes.get(key)
+            if previous is not None and previous <= size:
+                return
+            _learned_batch_sizes[key] = size
+        logging.warning(f"[Embedding] {self.provider} rejected an oversized batch, batch size reduced to {size}.")
+
+    def _embed_batched(self, texts: List[str], send) -> List[List[float]]:
+        """按批并发调用 send(batch)，按原顺序拼接结果"""
+        results = self._executor().map(lambda batch: self._send_batch(batch, send), self._split_batches(texts))
+        return [vec for batch in results for vec in batch]
+
+    def _send_batch(self, batch: List[str], send) -> List[List[float]]:
+        if len(batch) > self._batch_limits()[0]:
+            # 切分之后学到了更小的批大小，按新大小重新切分
+            return self._embed_batched(batch, send)
+        try:
+            with self._limited(batch):
+                return send(batch)
+        except Exception as e:
+            if len(batch) <= 1 or not _is_payload_too_large(e):
+                raise
+        # 批量超出服务端限制：记住对半后的批大小，重新切分后重试
+        self._learn_batch_size(len(batch) // 2)
+        return self._embed_batched(batch, send)
+
+    async def _aembed_batched(self, texts: List[str], send) -> List[List[float]]:
+        """_embed_batched 的异步版本，send 返回协程"""
+        results = await self._executor().amap(lambda batch: self._asend_batch(batch, send), self._split_batches(texts))
+        return [vec for batch in results for vec in batch]
+
+    async def _asend_batch(self, batch: List[str], send) -> List[List[float]]:
+        if len(batch) > self._batch_limits()[0]:
+            return await self._aembed_batched(batch, send)
+        try:
+            async with self._alimited(batch):
+                return await send(batch)
+        except Exception as e:
+            if len(batch) <= 1 or not _is_payload_too_large(e):
+                raise
+        self._learn_batch_size(len(batch) // 2)
+        return await self._aembed_batched(batch, send)
+
+    def _limit_cost(self, texts: List[str]) -> dict:
+        """单次请求的限流额度：1 个请求与 texts 的估算 token 数"""
+        return {"requests": 1, "tokens": sum(estimate_tokens(t) for t in texts)}
+
+    def _limited(self, texts: List[str]):
+        limiter = get_rate_limiter(f"embedding:{self.provider}", self.limit_key)
+        if limiter is None:
+            return nullcontext()
+        return limiter.limit(**self._limit_cost(texts))
+
+    def _alimited(self, texts: List[str]):
+        limiter = get_rate_limiter(f"embedding:{self.provider}", self.limit_key)
+        if limiter is None:
+            return nullcontext()
+        return limiter.alimit(**self._limit_cost(texts))
+
 class OpenAIEmbeddingAdapter(BaseEmbeddingAdapter):
     """
     基于 OpenAIEmbeddings（或兼容接口）的适配器
     """
     def __init__(self, api_key: str, base_url: str, model_name: str):
+        self.model_name = model_name
         self._embedding = OpenAIEmbeddings(
             openai_api_key=api_key,
             openai_api_base=ensure_openai_base_url_has_v1(base_url),
-            model=model_name
+            model=model_name,
+            chunk_size=_configured_batch_size("openai"),
+            max_retries=0,  # 重试统一由 EmbeddingExecutor / RetryPolicy 负责
+            http_client=get_http_client(ensure_openai_base_url_has_v1(base_url))
         )
 
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        return self._embedding.embed_documents(texts)
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed_batched(texts, self._embedding.embed_documents)
 
-    def embed_query(self, query: str) -> List[float]:
+    def _embed_query(self, query: str) -> List[float]:
         return self._embedding.embed_query(query)
 
+    async def _aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self._aembed_batched(texts, self._embedding.aembed_documents)
+
+    async def _aembed_query(self, query: str) -> List[float]:
+        return await self._embedding.aembed_query(query)
+
 class AzureOpenAIEmbeddingAdapter(BaseEmbeddingAdapter):
     """
     基于 AzureOpenAIEmbeddings（或兼容接口）的适配器
@@ -59,42 +366,65 @@ class AzureOpenAIEmbeddingAdapter(BaseEmbeddingAdapter):
             self.api_version = match.group(3)
         else:
             raise ValueError("Invalid Azure OpenAI base_url format")
-        
+        self.model_name = model_name or self.azure_deployment
+
         self._embedding = AzureOpenAIEmbeddings(
             azure_endpoint=self.azure_endpoint,
             azure_deployment=self.azure_deployment,
             openai_api_key=api_key,
             api_version=self.api_version,
+            chunk_size=_configured_batch_size("azure openai"),
+            max_retries=0,  # 重试统一由 EmbeddingExecutor / RetryPolicy 负责
+            http_client=get_http_client(self.azure_endpoint)
         )
 
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        return self._embedding.embed_documents(texts)
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed_batched(texts, self._embedding.embed_documents)
 
-    def embed_query(self, query: str) -> List[float]:
+    def _embed_query(self, query: str) -> List[float]:
         return self._embedding.embed_query(query)
 
+    async def _aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self._aembed_batched(texts, self._embedding.aembed_documents)
+
+    async def _aembed_query(self, query: str) -> List[float]:
+        return await self._embedding.aembed_query(query)
+
 class OllamaEmbeddingAdapter(BaseEmbeddingAdapter):
     """
-    其接口路径为 /api/embeddings
+    其接口路径为 /api/embed（input 为列表，一次请求嵌入一批文本）；
+    旧版 Ollama 没有该接口时退回逐条调用 /api/embeddings
     """
     def __init__(self, model_name: str, base_url: str):
         self.model_name = model_name
         self.base_url = base_url.rstrip("/")
 
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        embeddings = []
-        for text in texts:
-            vec = self._embed_single(text)
-            embeddings.append(vec)
-        return embeddings
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self._embed_url() in _ollama_legacy_urls:
+            return self._executor().map(self._limited_single, texts)
+        return self._embed_batched(texts, self._embed_batch)
 
-    def embed_query(self, query: str) -> List[float]:
-        return self._embed_single(query)
+    def _embed_query(self, query: str) -> List[float]:
+        return self._embed_batch([query])[0]
 
-    def _embed_single(self, text: str) -> List[float]:
-        """
-        调用 Ollama 本地服务 /api/embeddings 接口，获取文本 embedding
-        """
+    async def _aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self._embed_url() in _ollama_legacy_urls:
+            return await self._executor().amap(self._alimited_single, texts)
+        return await self._aembed_batched(texts, self._aembed_batch)
+
+    async def _aembed_query(self, query: str) -> List[float]:
+        return (await self._aembed_batch([query]))[0]
+
+    def _limited_single(self, text: str) -> List[float]:
+        """旧版服务逐条请求，每条单独申请限流额度"""
+        with self._limited([text]):
+            return self._embed_single(text)
+
+    async def _alimited_single(self, text: str) -> List[float]:
+        async with self._alimited([text]):
+            return await self._aembed_single(text)
+
+    def _embeddings_url(self) -> str:
         url = self.base_url.rstrip("/")
         if "/api/embeddings" not in url:
             if "/api" in url:
@@ -103,41 +433,127 @@ class OllamaEmbeddingAdapter(BaseEmbeddingAdapter):
                 if "/v1" in url:
                     url = url[:url.index("/v1")]
                 url = f"{url}/api/embeddings"
+        return url
+
+    def _embed_url(self) -> str:
+        url = self._embeddings_url()
+        return url[:url.rindex("/api/embeddings")] + "/api/embed"
+
+    @staticmethod
+    def _is_legacy_server(status_code: int, text: str) -> bool:
+        # 旧版返回 404 page not found；模型不存在同样是 404，但消息里带 model
+        return status_code in (404, 405) and "model" not in (text or "").lower()
 
+    def _parse_batch(self, result: dict, count: int) -> List[List[float]]:
+        embeddings = result.get("embeddings")
+        if not isinstance(embeddings, list) or len(embeddings) != count:
+            raise ValueError(f"Ollama /api/embed returned {len(embeddings or [])} embeddings for {count} texts.")
+        return embeddings
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """
+        调用 Ollama 本地服务 /api/embed 接口，一次获取一批文本的 embedding。
+        调用方已为这次请求申请了限流额度，旧版服务在此逐条顺序补发；之后的文档请求由
+        _embed_documents 直接走逐条限流的路径。
+        """
+        url = self._embed_url()
+        if url in _ollama_legacy_urls:
+            return [self._embed_single(text) for text in texts]
+        try:
+            response = http_post(url, json={"model": self.model_name, "input": texts})
+            if self._is_legacy_server(response.status_code, response.text):
+                logging.warning(f"Ollama at {url} has no /api/embed, falling back to /api/embeddings per text.")
+                _ollama_legacy_urls.add(url)
+                return [self._embed_single(text) for text in texts]
+            response.raise_for_status()
+            return self._parse_batch(response.json(), len(texts))
+        except requests.exceptions.RequestException as e:
+            # 网络/HTTP 错误交给 call_with_retry 按状态码与 Retry-After 重试
+            logging.error(f"Ollama embed request error: {e}\n{traceback.format_exc()}")
+            raise
+
+    async def _aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        url = self._embed_url()
+        if url in _ollama_legacy_urls:
+            return [await self._aembed_single(text) for text in texts]
+        try:
+            response = await get_async_http_client().post(url, json={"model": self.model_name, "input": texts})
+            if self._is_legacy_server(response.status_code, response.text):
+                logging.warning(f"Ollama at {url} has no /api/embed, falling back to /api/embeddings per text.")
+                _ollama_legacy_urls.add(url)
+                return [await self._aembed_single(text) for text in texts]
+            response.raise_for_status()
+            return self._parse_batch(response.json(), len(texts))
+        except httpx.HTTPError as e:
+            logging.error(f"Ollama embed request error: {e}\n{traceback.format_exc()}")
+            raise
+
+    def _embed_single(self, text: str) -> List[float]:
+        """
+        调用旧版 Ollama 的 /api/embeddings 接口，获取单条文本 embedding
+        """
+        url = self._embeddings_url()
         data = {
             "model": self.model_name,
             "prompt": text
         }
         try:
-            response = requests.post(url, json=data)
+            response = http_post(url, json=data)
             response.raise_for_status()
             result = response.json()
             if "embedding" not in result:
                 raise ValueError("No 'embedding' field in Ollama response.")
             return result["embedding"]
         except requests.exceptions.RequestException as e:
+            # 网络/HTTP 错误交给 call_with_retry 按状态码与 Retry-After 重试
             logging.error(f"Ollama embeddings request error: {e}\n{traceback.format_exc()}")
-            return []
+            raise
+
+    async def _aembed_single(self, text: str) -> List[float]:
+        data = {
+            "model": self.model_name,
+            "prompt": text
+        }
+        try:
+            response = await get_async_http_client().post(self._embeddings_url(), json=data)
+            response.raise_for_status()
+            result = response.json()
+            if "embedding" not in result:
+                raise ValueError("No 'embedding' field in Ollama response.")
+            return result["embedding"]
+        except httpx.HTTPError as e:
+            logging.error(f"Ollama embeddings request error: {e}\n{traceback.format_exc()}")
+            raise
 
 class MLStudioEmbeddingAdapter(BaseEmbeddingAdapter):
     def __init__(self, api_key: str, base_url: str, model_name: str):
+        self.model_name = model_name
         self._embedding = OpenAIEmbeddings(
             openai_api_key=api_key,
             openai_api_base=ensure_openai_base_url_has_v1(base_url),
-            model=model_name
+            model=model_name,
+            chunk_size=_configured_batch_size("ml studio"),
+            max_retries=0,  # 重试统一由 EmbeddingExecutor / RetryPolicy 负责
+            http_client=get_http_client(ensure_openai_base_url_has_v1(base_url))
         )
 
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        return self._embedding.embed_documents(texts)
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed_batched(texts, self._embedding.embed_documents)
 
-    def embed_query(self, query: str) -> List[float]:
+    def _embed_query(self, query: str) -> List[float]:
         return self._embedding.embed_query(query)
 
+    async def _aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self._aembed_batched(texts, self._embedding.aembed_documents)
+
+    async def _aembed_query(self, query: str) -> List[float]:
+        return await self._embedding.aembed_query(query)
+
 class GeminiEmbeddingAdapter(BaseEmbeddingAdapter):
     """
     基于 Google Generative AI (Gemini) 接口的 Embedding 适配器
-    使用直接 POST 请求方式，URL 示例：
-    https://generativelanguage.googleapis.com/v1beta/models/text-embedding-004:embedContent?key=YOUR_API_KEY
+    使用直接 POST 请求方式，文档批量走 batchEmbedContents，URL 示例：
+    https://generativelanguage.googleapis.com/v1beta/models/text-embedding-004:batchEmbedContents?key=YOUR_API_KEY
     """
     def __init__(self, api_key: str, model_name: str, base_url: str):
         """
@@ -149,20 +565,19 @@ class GeminiEmbeddingAdapter(BaseEmbeddingAdapter):
         self.model_name = model_name
         self.base_url = base_url.rstrip("/")
 
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        embeddings = []
-        for text in texts:
-            vec = self._embed_single(text)
-            embeddings.append(vec)
-        return embeddings
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed_batched(texts, self._embed_batch)
 
-    def embed_query(self, query: str) -> List[float]:
+    def _embed_query(self, query: str) -> List[float]:
         return self._embed_single(query)
 
-    def _embed_single(self, text: str) -> List[float]:
-        """
-        直接调用 Google Generative Language API (Gemini) 接口，获取文本 embedding
-        """
+    async def _aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self._aembed_batched(texts, self._aembed_batch)
+
+    async def _aembed_query(self, query: str) -> List[float]:
+        return await self._aembed_single(query)
+
+    def _embed_request(self, text: str):
         url = f"{self.base_url}/{self.model_name}:embedContent?key={self.api_key}"
         payload = {
             "model": self.model_name,
@@ -172,24 +587,91 @@ class GeminiEmbeddingAdapter(BaseEmbeddingAdapter):
                 ]
             }
         }
+        return url, payload
+
+    def _batch_request(self, texts: List[str]):
+        url = f"{self.base_url}/{self.model_name}:batchEmbedContents?key={self.api_key}"
+        # 批量接口要求每条请求的 model 带 "models/" 前缀
+        model = self.model_name if self.model_name.startswith("models/") else f"models/{self.model_name}"
+        payload = {
+            "requests": [
+                {"model": model, "content": {"parts": [{"text": text}]}}
+                for text in texts
+            ]
+        }
+        return url, payload
+
+    @staticmethod
+    def _parse_batch(result: dict, count: int) -> List[List[float]]:
+        embeddings = [item.get("values", []) for item in result.get("embeddings", [])]
+        if len(embeddings) != count:
+            logging.error(f"Gemini batchEmbedContents returned {len(embeddings)} embeddings for {count} texts.")
+            return [[] for _ in range(count)]
+        return embeddings
+
+    def _embed_single(self, text: str) -> List[float]:
+        """
+        直接调用 Google Generative Language API (Gemini) 接口，获取文本 embedding
+        """
+        url, payload = self._embed_request(text)
 
         try:
-            response = requests.post(url, json=payload)
-            print(response.text)
+            response = http_post(url, json=payload)
             response.raise_for_status()
             result = response.json()
             embedding_data = result.get("embedding", {})
             return embedding_data.get("values", [])
         except requests.exceptions.RequestException as e:
             logging.error(f"Gemini embed_content request error: {e}\n{traceback.format_exc()}")
+            raise
+        except Exception as e:
+            logging.error(f"Gemini embed_content parse error: {e}\n{traceback.format_exc()}")
             return []
+
+    async def _aembed_single(self, text: str) -> List[float]:
+        url, payload = self._embed_request(text)
+        try:
+            response = await get_async_http_client().post(url, json=payload)
+            response.raise_for_status()
+            result = response.json()
+            embedding_data = result.get("embedding", {})
+            return embedding_data.get("values", [])
+        except httpx.HTTPError as e:
+            logging.error(f"Gemini embed_content request error: {e}\n{traceback.format_exc()}")
+            raise
         except Exception as e:
             logging.error(f"Gemini embed_content parse error: {e}\n{traceback.format_exc()}")
             return []
 
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        url, payload = self._batch_request(texts)
+        try:
+            response = http_post(url, json=payload)
+            response.raise_for_status()
+            return self._parse_batch(response.json(), len(texts))
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Gemini batch_embed_contents request error: {e}\n{traceback.format_exc()}")
+            raise
+        except ValueError as e:
+            logging.error(f"Gemini batch_embed_contents parse error: {e}\n{traceback.format_exc()}")
+            return [[] for _ in texts]
+
+    async def _aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        url, payload = self._batch_request(texts)
+        try:
+            response = await get_async_http_client().post(url, json=payload)
+            response.raise_for_status()
+            return self._parse_batch(response.json(), len(texts))
+        except httpx.HTTPError as e:
+            logging.error(f"Gemini batch_embed_contents request error: {e}\n{traceback.format_exc()}")
+            raise
+        except ValueError as e:
+            logging.error(f"Gemini batch_embed_contents parse error: {e}\n{traceback.format_exc()}")
+            return [[] for _ in texts]
+
 class SiliconFlowEmbeddingAdapter(BaseEmbeddingAdapter):
     """
-    基于 SiliconFlow 的 embedding 适配器
+    基于 SiliconFlow 的 embedding 适配器，input 传列表，一次请求嵌入一批文本
     """
     def __init__(self, api_key: str, base_url: str, model_name: str):
         # 自动为 base_url 添加 scheme（如果缺失）
@@ -197,65 +679,89 @@ class SiliconFlowEmbeddingAdapter(BaseEmbeddingAdapter):
             base_url = "https://" + base_url
         self.url = base_url if base_url else "https://api.siliconflow.cn/v1/embeddings"
 
-        self.payload = {
-            "model": model_name,
-            "input": "Silicon flow embedding online: fast, affordable, and high-quality embedding services. come try it out!",
-            "encoding_format": "float"
-        }
+        self.model_name = model_name
         self.headers = {
             "Authorization": "Bearer {api_key}".format(api_key=api_key),
             "Content-Type": "application/json"
         }
 
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        embeddings = []
-        for text in texts:
-            try:
-                self.payload["input"] = text
-                response = requests.post(self.url, json=self.payload, headers=self.headers)
-                response.raise_for_status()
-                result = response.json()
-                if not result or "data" not in result or not result["data"]:
-                    logging.error(f"Invalid response format from SiliconFlow API: {result}")
-                    embeddings.append([])
-                    continue
-                emb = result["data"][0].get("embedding", [])
-                embeddings.append(emb)
-            except requests.exceptions.RequestException as e:
-                logging.error(f"SiliconFlow API request failed: {str(e)}")
-                embeddings.append([])
-            except (KeyError, IndexError, ValueError, TypeError) as e:
-                logging.error(f"Error parsing SiliconFlow API response: {str(e)}")
-                embeddings.append([])
-        return embeddings
+    def _payload(self, texts: List[str]) -> dict:
+        # 每次请求新建 payload，并发请求之间互不影响
+        return {"model": self.model_name, "input": texts, "encoding_format": "float"}
 
-    def embed_query(self, query: str) -> List[float]:
+    @staticmethod
+    def _parse_batch(result: dict, count: int) -> List[List[float]]:
+        if not result or "data" not in result or not result["data"]:
+            logging.error(f"Invalid response format from SiliconFlow API: {result}")
+            return [[] for _ in range(count)]
+        data = sorted(result["data"], key=lambda item: item.get("index", 0))
+        if len(data) != count:
+            logging.error(f"SiliconFlow API returned {len(data)} embeddings for {count} texts.")
+            return [[] for _ in range(count)]
+        return [item.get("embedding", []) for item in data]
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
         try:
-            self.payload["input"] = query
-            response = requests.post(self.url, json=self.payload, headers=self.headers)
+            response = http_post(self.url, json=self._payload(texts), headers=self.headers)
             response.raise_for_status()
-            result = response.json()
-            if not result or "data" not in result or not result["data"]:
-                logging.error(f"Invalid response format from SiliconFlow API: {result}")
-                return []
-            return result["data"][0].get("embedding", [])
+            return self._parse_batch(response.json(), len(texts))
         except requests.exceptions.RequestException as e:
             logging.error(f"SiliconFlow API request failed: {str(e)}")
-            return []
-        except (KeyError, IndexError, ValueError, TypeError) as e:
+            raise
+        except (KeyError, IndexError, ValueError, TypeError, AttributeError) as e:
             logging.error(f"Error parsing SiliconFlow API response: {str(e)}")
-            return []
+            return [[] for _ in texts]
 
-def create_embedding_adapter(
-    interface_format: str,
-    api_key: str,
-    base_url: str,
-    model_name: str
-) -> BaseEmbeddingAdapter:
+    async def _aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        try:
+            response = await get_async_http_client().post(self.url, json=self._payload(texts), headers=self.headers)
+            response.raise_for_status()
+            return self._parse_batch(response.json(), len(texts))
+        except httpx.HTTPError as e:
+            logging.error(f"SiliconFlow API request failed: {str(e)}")
+            raise
+        except (KeyError, IndexError, ValueError, TypeError, AttributeError) as e:
+            logging.error(f"Error parsing SiliconFlow API response: {str(e)}")
+            return [[] for _ in texts]
+
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed_batched(texts, self._embed_batch)
+
+    def _embed_query(self, query: str) -> List[float]:
+        return self._embed_batch([query])[0]
+
+    async def _aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self._aembed_batched(texts, self._aembed_batch)
+
+    async def _aembed_query(self, query: str) -> List[float]:
+        return (await self._aembed_batch([query]))[0]
+
+class MockEmbeddingAdapter(BaseEmbeddingAdapter):
     """
-    工厂函数：根据 interface_format 返回不同的 embedding 适配器实例
+    离线模拟后端：按文本确定性地生成向量，维度、延迟与错误率由 base_url 查询串配置，
+    例如 mock://local?dim=256&embed_latency=0.05（参见 mock_backend.py）。
     """
-    fmt = interface_format.strip().lower()
+    def __init__(self, base_url: str, model_name: str):
+        self.base_url = base_url
+        self.model_name = model_name or "mock"
+        self._client = MockEmbedding(parse_mock_options(base_url))
+
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # 整组文本模拟为一次请求
+        with self._limited(texts):
+            return self._client.embed(texts)
+
+    def _embed_query(self, query: str) -> List[float]:
+        return self._client.embed([query])[0]
+
+    async def _aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        async with self._alimited(texts):
+            return await self._client.aembed(texts)
+
+    async def _aembed_query(self, query: str) -> List[float]:
+        return (await self._client.aembed([query]))[0]
+
+def _new_embedding_adapter(fmt: str, interface_format: str, api_key: str, base_url: str, model_name: str) -> BaseEmbeddingAdapter:
     if fmt == "openai":
         return OpenAIEmbeddingAdapter(api_key, base_url, model_name)
     elif fmt == "azure openai":
@@ -268,5 +774,23 @@ def create_embedding_adapter(
         return GeminiEmbeddingAdapter(api_key, model_name, base_url)
     elif fmt == "siliconflow":
         return SiliconFlowEmbeddingAdapter(api_key, base_url, model_name)
+    elif fmt == "mock":
+        return MockEmbeddingAdapter(base_url, model_name)
     else:
         raise ValueError(f"Unknown embedding interface_format: {interface_format}")
+
+def create_embedding_adapter(
+    interface_format: str,
+    api_key: str,
+    base_url: str,
+    model_name: str
+) -> BaseEmbeddingAdapter:
+    """
+    工厂函数：根据 interface_format 返回不同的 embedding 适配器实例
+    """
+    fmt = interface_format.strip().lower()
+    adapter = _new_embedding_adapter(fmt, interface_format, api_key, base_url, model_name)
+    adapter.provider = interface_format.strip()
+    adapter.limit_key = api_key
+    adapter.flight_key = hashlib.sha256(json.dumps([fmt, base_url, model_name, api_key]).encode("utf-8")).hexdigest()
+    return adapter
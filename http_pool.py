@@ -0,0 +1,165 @@
+# http_pool.py
+# -*- coding: utf-8 -*-
+"""
+按 endpoint（scheme://host:port）共享的 HTTP 连接池：
+- requests.Session：供直接发 HTTP 请求的适配器使用（Ollama / Gemini / SiliconFlow embedding 等）；
+- httpx.Client：传给 OpenAI / langchain 等 SDK；
+- httpx.AsyncClient：与事件循环绑定，按事件循环各缓存一个。
+连接保持 keep-alive，连接/读取超时可通过 config.json 的 "http" 配置，例如：
+{"http": {"connect_timeout": 10, "read_timeout": 120, "pool_maxsize": 20, "max_keepalive": 10}}
+各 endpoint 的请求数、错误数、新建连接数可通过 get_http_pool_stats() 查看。
+"""
+import asyncio
+import threading
+import weakref
+from typing import Optional
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+_http_settings = {
+    "connect_timeout": 10.0,
+    "read_timeout": 120.0,
+    "pool_maxsize": 20,
+    "max_keepalive": 10
+}
+
+# requests 的 pool_connections 是缓存的按 host 连接池个数，不是连接数；每个 Session 只服务一个 endpoint，少量即可
+SESSION_HOST_POOLS = 4
+
+_sessions = {}
+_http_clients = {}
+_async_http_clients = weakref.WeakKeyDictionary()
+_pool_lock = threading.Lock()
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+def configure_http_pool(settings: dict):
+    """应用 config.json 中的 "http" 配置；之后新建的连接池使用新参数"""
+    for key, value in (settings or {}).items():
+        if key in _http_settings:
+            _http_settings[key] = value
+
+def _endpoint(url: str) -> Optional[str]:
+    parts = urlsplit(url or "")
+    if not parts.scheme or not parts.netloc:
+        return None
+    return f"{parts.scheme}://{parts.netloc}"
+
+def _record(endpoint: str, error: bool = False):
+    with _stats_lock:
+        stats = _stats.setdefault(endpoint, {"requests": 0, "errors": 0})
+        stats["requests"] += 1
+        if error:
+            stats["errors"] += 1
+
+def default_timeout(read_timeout: Optional[float] = None) -> tuple:
+    """requests 使用的 (connect, read) 超时"""
+    return (
+        float(_http_settings["connect_timeout"]),
+        float(read_timeout if read_timeout is not None else _http_settings["read_timeout"])
+    )
+
+def get_session(url: str) -> requests.Session:
+    """获取 url 所在 endpoint 的共享 requests.Session"""
+    endpoint = _endpoint(url) or ""
+    with _pool_lock:
+        session = _sessions.get(endpoint)
+        if session is None:
+            session = requests.Session()
+            # pool_maxsize 是每个 host 保留复用的连接数（非阻塞池，超出的连接用完即关闭），对应 max_keepalive
+            adapter = HTTPAdapter(
+                pool_connections=SESSION_HOST_POOLS,
+                pool_maxsize=int(_http_settings["max_keepalive"])
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[endpoint] = session
+        return session
+
+def post(url: str, timeout: Optional[float] = None, **kwargs) -> requests.Response:
+    """
+    通过共享 Session 发送 POST，未指定时使用默认的连接/读取超时。
+    timeout 为读取超时秒数，或 requests 接受的 (connect, read) 元组。
+    """
+    endpoint = _endpoint(url) or ""
+    if not isinstance(timeout, tuple):
+        timeout = default_timeout(timeout)
+    try:
+        response = get_session(url).post(url, timeout=timeout, **kwargs)
+    except requests.exceptions.RequestException:
+        _record(endpoint, error=True)
+        raise
+    _record(endpoint, error=response.status_code >= 400)
+    return response
+
+def _httpx_timeout(timeout: Optional[float]) -> httpx.Timeout:
+    read = float(timeout if timeout is not None else _http_settings["read_timeout"])
+    return httpx.Timeout(read, connect=float(_http_settings["connect_timeout"]))
+
+def _httpx_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=int(_http_settings["pool_maxsize"]),
+        max_keepalive_connections=int(_http_settings["max_keepalive"])
+    )
+
+def get_http_client(base_url: str, timeout: Optional[float] = None) -> Optional[httpx.Client]:
+    """
+    获取 base_url 所在 endpoint 的共享 httpx.Client（keep-alive 连接池）。
+    base_url 为空时返回 None，由 SDK 自行创建默认客户端。
+    """
+    endpoint = _endpoint(base_url)
+    if endpoint is None:
+        return None
+    with _pool_lock:
+        client = _http_clients.get(endpoint)
+        if client is None:
+            client = httpx.Client(
+                timeout=_httpx_timeout(timeout),
+                limits=_httpx_limits(),
+                event_hooks={"response": [lambda response: _record(endpoint, response.status_code >= 400)]}
+            )
+            _http_clients[endpoint] = client
+        return client
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """获取当前事件循环的共享 httpx.AsyncClient"""
+    loop = asyncio.get_running_loop()
+    with _pool_lock:
+        client = _async_http_clients.get(loop)
+        if client is None:
+            async def on_response(response):
+                _record(_endpoint(str(response.request.url)) or "", response.status_code >= 400)
+
+            client = httpx.AsyncClient(
+                timeout=_httpx_timeout(None),
+                limits=_httpx_limits(),
+                event_hooks={"response": [on_response]}
+            )
+            _async_http_clients[loop] = client
+        return client
+
+def get_http_pool_stats() -> dict:
+    """
+    各 endpoint 的请求数、错误数，以及 requests.Session 新建的连接数
+    （connections 远小于 requests 说明 keep-alive 生效）。
+    """
+    with _stats_lock:
+        stats = {endpoint: dict(values) for endpoint, values in _stats.items()}
+    with _pool_lock:
+        sessions = list(_sessions.items())
+    for endpoint, session in sessions:
+        connections = 0
+        for adapter in set(session.adapters.values()):
+            pools = getattr(adapter.poolmanager, "pools", None)
+            if pools is None:
+                continue
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += getattr(pool, "num_connections", 0)
+        stats.setdefault(endpoint, {"requests": 0, "errors": 0})["connections"] = connections
+    return stats
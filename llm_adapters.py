@@ -1,14 +1,28 @@
 # llm_adapters.py
 # -*- coding: utf-8 -*-
+import asyncio
+import contextvars
 import logging
-from typing import Optional
+import queue
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Iterator, Optional
 from langchain_openai import ChatOpenAI, AzureChatOpenAI
 import google.generativeai as genai
 from azure.ai.inference import ChatCompletionsClient
 from azure.core.credentials import AzureKeyCredential
+from azure.ai.inference.aio import ChatCompletionsClient as AsyncChatCompletionsClient
 from azure.ai.inference.models import SystemMessage, UserMessage
-from openai import OpenAI
-import requests
+from openai import AsyncOpenAI, OpenAI
+from http_pool import get_async_http_client, get_http_client
+from llm_metrics import current_call, track_call
+from llm_usage import record_usage
+from rate_limiter import estimate_tokens, get_rate_limiter
+from mock_backend import MockLLM, parse_options as parse_mock_options
 
 
 def check_base_url(url: str) -> str:
@@ -30,16 +44,139 @@ def check_base_url(url: str) -> str:
             url = url.rstrip('/') + '/v1'
     return url
 
+
+# 各适配器按事件循环缓存的异步客户端（见 BaseLLMAdapter._loop_client）
+_loop_clients_lock = threading.Lock()
+
+# 各服务商表示"达到 max_tokens 被截断"的结束原因
+_LENGTH_FINISH_REASONS = {"length", "max_tokens", "token_limit", "max_output_tokens"}
+
+def normalize_finish_reason(reason) -> str:
+    """统一各 SDK 的结束原因（字符串或枚举）；因长度截断一律返回 "length" """
+    name = str(getattr(reason, "name", None) or getattr(reason, "value", None) or reason).strip().lower()
+    name = name.rsplit(".", 1)[-1]
+    return "length" if name in _LENGTH_FINISH_REASONS else name
+
 class BaseLLMAdapter:
     """
     统一的 LLM 接口基类，为不同后端（OpenAI、Ollama、ML Studio、Gemini等）提供一致的方法签名。
+    temperature / max_tokens 可在单次调用时覆盖，未传入时使用创建适配器时的配置。
+    公共方法 invoke / invoke_stream / ainvoke 负责限流等通用逻辑，
+    子类实现对应的 _invoke / _invoke_stream / _ainvoke。
     """
-    def invoke(self, prompt: str) -> str:
-        raise NotImplementedError("Subclasses must implement .invoke(prompt) method.")
+    # 服务商名称（interface_format），由 create_llm_adapter 设置，用于查找限流器
+    provider = ""
+
+    def invoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
+        with track_call(self.provider, getattr(self, "model_name", ""), "invoke") as call, call.active():
+            with self._limited(prompt, max_tokens):
+                call.queued()
+                return self._invoke(prompt, temperature, max_tokens)
+
+    def invoke_stream(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> Iterator[str]:
+        """
+        流式调用，逐块 yield 文本增量。
+        """
+        with track_call(self.provider, getattr(self, "model_name", ""), "stream") as call:
+            with self._limited(prompt, max_tokens):
+                call.queued()
+                stream = self._invoke_stream(prompt, temperature, max_tokens)
+                try:
+                    while True:
+                        # 只在取下一块时登记为当前调用，yield 给调用方时不泄漏该上下文
+                        with call.active():
+                            try:
+                                chunk = next(stream)
+                            except StopIteration:
+                                break
+                        if chunk:
+                            call.first_token()
+                        yield chunk
+                finally:
+                    close = getattr(stream, "close", None)
+                    if close is not None:
+                        close()
+
+    async def ainvoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
+        """
+        异步调用，限流等待不会阻塞事件循环。
+        """
+        with track_call(self.provider, getattr(self, "model_name", ""), "ainvoke") as call, call.active():
+            async with self._alimited(prompt, max_tokens):
+                call.queued()
+                return await self._ainvoke(prompt, temperature, max_tokens)
+
+    def _invoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
+        raise NotImplementedError("Subclasses must implement ._invoke(prompt) method.")
+
+    def _invoke_stream(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> Iterator[str]:
+        """未实现原生流式的后端退化为一次性返回完整结果"""
+        result = self._invoke(prompt, temperature, max_tokens)
+        if result:
+            yield result
 
-class DeepSeekAdapter(BaseLLMAdapter):
+    async def _ainvoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
+        """未实现原生异步客户端的后端在线程池中执行 _invoke"""
+        return await asyncio.to_thread(self._invoke, prompt, temperature, max_tokens)
+
+    def _loop_client(self, factory):
+        """
+        当前事件循环专用的异步客户端，首次使用时由 factory() 创建。
+        适配器在进程内复用，而异步连接只能在创建它的事件循环中使用，
+        多次 asyncio.run 之间不能共用同一个异步客户端。
+        """
+        loop = asyncio.get_running_loop()
+        with _loop_clients_lock:
+            clients = self.__dict__.setdefault("_async_clients", weakref.WeakKeyDictionary())
+            client = clients.get(loop)
+            if client is None:
+                client = factory()
+                clients[loop] = client
+            return client
+
+    def _estimated_tokens(self, prompt: str, max_tokens: Optional[int] = None) -> int:
+        """TPM 预扣额度：提示词估算 token 数 + 本次允许的最大输出"""
+        completion = max_tokens if max_tokens is not None else getattr(self, "max_tokens", 0)
+        return estimate_tokens(prompt) + int(completion or 0)
+
+    def _limited(self, prompt: str, max_tokens: Optional[int] = None):
+        limiter = get_rate_limiter(self.provider, getattr(self, "api_key", ""))
+        if limiter is None:
+            return nullcontext()
+        return limiter.limit(tokens=self._estimated_tokens(prompt, max_tokens))
+
+    def _alimited(self, prompt: str, max_tokens: Optional[int] = None):
+        limiter = get_rate_limiter(self.provider, getattr(self, "api_key", ""))
+        if limiter is None:
+            return nullcontext()
+        return limiter.alimit(tokens=self._estimated_tokens(prompt, max_tokens))
+
+    def _record_usage(self, usage):
+        """把服务商返回的 usage（含缓存命中的 token 数）计入当前阶段的统计及本次调用的指标记录"""
+        if usage:
+            parsed = record_usage(usage, self.provider, getattr(self, "model_name", ""))
+            call = current_call()
+            if call is not None:
+                call.add_usage(parsed)
+
+    def _record_finish_reason(self, reason):
+        """登记本次调用的结束原因（"stop" / "length" 等），供调用方判断输出是否因长度限制被截断"""
+        call = current_call()
+        if call is not None and reason:
+            call.finish_reason = normalize_finish_reason(reason)
+
+    def _call_overrides(self, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> dict:
+        """只返回本次调用显式覆盖的参数"""
+        overrides = {}
+        if temperature is not None:
+            overrides["temperature"] = temperature
+        if max_tokens is not None:
+            overrides["max_tokens"] = max_tokens
+        return overrides
+
+class _ChatOpenAIAdapter(BaseLLMAdapter):
     """
-    适配官方/OpenAI兼容接口（使用 langchain.ChatOpenAI）
+    基于 langchain.ChatOpenAI 的适配器公共实现（DeepSeek / OpenAI / Ollama / ML Studio 共用）
     """
     def __init__(self, api_key: str, base_url: str, model_name: str, max_tokens: int, temperature: float = 0.7, timeout: Optional[int] = 600):
         self.base_url = check_base_url(base_url)
@@ -49,26 +186,62 @@ class DeepSeekAdapter(BaseLLMAdapter):
         self.temperature = temperature
         self.timeout = timeout
 
-        self._client = ChatOpenAI(
+        self._client = self._make_client(http_client=get_http_client(self.base_url, self.timeout))
+
+    def _make_client(self, **http_clients):
+        return ChatOpenAI(
             model=self.model_name,
             api_key=self.api_key,
             base_url=self.base_url,
             max_tokens=self.max_tokens,
             temperature=self.temperature,
-            timeout=self.timeout
+            timeout=self.timeout,
+            max_retries=0,  # 重试统一由 novel_generator.common.RetryPolicy 负责
+            stream_usage=True,  # 流式调用在最后一块返回 usage
+            **http_clients
         )
 
-    def invoke(self, prompt: str) -> str:
-        response = self._client.invoke(prompt)
+    def _async_chat_client(self):
+        """异步调用使用按事件循环创建、绑定当前循环共享 httpx.AsyncClient 的实例"""
+        return self._loop_client(lambda: self._make_client(http_async_client=get_async_http_client()))
+
+    def _invoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
+        response = self._client.invoke(prompt, **self._call_overrides(temperature, max_tokens))
         if not response:
-            logging.warning("No response from DeepSeekAdapter.")
+            logging.warning(f"No response from {type(self).__name__}.")
             return ""
+        self._record_message_usage(response)
         return response.content
 
-class OpenAIAdapter(BaseLLMAdapter):
+    def _invoke_stream(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> Iterator[str]:
+        for chunk in self._client.stream(prompt, **self._call_overrides(temperature, max_tokens)):
+            # 客户端开启了 stream_usage，usage 在流结束时的最后一块中返回
+            if getattr(chunk, "usage_metadata", None):
+                self._record_usage(chunk.usage_metadata)
+            self._record_finish_reason((getattr(chunk, "response_metadata", None) or {}).get("finish_reason"))
+            if chunk.content:
+                yield chunk.content
+
+    async def _ainvoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
+        response = await self._async_chat_client().ainvoke(prompt, **self._call_overrides(temperature, max_tokens))
+        if not response:
+            logging.warning(f"No response from {type(self).__name__}.")
+            return ""
+        self._record_message_usage(response)
+        return response.content
+
+    def _record_message_usage(self, message):
+        # 原始 token_usage 保留了服务商特有的缓存字段（如 DeepSeek 的 prompt_cache_hit_tokens）
+        metadata = getattr(message, "response_metadata", None) or {}
+        self._record_usage(metadata.get("token_usage") or getattr(message, "usage_metadata", None))
+        self._record_finish_reason(metadata.get("finish_reason"))
+
+class _OpenAISDKAdapter(BaseLLMAdapter):
     """
-    适配官方/OpenAI兼容接口（使用 langchain.ChatOpenAI）
+    基于 openai.OpenAI SDK 直接调用 chat.completions 的适配器公共实现（火山引擎 / 硅基流动 共用）
     """
+    provider_label = "OpenAI SDK"
+
     def __init__(self, api_key: str, base_url: str, model_name: str, max_tokens: int, temperature: float = 0.7, timeout: Optional[int] = 600):
         self.base_url = check_base_url(base_url)
         self.api_key = api_key
@@ -77,21 +250,102 @@ class OpenAIAdapter(BaseLLMAdapter):
         self.temperature = temperature
         self.timeout = timeout
 
-        self._client = ChatOpenAI(
-            model=self.model_name,
-            api_key=self.api_key,
+        self._client = OpenAI(
             base_url=self.base_url,
-            max_tokens=self.max_tokens,
-            temperature=self.temperature,
-            timeout=self.timeout
+            api_key=api_key,
+            timeout=timeout,  # 添加超时配置
+            max_retries=0,  # 重试统一由 novel_generator.common.RetryPolicy 负责
+            http_client=get_http_client(self.base_url, timeout)
         )
 
-    def invoke(self, prompt: str) -> str:
-        response = self._client.invoke(prompt)
-        if not response:
-            logging.warning("No response from OpenAIAdapter.")
-            return ""
-        return response.content
+    def _async_client(self) -> AsyncOpenAI:
+        return self._loop_client(lambda: AsyncOpenAI(
+            base_url=self.base_url,
+            api_key=self.api_key,
+            timeout=self.timeout,
+            max_retries=0,
+            http_client=get_async_http_client()
+        ))
+
+    def _invoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
+        try:
+            response = self._client.chat.completions.create(
+                model=self.model_name,
+                messages=[
+                    {"role": "system", "content": "你是DeepSeek，是一个 AI 人工智能助手"},
+                    {"role": "user", "content": prompt},
+                ],
+                timeout=self.timeout,  # 添加超时参数
+                **self._call_overrides(temperature, max_tokens)
+            )
+            if not response:
+                logging.warning(f"No response from {type(self).__name__}.")
+                return ""
+            self._record_usage(getattr(response, "usage", None))
+            self._record_finish_reason(response.choices[0].finish_reason)
+            return response.choices[0].message.content
+        except Exception as e:
+            # 交由调用方按状态码与 Retry-After 决定是否重试
+            logging.error(f"{self.provider_label}API调用超时或失败: {e}")
+            raise
+
+    def _invoke_stream(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> Iterator[str]:
+        try:
+            stream = self._client.chat.completions.create(
+                model=self.model_name,
+                messages=[
+                    {"role": "system", "content": "你是DeepSeek，是一个 AI 人工智能助手"},
+                    {"role": "user", "content": prompt},
+                ],
+                timeout=self.timeout,
+                stream=True,
+                stream_options={"include_usage": True},
+                **self._call_overrides(temperature, max_tokens)
+            )
+            for chunk in stream:
+                # usage 只出现在最后一块（choices 为空）
+                self._record_usage(getattr(chunk, "usage", None))
+                if chunk.choices:
+                    self._record_finish_reason(chunk.choices[0].finish_reason)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            logging.error(f"{self.provider_label}API流式调用超时或失败: {e}")
+            raise
+
+    async def _ainvoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
+        try:
+            response = await self._async_client().chat.completions.create(
+                model=self.model_name,
+                messages=[
+                    {"role": "system", "content": "你是DeepSeek，是一个 AI 人工智能助手"},
+                    {"role": "user", "content": prompt},
+                ],
+                timeout=self.timeout,
+                **self._call_overrides(temperature, max_tokens)
+            )
+            if not response:
+                logging.warning(f"No response from {type(self).__name__}.")
+                return ""
+            self._record_usage(getattr(response, "usage", None))
+            self._record_finish_reason(response.choices[0].finish_reason)
+            return response.choices[0].message.content
+        except Exception as e:
+            # 交由调用方按状态码与 Retry-After 决定是否重试
+            logging.error(f"{self.provider_label}API异步调用超时或失败: {e}")
+            raise
+
+class DeepSeekAdapter(_ChatOpenAIAdapter):
+    """
+    适配官方/OpenAI兼容接口（使用 langchain.ChatOpenAI）
+    """
+    pass
+
+class OpenAIAdapter(_ChatOpenAIAdapter):
+    """
+    适配官方/OpenAI兼容接口（使用 langchain.ChatOpenAI）
+    """
+    pass
 
 class GeminiAdapter(BaseLLMAdapter):
     """
@@ -106,18 +360,20 @@ class GeminiAdapter(BaseLLMAdapter):
 
         self._client = genai.Client(api_key=self.api_key)
 
-    def invoke(self, prompt: str) -> str:
+    def _invoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
         try:
             response = self._client.models.generate_content(
                 model = self.model_name,
                 contents = prompt,
                 config = genai.types.GenerateContentConfig(
-                    max_output_tokens=self.max_tokens,
-                    temperature=self.temperature,
+                    max_output_tokens=self.max_tokens if max_tokens is None else max_tokens,
+                    temperature=self.temperature if temperature is None else temperature,
                 ),
                 timeout=self.timeout  # 添加超时参数
             )
             if response and response.text:
+                self._record_usage(getattr(response, "usage_metadata", None))
+                self._record_gemini_finish_reason(response)
                 return response.text
             else:
                 logging.warning("No text response from Gemini API.")
@@ -126,7 +382,55 @@ class GeminiAdapter(BaseLLMAdapter):
             logging.error(f"Gemini API 调用失败: {e}")
             return ""
 
-class AzureOpenAIAdapter(BaseLLMAdapter):
+    def _invoke_stream(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> Iterator[str]:
+        usage = None
+        try:
+            for chunk in self._client.models.generate_content_stream(
+                model = self.model_name,
+                contents = prompt,
+                config = genai.types.GenerateContentConfig(
+                    max_output_tokens=self.max_tokens if max_tokens is None else max_tokens,
+                    temperature=self.temperature if temperature is None else temperature,
+                ),
+                timeout=self.timeout
+            ):
+                # 每个块携带累计用量，结束后只记录最后一次
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                self._record_gemini_finish_reason(chunk)
+                if chunk and chunk.text:
+                    yield chunk.text
+            self._record_usage(usage)
+        except Exception as e:
+            logging.error(f"Gemini API 流式调用失败: {e}")
+
+    async def _ainvoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
+        try:
+            client = self._loop_client(lambda: genai.Client(api_key=self.api_key))
+            response = await client.aio.models.generate_content(
+                model = self.model_name,
+                contents = prompt,
+                config = genai.types.GenerateContentConfig(
+                    max_output_tokens=self.max_tokens if max_tokens is None else max_tokens,
+                    temperature=self.temperature if temperature is None else temperature,
+                )
+            )
+            if response and response.text:
+                self._record_usage(getattr(response, "usage_metadata", None))
+                self._record_gemini_finish_reason(response)
+                return response.text
+            else:
+                logging.warning("No text response from Gemini API.")
+                return ""
+        except Exception as e:
+            logging.error(f"Gemini API 异步调用失败: {e}")
+            return ""
+
+    def _record_gemini_finish_reason(self, response):
+        candidates = getattr(response, "candidates", None)
+        if candidates:
+            self._record_finish_reason(getattr(candidates[0], "finish_reason", None))
+
+class AzureOpenAIAdapter(_ChatOpenAIAdapter):
     """
     适配 Azure OpenAI 接口（使用 langchain.ChatOpenAI）
     """
@@ -146,81 +450,50 @@ class AzureOpenAIAdapter(BaseLLMAdapter):
         self.temperature = temperature
         self.timeout = timeout
 
-        self._client = AzureChatOpenAI(
+        self._client = self._make_client(http_client=get_http_client(self.azure_endpoint, self.timeout))
+
+    def _make_client(self, **http_clients):
+        return AzureChatOpenAI(
             azure_endpoint=self.azure_endpoint,
             azure_deployment=self.azure_deployment,
             api_version=self.api_version,
             api_key=self.api_key,
             max_tokens=self.max_tokens,
             temperature=self.temperature,
-            timeout=self.timeout
+            timeout=self.timeout,
+            max_retries=0,
+            stream_usage=True,
+            **http_clients
         )
 
-    def invoke(self, prompt: str) -> str:
-        response = self._client.invoke(prompt)
-        if not response:
-            logging.warning("No response from AzureOpenAIAdapter.")
-            return ""
-        return response.content
-
-class OllamaAdapter(BaseLLMAdapter):
+class OllamaAdapter(_ChatOpenAIAdapter):
     """
     Ollama 同样有一个 OpenAI-like /v1/chat 接口，可直接使用 ChatOpenAI。
     """
     def __init__(self, api_key: str, base_url: str, model_name: str, max_tokens: int, temperature: float = 0.7, timeout: Optional[int] = 600):
-        self.base_url = check_base_url(base_url)
-        self.api_key = api_key
-        self.model_name = model_name
-        self.max_tokens = max_tokens
-        self.temperature = temperature
-        self.timeout = timeout
-
-        if self.api_key == '':
-            self.api_key= 'ollama'
-
-        self._client = ChatOpenAI(
-            model=self.model_name,
-            api_key=self.api_key,
-            base_url=self.base_url,
-            max_tokens=self.max_tokens,
-            temperature=self.temperature,
-            timeout=self.timeout
-        )
+        if api_key == '':
+            api_key = 'ollama'
+        super().__init__(api_key, base_url, model_name, max_tokens, temperature, timeout)
 
-    def invoke(self, prompt: str) -> str:
-        response = self._client.invoke(prompt)
-        if not response:
-            logging.warning("No response from OllamaAdapter.")
+class MLStudioAdapter(_ChatOpenAIAdapter):
+    def _invoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
+        try:
+            return super()._invoke(prompt, temperature, max_tokens)
+        except Exception as e:
+            logging.error(f"ML Studio API 调用超时或失败: {e}")
             return ""
-        return response.content
 
-class MLStudioAdapter(BaseLLMAdapter):
-    def __init__(self, api_key: str, base_url: str, model_name: str, max_tokens: int, temperature: float = 0.7, timeout: Optional[int] = 600):
-        self.base_url = check_base_url(base_url)
-        self.api_key = api_key
-        self.model_name = model_name
-        self.max_tokens = max_tokens
-        self.temperature = temperature
-        self.timeout = timeout
-
-        self._client = ChatOpenAI(
-            model=self.model_name,
-            api_key=self.api_key,
-            base_url=self.base_url,
-            max_tokens=self.max_tokens,
-            temperature=self.temperature,
-            timeout=self.timeout
-        )
+    def _invoke_stream(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> Iterator[str]:
+        try:
+            yield from super()._invoke_stream(prompt, temperature, max_tokens)
+        except Exception as e:
+            logging.error(f"ML Studio API 流式调用超时或失败: {e}")
 
-    def invoke(self, prompt: str) -> str:
+    async def _ainvoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
         try:
-            response = self._client.invoke(prompt)
-            if not response:
-                logging.warning("No response from MLStudioAdapter.")
-                return ""
-            return response.content
+            return await super()._ainvoke(prompt, temperature, max_tokens)
         except Exception as e:
-            logging.error(f"ML Studio API 调用超时或失败: {e}")
+            logging.error(f"ML Studio API 异步调用超时或失败: {e}")
             return ""
 
 class AzureAIAdapter(BaseLLMAdapter):
@@ -256,15 +529,29 @@ class AzureAIAdapter(BaseLLMAdapter):
             timeout=self.timeout
         )
 
-    def invoke(self, prompt: str) -> str:
+    def _async_client(self) -> AsyncChatCompletionsClient:
+        # azure-core 使用自带的 aiohttp 传输，不能传入 httpx 客户端，只按事件循环各建一个
+        return self._loop_client(lambda: AsyncChatCompletionsClient(
+            endpoint=self.endpoint,
+            credential=AzureKeyCredential(self.api_key),
+            model=self.model_name,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            timeout=self.timeout
+        ))
+
+    def _invoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
         try:
             response = self._client.complete(
                 messages=[
                     SystemMessage("You are a helpful assistant."),
                     UserMessage(prompt)
-                ]
+                ],
+                **self._call_overrides(temperature, max_tokens)
             )
             if response and response.choices:
+                self._record_usage(getattr(response, "usage", None))
+                self._record_finish_reason(response.choices[0].finish_reason)
                 return response.choices[0].message.content
             else:
                 logging.warning("No response from AzureAIAdapter.")
@@ -273,84 +560,371 @@ class AzureAIAdapter(BaseLLMAdapter):
             logging.error(f"Azure AI Inference API 调用失败: {e}")
             return ""
 
-# 火山引擎实现
-class VolcanoEngineAIAdapter(BaseLLMAdapter):
-    def __init__(self, api_key: str, base_url: str, model_name: str, max_tokens: int, temperature: float = 0.7, timeout: Optional[int] = 600):
-        self.base_url = check_base_url(base_url)
-        self.api_key = api_key
-        self.model_name = model_name
-        self.max_tokens = max_tokens
-        self.temperature = temperature
-        self.timeout = timeout
+    def _invoke_stream(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> Iterator[str]:
+        try:
+            response = self._client.complete(
+                messages=[
+                    SystemMessage("You are a helpful assistant."),
+                    UserMessage(prompt)
+                ],
+                stream=True,
+                **self._call_overrides(temperature, max_tokens)
+            )
+            for update in response:
+                self._record_usage(getattr(update, "usage", None))
+                if update.choices:
+                    self._record_finish_reason(update.choices[0].finish_reason)
+                if update.choices and update.choices[0].delta.content:
+                    yield update.choices[0].delta.content
+        except Exception as e:
+            logging.error(f"Azure AI Inference API 流式调用失败: {e}")
 
-        self._client = OpenAI(
-            base_url=base_url,
-            api_key=api_key,
-            timeout=timeout  # 添加超时配置
-        )
-    def invoke(self, prompt: str) -> str:
+    async def _ainvoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
         try:
-            response = self._client.chat.completions.create(
-                model=self.model_name,
+            response = await self._async_client().complete(
                 messages=[
-                    {"role": "system", "content": "你是DeepSeek，是一个 AI 人工智能助手"},
-                    {"role": "user", "content": prompt},
+                    SystemMessage("You are a helpful assistant."),
+                    UserMessage(prompt)
                 ],
-                timeout=self.timeout  # 添加超时参数
+                **self._call_overrides(temperature, max_tokens)
             )
-            if not response:
-                logging.warning("No response from DeepSeekAdapter.")
+            if response and response.choices:
+                self._record_usage(getattr(response, "usage", None))
+                self._record_finish_reason(response.choices[0].finish_reason)
+                return response.choices[0].message.content
+            else:
+                logging.warning("No response from AzureAIAdapter.")
                 return ""
-            return response.choices[0].message.content
         except Exception as e:
-            logging.error(f"火山引擎API调用超时或失败: {e}")
+            logging.error(f"Azure AI Inference API 异步调用失败: {e}")
             return ""
 
-class SiliconFlowAdapter(BaseLLMAdapter):
+# 火山引擎实现
+class VolcanoEngineAIAdapter(_OpenAISDKAdapter):
+    provider_label = "火山引擎"
+
+class SiliconFlowAdapter(_OpenAISDKAdapter):
+    provider_label = "硅基流动"
+
+class MockLLMAdapter(BaseLLMAdapter):
+    """
+    离线模拟后端：按提示词确定性地生成文本，延迟、速度、错误率与截断由 base_url 查询串配置，
+    例如 mock://local?latency=0.5&tps=40&error_rate=0.05（参见 mock_backend.py）。
+    """
     def __init__(self, api_key: str, base_url: str, model_name: str, max_tokens: int, temperature: float = 0.7, timeout: Optional[int] = 600):
-        self.base_url = check_base_url(base_url)
+        self.base_url = base_url
         self.api_key = api_key
-        self.model_name = model_name
+        self.model_name = model_name or "mock"
         self.max_tokens = max_tokens
         self.temperature = temperature
         self.timeout = timeout
+        self._client = MockLLM(self.model_name, parse_mock_options(base_url))
 
-        self._client = OpenAI(
-            base_url=base_url,
-            api_key=api_key,
-            timeout=timeout  # 添加超时配置
-        )
-    def invoke(self, prompt: str) -> str:
+    def _invoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
+        text, finish_reason, usage = self._client.complete(prompt, max_tokens or self.max_tokens)
+        self._record_usage(usage)
+        self._record_finish_reason(finish_reason)
+        return text
+
+    def _invoke_stream(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> Iterator[str]:
+        for chunk, finish_reason, usage in self._client.stream(prompt, max_tokens or self.max_tokens):
+            self._record_usage(usage)
+            self._record_finish_reason(finish_reason)
+            yield chunk
+
+    async def _ainvoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
+        text, finish_reason, usage = await self._client.acomplete(prompt, max_tokens or self.max_tokens)
+        self._record_usage(usage)
+        self._record_finish_reason(finish_reason)
+        return text
+
+class _BackendHealth:
+    """
+    单个后端的健康状况：延迟样本、连续失败次数与冷却截止时间。
+    延迟样本按模式分开：stream 为首 token 延迟，invoke 为完整响应的耗时。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {"invoke": deque(maxlen=100), "stream": deque(maxlen=100)}
+        self.failures = 0
+        self.cooldown_until = 0.0
+
+    def record_success(self, mode: str, latency: float):
+        with self._lock:
+            self.latencies[mode].append(latency)
+            self.failures = 0
+            self.cooldown_until = 0.0
+
+    def record_failure(self, threshold: int, cooldown: float) -> bool:
+        """记录一次失败，连续失败达到 threshold 次时进入冷却，返回是否进入冷却"""
+        with self._lock:
+            self.failures += 1
+            if self.failures >= threshold:
+                self.cooldown_until = time.monotonic() + cooldown
+                return True
+            return False
+
+    def available(self) -> bool:
+        return time.monotonic() >= self.cooldown_until
+
+    def percentile(self, mode: str, q: float, min_samples: int) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self.latencies[mode])
+        if len(samples) < max(min_samples, 1):
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+_backend_health = weakref.WeakKeyDictionary()
+_backend_health_lock = threading.Lock()
+
+def _get_backend_health(adapter: BaseLLMAdapter) -> _BackendHealth:
+    with _backend_health_lock:
+        health = _backend_health.get(adapter)
+        if health is None:
+            health = _BackendHealth()
+            _backend_health[adapter] = health
+        return health
+
+_hedge_executor = None
+_hedge_loop = None
+_hedge_executor_lock = threading.Lock()
+
+def _get_hedge_executor() -> ThreadPoolExecutor:
+    global _hedge_executor
+    with _hedge_executor_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-hedge")
+        return _hedge_executor
+
+def _get_hedge_loop() -> asyncio.AbstractEventLoop:
+    """
+    同步 invoke 的对冲在这个常驻后台线程的事件循环中以 ainvoke 执行：
+    落选的请求可以直接取消（关闭其异步连接），各后端按事件循环缓存的异步客户端也能在多次调用间复用。
+    """
+    global _hedge_loop
+    with _hedge_executor_lock:
+        if _hedge_loop is None:
+            _hedge_loop = asyncio.new_event_loop()
+            threading.Thread(target=_hedge_loop.run_forever, name="llm-hedge-loop", daemon=True).start()
+        return _hedge_loop
+
+def _pump_backend(call, adapter: BaseLLMAdapter, index: int, events: queue.Queue, stop: threading.Event):
+    """在线程中执行 call(adapter)，把产出的文本块与结束/异常事件放入 events"""
+    try:
+        stream = call(adapter)
         try:
-            response = self._client.chat.completions.create(
-                model=self.model_name,
-                messages=[
-                    {"role": "system", "content": "你是DeepSeek，是一个 AI 人工智能助手"},
-                    {"role": "user", "content": prompt},
-                ],
-                timeout=self.timeout  # 添加超时参数
-            )
-            if not response:
-                logging.warning("No response from DeepSeekAdapter.")
-                return ""
-            return response.choices[0].message.content
-        except Exception as e:
-            logging.error(f"硅基流动API调用超时或失败: {e}")
-            return ""
+            for chunk in stream:
+                if stop.is_set():
+                    break
+                events.put((index, "chunk", chunk))
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+        events.put((index, "done", None))
+    except Exception as e:
+        events.put((index, "error", e))
 
-def create_llm_adapter(
-    interface_format: str,
-    base_url: str,
-    model_name: str,
-    api_key: str,
-    temperature: float,
-    max_tokens: int,
-    timeout: int
-) -> BaseLLMAdapter:
+def _backend_label(adapter: BaseLLMAdapter) -> str:
+    return f"{adapter.provider or type(adapter).__name__}/{getattr(adapter, 'model_name', '')}"
+
+class FailoverLLMAdapter(BaseLLMAdapter):
     """
-    工厂函数：根据 interface_format 返回不同的适配器实例。
+    按顺序组合多个后端：
+    - 对冲：当前后端在 hedge_after 秒内（"p95" 等表示按该后端观测到的延迟分位数）仍未返回时，
+      同时向下一个后端发出请求，先返回有效内容的一方胜出。invoke_stream 以首个文本块为准；
+      invoke / ainvoke 没有首 token 可观测，以完整响应为准，分位数也取自完整响应的耗时；
+    - 落选的请求：invoke / ainvoke 直接取消对应的异步请求（关闭连接；没有原生异步客户端、
+      在线程中执行的后端无法中断，只丢弃结果）；invoke_stream 的落选流在收到下一块时关闭，
+      同步流在等待数据时无法从其它线程中断；
+    - 故障转移：后端报错或返回空内容时立即改用下一个后端，
+      连续失败 failure_threshold 次的后端在 cooldown 秒内被跳过。
+    限流由各后端适配器自行处理。
     """
-    fmt = interface_format.strip().lower()
+    def __init__(self, adapters: list, hedge_after="p95", min_samples: int = 5, cooldown: float = 60, failure_threshold: int = 2):
+        if not adapters:
+            raise ValueError("FailoverLLMAdapter requires at least one backend.")
+        self.adapters = list(adapters)
+        self.hedge_after = hedge_after
+        self.min_samples = min_samples
+        self.cooldown = cooldown
+        self.failure_threshold = failure_threshold
+
+        primary = self.adapters[0]
+        self.provider = primary.provider
+        self.model_name = getattr(primary, "model_name", "")
+        self.base_url = getattr(primary, "base_url", "")
+        self.temperature = getattr(primary, "temperature", None)
+        self.max_tokens = getattr(primary, "max_tokens", None)
+        self.timeout = getattr(primary, "timeout", None)
+
+    def _candidates(self) -> list:
+        """处于冷却中的后端排到最后，全部冷却时仍按原顺序尝试"""
+        healthy = [a for a in self.adapters if _get_backend_health(a).available()]
+        return healthy + [a for a in self.adapters if a not in healthy]
+
+    def _hedge_delay(self, adapter: BaseLLMAdapter, mode: str) -> Optional[float]:
+        if self.hedge_after is None:
+            return None
+        if isinstance(self.hedge_after, str):
+            text = self.hedge_after.strip().lower()
+            if not text.startswith("p"):
+                return None
+            return _get_backend_health(adapter).percentile(mode, float(text[1:]) / 100.0, self.min_samples)
+        return float(self.hedge_after)
+
+    def _record_failure(self, adapter: BaseLLMAdapter, error: Exception):
+        logging.warning(f"[Failover] {_backend_label(adapter)} failed: {error}")
+        if _get_backend_health(adapter).record_failure(self.failure_threshold, self.cooldown):
+            logging.warning(f"[Failover] {_backend_label(adapter)} cooling down for {self.cooldown}s.")
+
+    def _race(self, mode: str, call) -> Iterator[str]:
+        """
+        依次/对冲地在线程中执行 call(adapter)（返回文本块迭代器），输出第一个产出有效内容的后端的全部文本块。
+        胜出后其余后端被通知停止：其流在收到下一块时关闭，已收到的内容被丢弃。
+        """
+        candidates = self._candidates()
+        events = queue.Queue()
+        running = {}  # index -> (adapter, started, stop_event)
+        next_index = 0
+        winner = None
+        last_error = None
+
+        def launch():
+            nonlocal next_index
+            index = next_index
+            next_index += 1
+            stop = threading.Event()
+            running[index] = (candidates[index], time.monotonic(), stop)
+            # 复制上下文，使后台线程中的调用仍归入当前阶段的统计
+            context = contextvars.copy_context()
+            _get_hedge_executor().submit(context.run, _pump_backend, call, candidates[index], index, events, stop)
+
+        launch()
+        try:
+            while running:
+                timeout = None
+                if winner is None and next_index < len(candidates) and (next_index - 1) in running:
+                    adapter, started, _ = running[next_index - 1]
+                    delay = self._hedge_delay(adapter, mode)
+                    if delay is not None:
+                        timeout = max(started + delay - time.monotonic(), 0.0)
+                try:
+                    index, kind, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    logging.info(
+                        f"[Failover] {_backend_label(candidates[next_index - 1])} has no first token yet, "
+                        f"hedging to {_backend_label(candidates[next_index])}."
+                    )
+                    launch()
+                    continue
+                if index not in running:
+                    continue
+                adapter, started, _ = running[index]
+                if kind == "chunk":
+                    if not payload:
+                        continue
+                    if winner is None:
+                        winner = index
+                        _get_backend_health(adapter).record_success(mode, time.monotonic() - started)
+                        for other, (_, _, stop) in running.items():
+                            if other != index:
+                                stop.set()
+                        running = {index: running[index]}
+                    yield payload
+                    continue
+                running.pop(index)
+                if winner == index:
+                    if kind == "error":
+                        raise payload
+                    return
+                if kind == "error":
+                    last_error = payload
+                    self._record_failure(adapter, payload)
+                else:
+                    self._record_failure(adapter, "empty response")
+                if not running and next_index < len(candidates):
+                    launch()
+        finally:
+            for _, _, stop in running.values():
+                stop.set()
+        if last_error is not None:
+            raise last_error
+
+    def invoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
+        # 调用方的 contextvars（阶段等）随 run_coroutine_threadsafe 复制到后台事件循环中的任务
+        future = asyncio.run_coroutine_threadsafe(self.ainvoke(prompt, temperature, max_tokens), _get_hedge_loop())
+        return future.result()
+
+    def invoke_stream(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> Iterator[str]:
+        yield from self._race("stream", lambda adapter: adapter.invoke_stream(prompt, temperature, max_tokens))
+
+    async def ainvoke(self, prompt: str, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
+        candidates = self._candidates()
+        pending = {}  # task -> (adapter, started)
+        next_index = 0
+        last_error = None
+        last_started = 0.0
+
+        def launch():
+            nonlocal next_index, last_started
+            adapter = candidates[next_index]
+            next_index += 1
+            last_started = time.monotonic()
+            task = asyncio.ensure_future(adapter.ainvoke(prompt, temperature, max_tokens))
+            pending[task] = (adapter, last_started)
+
+        launch()
+        try:
+            while pending:
+                timeout = None
+                if next_index < len(candidates):
+                    delay = self._hedge_delay(candidates[next_index - 1], "invoke")
+                    if delay is not None:
+                        timeout = max(last_started + delay - time.monotonic(), 0.0)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logging.info(
+                        f"[Failover] {_backend_label(candidates[next_index - 1])} has not answered yet, "
+                        f"hedging to {_backend_label(candidates[next_index])}."
+                    )
+                    launch()
+                    continue
+                for task in done:
+                    adapter, started = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        last_error = e
+                        self._record_failure(adapter, e)
+                        continue
+                    if result:
+                        _get_backend_health(adapter).record_success("invoke", time.monotonic() - started)
+                        return result
+                    self._record_failure(adapter, "empty response")
+                if not pending and next_index < len(candidates):
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+        if last_error is not None:
+            raise last_error
+        return ""
+
+# 进程级适配器池：相同配置的调用共用同一个适配器（及其底层客户端）
+_adapter_pool = {}
+_adapter_pool_lock = threading.Lock()
+
+# config.json 中 "llm_failover" 的配置；backends 为按顺序排列的备用后端参数
+_failover_settings = {
+    "backends": [],
+    "hedge_after": "p95",
+    "min_samples": 5,
+    "cooldown": 60,
+    "failure_threshold": 2
+}
+
+def _new_llm_adapter(fmt: str, interface_format: str, base_url: str, model_name: str, api_key: str, temperature: float, max_tokens: int, timeout: int) -> BaseLLMAdapter:
     if fmt == "deepseek":
         return DeepSeekAdapter(api_key, base_url, model_name, max_tokens, temperature, timeout)
     elif fmt == "openai":
@@ -372,5 +946,97 @@ def create_llm_adapter(
         return VolcanoEngineAIAdapter(api_key, base_url, model_name, max_tokens, temperature, timeout)
     elif fmt == "硅基流动":
         return SiliconFlowAdapter(api_key, base_url, model_name, max_tokens, temperature, timeout)
+    elif fmt == "mock":
+        return MockLLMAdapter(api_key, base_url, model_name, max_tokens, temperature, timeout)
     else:
         raise ValueError(f"Unknown interface_format: {interface_format}")
+
+def _pooled_llm_adapter(interface_format: str, base_url: str, model_name: str, api_key: str, temperature: float, max_tokens: int, timeout: int) -> BaseLLMAdapter:
+    fmt = interface_format.strip().lower()
+    # api_key 也参与区分，避免不同密钥共用同一个客户端
+    key = (fmt, base_url, model_name, temperature, max_tokens, timeout, api_key)
+    with _adapter_pool_lock:
+        adapter = _adapter_pool.get(key)
+        if adapter is None:
+            adapter = _new_llm_adapter(fmt, interface_format, base_url, model_name, api_key, temperature, max_tokens, timeout)
+            adapter.provider = interface_format.strip()
+            _adapter_pool[key] = adapter
+        return adapter
+
+def create_llm_adapter(
+    interface_format: str,
+    base_url: str,
+    model_name: str,
+    api_key: str,
+    temperature: float,
+    max_tokens: int,
+    timeout: int,
+    backends: Optional[list] = None
+) -> BaseLLMAdapter:
+    """
+    工厂函数：根据 interface_format 返回不同的适配器实例。
+    相同 (interface_format, base_url, model_name, temperature, max_tokens, timeout, api_key) 的调用
+    会复用池中已创建的适配器，线程安全。
+    backends 为按顺序排列的备用后端（每项含 interface_format / base_url / model_name / api_key，
+    可选 max_tokens / timeout），非空时返回带对冲与故障转移的 FailoverLLMAdapter；
+    未传入时使用 config.json 中 "llm_failover" 配置的备用后端；传入 [] 时只使用该后端（如测试某一配置是否可用）。
+    """
+    primary = _pooled_llm_adapter(interface_format, base_url, model_name, api_key, temperature, max_tokens, timeout)
+    if backends is None:
+        backends = [
+            b for b in _failover_settings["backends"]
+            if (b["interface_format"].strip().lower(), b.get("base_url", ""), b.get("model_name", ""))
+            != (interface_format.strip().lower(), base_url, model_name)
+        ]
+    if not backends:
+        return primary
+    adapters = [primary] + [
+        _pooled_llm_adapter(
+            b["interface_format"],
+            b.get("base_url", ""),
+            b.get("model_name", ""),
+            b.get("api_key", ""),
+            temperature,
+            b.get("max_tokens", max_tokens),
+            b.get("timeout", timeout)
+        )
+        for b in backends
+    ]
+    return FailoverLLMAdapter(
+        adapters,
+        hedge_after=_failover_settings["hedge_after"],
+        min_samples=_failover_settings["min_samples"],
+        cooldown=_failover_settings["cooldown"],
+        failure_threshold=_failover_settings["failure_threshold"]
+    )
+
+def configure_llm_failover(settings: dict, llm_configs: Optional[dict] = None):
+    """
+    根据 config.json 中的 "llm_failover" 配置备用后端与对冲策略，例如：
+    {"backends": ["硅基流动", "OpenAI"], "hedge_after": "p95", "cooldown": 60, "failure_threshold": 2}
+    backends 中的字符串引用 llm_configs 中同名的接口配置，也可直接写完整的后端参数字典。
+    hedge_after 可为秒数、"p95" 之类的分位数或 null（不对冲，仅故障转移）。
+    """
+    settings = settings or {}
+    llm_configs = llm_configs or {}
+    backends = []
+    for entry in settings.get("backends", []):
+        if isinstance(entry, str):
+            conf = llm_configs.get(entry)
+            if conf is None:
+                logging.warning(f"[Failover] Backend '{entry}' not found in llm_configs, skipped.")
+                continue
+            entry = dict(conf, interface_format=conf.get("interface_format", entry))
+        if isinstance(entry, dict) and entry.get("interface_format"):
+            if entry.get("max_tokens") is not None:
+                entry["max_tokens"] = int(entry["max_tokens"])
+            backends.append(entry)
+    _failover_settings["backends"] = backends
+    for key in ("hedge_after", "min_samples", "cooldown", "failure_threshold"):
+        if key in settings:
+            _failover_settings[key] = settings[key]
+
+def clear_llm_adapter_pool():
+    """清空适配器池（例如切换配置后希望重新建立客户端时）"""
+    with _adapter_pool_lock:
+        _adapter_pool.clear()
@@ -0,0 +1,246 @@
+# llm_metrics.py
+# -*- coding: utf-8 -*-
+"""
+逐次 LLM 调用的耗时与 token 指标：
+每次适配器调用（invoke / invoke_stream / ainvoke）生成一条记录，包含阶段、服务商、模型、限流排队时间、
+首 token 延迟、总耗时、提示词/缓存命中/输出 token 数、结束原因（finish_reason）以及第几次重试；
+合并到在途相同请求而未实际发出的调用以 outcome="coalesced" 单独记录。
+记录保存在内存中供界面汇总，并在项目目录下写入滚动的 llm_metrics.jsonl。
+可通过 config.json 的 "metrics" 配置，例如：
+{"metrics": {"enabled": true, "max_bytes": 5242880, "backup_count": 3}}
+"""
+import asyncio
+import contextvars
+import hashlib
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from llm_usage import current_stage, stage_context
+
+METRICS_FILENAME = "llm_metrics.jsonl"
+
+_metrics_settings = {
+    "enabled": True,
+    "max_bytes": 5 * 1024 * 1024,
+    "backup_count": 3
+}
+
+_project_dir = contextvars.ContextVar("llm_project_dir", default="")
+_attempt = contextvars.ContextVar("llm_attempt", default=1)
+_active_call = contextvars.ContextVar("llm_active_call", default=None)
+_call_observer = contextvars.ContextVar("llm_call_observer", default=None)
+
+_records = deque(maxlen=5000)
+_records_lock = threading.Lock()
+_sequence = itertools.count(1)
+
+_sink_loggers = {}
+_sink_lock = threading.Lock()
+
+def configure_metrics(settings: dict):
+    """应用 config.json 中的 "metrics" 配置；已打开的 jsonl 文件按新参数重新打开"""
+    for key, value in (settings or {}).items():
+        if key in _metrics_settings:
+            _metrics_settings[key] = value
+    with _sink_lock:
+        for logger in _sink_loggers.values():
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+                handler.close()
+        _sink_loggers.clear()
+
+@contextmanager
+def call_scope(stage: str, project_dir: str = "", attempt: int = 1, observer: list = None):
+    """
+    在该上下文内发起的 LLM 调用归入 stage，记录写入 project_dir 下的 jsonl，
+    attempt 为同一请求的第几次尝试（1 表示首次）。
+    observer 为列表时，调用结束后把记录追加到其中，供调用方读取 finish_reason 等。
+    """
+    dir_token = _project_dir.set(project_dir or "")
+    attempt_token = _attempt.set(attempt)
+    observer_token = _call_observer.set(observer)
+    try:
+        with stage_context(stage):
+            yield
+    finally:
+        _call_observer.reset(observer_token)
+        _attempt.reset(attempt_token)
+        _project_dir.reset(dir_token)
+
+def last_finish_reason(records: list):
+    """observer 收集到的记录中，最后一次成功调用的结束原因；无法得知时返回 None"""
+    for record in reversed(records or []):
+        if record["outcome"] == "ok" and record.get("finish_reason"):
+            return record["finish_reason"]
+    return None
+
+def current_call():
+    """当前正在进行的调用记录；不在适配器调用内时返回 None"""
+    return _active_call.get()
+
+def _sink_logger(project_dir: str):
+    path = os.path.abspath(os.path.join(project_dir, METRICS_FILENAME))
+    with _sink_lock:
+        logger = _sink_loggers.get(path)
+        if logger is None:
+            os.makedirs(project_dir, exist_ok=True)
+            name = "llm_metrics." + hashlib.sha256(path.encode("utf-8")).hexdigest()[:12]
+            logger = logging.getLogger(name)
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            handler = logging.handlers.RotatingFileHandler(
+                path,
+                maxBytes=int(_metrics_settings["max_bytes"]),
+                backupCount=int(_metrics_settings["backup_count"]),
+                encoding="utf-8"
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            _sink_loggers[path] = logger
+        return logger
+
+class LLMCall:
+    """一次适配器调用的计时与 token 统计，结束时由 finish 写出记录"""
+    def __init__(self, provider: str, model_name: str, mode: str):
+        self.provider = provider or ""
+        self.model_name = model_name or ""
+        self.mode = mode
+        self.stage = current_stage() or "default"
+        self.project_dir = _project_dir.get()
+        self.attempt = _attempt.get()
+        self.observer = _call_observer.get()
+        self.started = time.monotonic()
+        self.queue_wait = None
+        self.ttft = None
+        self.finish_reason = None
+        self.usage = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+    @contextmanager
+    def active(self):
+        """使该上下文内的 current_call() 返回本次调用，供适配器登记 usage"""
+        token = _active_call.set(self)
+        try:
+            yield self
+        finally:
+            _active_call.reset(token)
+
+    def queued(self):
+        """限流排队结束、即将发出请求时调用"""
+        if self.queue_wait is None:
+            self.queue_wait = time.monotonic() - self.started
+
+    def first_token(self):
+        if self.ttft is None:
+            self.ttft = time.monotonic() - self.started
+
+    def add_usage(self, parsed: dict):
+        for key in self.usage:
+            self.usage[key] += parsed.get(key, 0)
+
+    def finish(self, error: BaseException = None, outcome: str = None) -> dict:
+        if outcome is None:
+            if isinstance(error, (GeneratorExit, asyncio.CancelledError)):
+                outcome = "cancelled"
+            elif error is not None:
+                outcome = "error"
+            else:
+                outcome = "ok"
+        record = {
+            "ts": round(time.time(), 3),
+            "stage": self.stage,
+            "provider": self.provider,
+            "model": self.model_name,
+            "mode": self.mode,
+            "attempt": self.attempt,
+            "retries": max(self.attempt - 1, 0),
+            "queue_wait": round(self.queue_wait or 0.0, 3),
+            "ttft": round(self.ttft, 3) if self.ttft is not None else None,
+            "latency": round(time.monotonic() - self.started, 3),
+            **self.usage,
+            "finish_reason": self.finish_reason,
+            "outcome": outcome,
+            "error": f"{type(error).__name__}: {error}" if outcome == "error" else None
+        }
+        with _records_lock:
+            _records.append((next(_sequence), record))
+        if self.observer is not None:
+            self.observer.append(record)
+        if self.project_dir and _metrics_settings["enabled"]:
+            try:
+                _sink_logger(self.project_dir).info(json.dumps(record, ensure_ascii=False))
+            except Exception as e:
+                logging.warning(f"[LLMMetrics] Failed to write metrics: {e}")
+        return record
+
+@contextmanager
+def track_call(provider: str, model_name: str, mode: str):
+    """包住一次适配器调用：正常结束或抛出异常时都会写出记录"""
+    call = LLMCall(provider, model_name, mode)
+    try:
+        yield call
+    except BaseException as e:
+        call.finish(e)
+        raise
+    call.finish()
+
+def record_coalesced(provider: str, model_name: str, waited: float, stage: str = "") -> dict:
+    """登记一次合并到在途相同请求的调用（未向服务商发出请求），latency 为等待时间"""
+    call = LLMCall(provider, model_name, "coalesced")
+    if stage:
+        call.stage = stage
+    call.started = time.monotonic() - waited
+    return call.finish(outcome="coalesced")
+
+def metrics_mark() -> int:
+    """当前记录序号，配合 get_metrics / format_metrics_summary 的 since 只看之后的调用"""
+    with _records_lock:
+        return _records[-1][0] if _records else 0
+
+def get_metrics(since: int = 0) -> list:
+    with _records_lock:
+        return [dict(record) for seq, record in _records if seq > since]
+
+def summarize_metrics(records: list) -> dict:
+    """按阶段汇总：调用数、失败数、重试数、合并数、总耗时、排队、首 token 均值与 token 数"""
+    summary = {}
+    for record in records:
+        stats = summary.setdefault(record["stage"], {
+            "calls": 0, "errors": 0, "retries": 0, "coalesced": 0, "latency": 0.0, "queue_wait": 0.0,
+            "ttft_total": 0.0, "ttft_count": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0
+        })
+        if record["outcome"] == "coalesced":
+            stats["coalesced"] += 1
+            continue
+        stats["calls"] += 1
+        stats["errors"] += record["outcome"] == "error"
+        stats["retries"] += record["attempt"] > 1
+        stats["latency"] += record["latency"]
+        stats["queue_wait"] += record["queue_wait"]
+        if record["ttft"] is not None:
+            stats["ttft_total"] += record["ttft"]
+            stats["ttft_count"] += 1
+        for key in ("prompt_tokens", "cached_tokens", "completion_tokens"):
+            stats[key] += record[key]
+    return summary
+
+def format_metrics_summary(since: int = 0) -> str:
+    """生成给界面日志看的按阶段汇总文本；没有调用记录时返回空字符串"""
+    summary = summarize_metrics(get_metrics(since))
+    if not summary:
+        return ""
+    lines = ["LLM 调用耗时统计："]
+    for stage, stats in sorted(summary.items(), key=lambda item: -item[1]["latency"]):
+        ttft = f"{stats['ttft_total'] / stats['ttft_count']:.1f}s" if stats["ttft_count"] else "-"
+        lines.append(
+            f"  {stage}: {stats['calls']}次 共{stats['latency']:.1f}s 排队{stats['queue_wait']:.1f}s "
+            f"首token{ttft} 提示词{stats['prompt_tokens']}(缓存{stats['cached_tokens']}) "
+            f"输出{stats['completion_tokens']} 重试{stats['retries']} 失败{stats['errors']} 合并{stats['coalesced']}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,106 @@
+# llm_usage.py
+# -*- coding: utf-8 -*-
+"""
+LLM token 用量统计：
+各适配器把服务商返回的 usage 交给 record_usage，这里统一解析出提示词 / 缓存命中 / 输出 token 数，
+并按当前调用阶段（stage，由 stage_context 设置）汇总，用于衡量服务商提示词缓存的命中率。
+"""
+import contextvars
+import logging
+import threading
+from contextlib import contextmanager
+
+_current_stage = contextvars.ContextVar("llm_stage", default="")
+
+_usage_stats = {}
+_usage_lock = threading.Lock()
+
+@contextmanager
+def stage_context(stage: str):
+    """在该上下文内发起的 LLM 调用归入 stage 统计"""
+    token = _current_stage.set(stage or "")
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+
+def current_stage() -> str:
+    return _current_stage.get()
+
+def _to_dict(obj) -> dict:
+    if obj is None:
+        return {}
+    if isinstance(obj, dict):
+        return obj
+    for method in ("model_dump", "as_dict", "to_dict"):
+        func = getattr(obj, method, None)
+        if callable(func):
+            try:
+                return func()
+            except Exception:
+                pass
+    names = (
+        "prompt_tokens", "completion_tokens", "input_tokens", "output_tokens",
+        "prompt_tokens_details", "prompt_cache_hit_tokens", "input_token_details",
+        "prompt_token_count", "candidates_token_count", "cached_content_token_count"
+    )
+    return {name: getattr(obj, name) for name in names if getattr(obj, name, None) is not None}
+
+def _first_int(*values) -> int:
+    for value in values:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return int(value)
+    return 0
+
+def parse_usage(usage) -> dict:
+    """
+    兼容多种 usage 格式，返回 {"prompt_tokens", "cached_tokens", "completion_tokens"}：
+    - OpenAI：prompt_tokens_details.cached_tokens
+    - DeepSeek：prompt_cache_hit_tokens
+    - langchain usage_metadata：input_token_details.cache_read
+    - Gemini：cached_content_token_count
+    """
+    data = _to_dict(usage)
+    prompt_details = _to_dict(data.get("prompt_tokens_details"))
+    input_details = _to_dict(data.get("input_token_details"))
+    return {
+        "prompt_tokens": _first_int(data.get("prompt_tokens"), data.get("input_tokens"), data.get("prompt_token_count")),
+        "cached_tokens": _first_int(
+            prompt_details.get("cached_tokens"),
+            data.get("prompt_cache_hit_tokens"),
+            input_details.get("cache_read"),
+            data.get("cached_content_token_count")
+        ),
+        "completion_tokens": _first_int(
+            data.get("completion_tokens"), data.get("output_tokens"), data.get("candidates_token_count")
+        ),
+    }
+
+def record_usage(usage, provider: str = "", model_name: str = "") -> dict:
+    """解析 usage 并计入当前阶段的统计；返回解析结果"""
+    parsed = parse_usage(usage)
+    if not any(parsed.values()):
+        return parsed
+    stage = current_stage() or "default"
+    with _usage_lock:
+        stats = _usage_stats.setdefault(stage, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0})
+        stats["calls"] += 1
+        for key, value in parsed.items():
+            stats[key] += value
+    logging.info(
+        f"[LLMUsage] stage={stage} {provider}/{model_name} prompt={parsed['prompt_tokens']} "
+        f"cached={parsed['cached_tokens']} completion={parsed['completion_tokens']}"
+    )
+    return parsed
+
+def get_usage_stats() -> dict:
+    """各阶段的累计用量，cache_hit_rate 为缓存命中的提示词 token 占比"""
+    with _usage_lock:
+        result = {stage: dict(stats) for stage, stats in _usage_stats.items()}
+    for stats in result.values():
+        stats["cache_hit_rate"] = round(stats["cached_tokens"] / stats["prompt_tokens"], 4) if stats["prompt_tokens"] else 0.0
+    return result
+
+def reset_usage_stats():
+    with _usage_lock:
+        _usage_stats.clear()
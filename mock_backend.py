@@ -0,0 +1,407 @@
+# mock_backend.py
+# -*- coding: utf-8 -*-
+"""
+离线基准测试用的确定性模拟后端：
+- MockLLM / MockEmbedding：由提示词哈希确定输出文本与向量，可配置首 token 延迟、生成速度、错误率与截断，
+  供 interface_format="Mock" 的 LLM / Embedding 适配器直接使用；
+- 本地 OpenAI 兼容 HTTP 服务（/v1/chat/completions、/v1/embeddings 以及 Ollama 的 /api/embed、/api/embeddings），
+  可作为其它接口格式（OpenAI、DeepSeek、Ollama……）的替身，用于测试连接池、重试、对冲等网络行为。
+
+参数可写在 base_url 的查询串中，例如 mock://local?latency=0.5&tps=40&error_rate=0.05&truncate_rate=0.1，
+或以命令行启动服务：
+    python mock_backend.py --port 8765 --latency 0.5 --tps 40 --error-rate 0.05
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from rate_limiter import estimate_tokens
+
+DEFAULT_OPTIONS = {
+    "latency": 0.3,        # 首 token 延迟（秒）
+    "tps": 60.0,           # 生成速度（token/秒），<=0 表示不限速
+    "error_rate": 0.0,     # 请求失败概率（失败时随机返回 429 或 503）
+    "retry_after": 1.0,    # 429 响应携带的 Retry-After 秒数
+    "truncate_rate": 0.0,  # 输出被截断（finish_reason="length"）的概率
+    "dim": 256,            # 向量维度
+    "embed_latency": 0.02, # 每次 embedding 请求的延迟（秒）
+    "max_embed_batch": 0   # 单次 embedding 请求最多条数，超出返回 413；0 表示不限
+}
+
+# 模拟服务商的提示词前缀缓存：按固定长度的块记录见过的前缀哈希
+_PREFIX_BLOCK_CHARS = 128
+_MAX_SEEN_PREFIXES = 100000
+_seen_prefixes = set()
+_seen_prefixes_lock = threading.Lock()
+
+_WORDS = [
+    "夜色", "城墙", "旧信", "铜铃", "雾气", "码头", "灯火", "脚步", "誓言", "伤痕",
+    "钟声", "密室", "残页", "星图", "风暴", "渡口", "长街", "影子", "回声", "契约"
+]
+_VERBS = ["凝视着", "追寻着", "隐藏了", "唤醒了", "穿过了", "守护着", "揭开了", "回忆起", "背叛了", "等待着"]
+_NAMES = ["林远", "苏晚", "陆沉", "顾言", "沈青", "白鹭"]
+_ROLES = ["角色", "事件", "主题", "伏笔"]
+_PURPOSES = ["推进", "转折", "揭示", "铺垫"]
+_SUSPENSE = ["紧凑", "渐进", "爆发", "舒缓"]
+
+def parse_options(base_url: str = "", **overrides) -> dict:
+    """合并默认参数、base_url 查询串与显式传入的参数"""
+    options = dict(DEFAULT_OPTIONS)
+    for key, value in parse_qsl(urlsplit(base_url or "").query):
+        if key in options:
+            options[key] = float(value)
+    for key, value in overrides.items():
+        if key in options and value is not None:
+            options[key] = float(value)
+    options["dim"] = int(options["dim"])
+    options["max_embed_batch"] = int(options["max_embed_batch"])
+    return options
+
+def _rng(*parts) -> random.Random:
+    seed = hashlib.sha256("\x00".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+    return random.Random(int(seed[:16], 16))
+
+def _sentence(rng: random.Random) -> str:
+    return f"{rng.choice(_NAMES)}在{rng.choice(_WORDS)}旁{rng.choice(_VERBS)}{rng.choice(_WORDS)}，{rng.choice(_WORDS)}与{rng.choice(_WORDS)}交织成新的谜团。"
+
+def _prose(rng: random.Random, length: int) -> str:
+    parts = []
+    size = 0
+    while size < length:
+        paragraph = "".join(_sentence(rng) for _ in range(rng.randint(2, 4)))
+        parts.append(paragraph)
+        size += len(paragraph)
+    return "\n\n".join(parts)
+
+def _blueprint(rng: random.Random, start: int, end: int) -> str:
+    chapters = []
+    for n in range(start, end + 1):
+        chapters.append(
+            f"第{n}章 - {rng.choice(_WORDS)}{rng.choice(_WORDS)}\n"
+            f"本章定位：{rng.choice(_ROLES)}\n"
+            f"核心作用：{rng.choice(_PURPOSES)}\n"
+            f"悬念密度：{rng.choice(_SUSPENSE)}\n"
+            f"伏笔操作：埋设({rng.choice(_WORDS)})→强化({rng.choice(_WORDS)})\n"
+            f"认知颠覆：{'★' * (n % 5 + 1)}{'☆' * (4 - n % 5)}\n"
+            f"本章简述：{_sentence(rng)}"
+        )
+    return "\n\n".join(chapters)
+
+def generate_text(prompt: str, model_name: str = "", max_tokens: int = 0) -> str:
+    """
+    按提示词确定性地生成文本。能识别章节目录、检索关键词等需要固定格式的提示词，
+    其余按提示词中的“字数要求”（默认约 300 字）生成段落；不超过 max_tokens。
+    """
+    rng = _rng(model_name, prompt)
+    chunk = re.search(r"第(\d+)章到第(\d+)", prompt)
+    whole = re.search(r"设计(\d+)章的节奏分布", prompt)
+    if chunk:
+        text = _blueprint(rng, int(chunk.group(1)), int(chunk.group(2)))
+    elif whole:
+        text = _blueprint(rng, 1, int(whole.group(1)))
+    elif "检索关键词" in prompt:
+        text = "\n".join(f"{rng.choice(_WORDS)}·{rng.choice(_WORDS)}" for _ in range(rng.randint(2, 5)))
+    else:
+        words = re.search(r"字数要求[：:]?\s*(\d+)", prompt)
+        text = _prose(rng, int(words.group(1)) if words else 300)
+    if max_tokens:
+        text = _truncate_tokens(text, int(max_tokens))
+    return text
+
+def _truncate_tokens(text: str, max_tokens: int) -> str:
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
+
+def embed_text(text: str, dim: int = 256) -> list:
+    """
+    确定性向量：字符二元组的哈希特征（signed hashing trick）后做 L2 归一化，
+    文本越相似向量越接近，可用于检索流程的测试。
+    """
+    vector = [0.0] * dim
+    text = text or ""
+    grams = [text[i:i + 2] for i in range(max(len(text) - 1, 1))]
+    for gram in grams:
+        digest = hashlib.md5(gram.encode("utf-8")).digest()
+        index = int.from_bytes(digest[:4], "little") % dim
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+def _cached_prefix_tokens(prompt: str) -> int:
+    """返回提示词开头与此前请求相同的完整块所对应的 token 数"""
+    hasher = hashlib.sha256()
+    cached_chars = 0
+    matching = True
+    new_digests = []
+    with _seen_prefixes_lock:
+        for start in range(0, len(prompt) - _PREFIX_BLOCK_CHARS + 1, _PREFIX_BLOCK_CHARS):
+            hasher.update(prompt[start:start + _PREFIX_BLOCK_CHARS].encode("utf-8"))
+            digest = hasher.hexdigest()
+            if matching and digest in _seen_prefixes:
+                cached_chars = start + _PREFIX_BLOCK_CHARS
+            else:
+                matching = False
+                new_digests.append(digest)
+        if len(_seen_prefixes) > _MAX_SEEN_PREFIXES:
+            _seen_prefixes.clear()
+        _seen_prefixes.update(new_digests)
+    return estimate_tokens(prompt[:cached_chars])
+
+def make_usage(prompt: str, completion: str, cached_tokens: int = 0) -> dict:
+    """OpenAI 格式的 usage，缓存命中数写在 prompt_tokens_details.cached_tokens"""
+    prompt_tokens = estimate_tokens(prompt)
+    completion_tokens = estimate_tokens(completion)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": min(cached_tokens, prompt_tokens)}
+    }
+
+class MockBackendError(Exception):
+    """模拟的上游错误，带 status_code 与响应头，便于重试策略按真实错误处理"""
+    class _Response:
+        def __init__(self, status_code: int, headers: dict):
+            self.status_code = status_code
+            self.headers = headers
+
+    def __init__(self, status_code: int, retry_after: float = None):
+        super().__init__(f"Mock backend returned HTTP {status_code}")
+        self.status_code = status_code
+        headers = {"retry-after": f"{retry_after:g}"} if retry_after is not None else {}
+        self.response = self._Response(status_code, headers)
+
+class MockLLM:
+    """确定性的模拟 LLM：先等待 latency 秒，再按 tps 的速度逐块产出文本"""
+    def __init__(self, model_name: str = "mock", options: dict = None):
+        self.model_name = model_name
+        self.options = options or parse_options()
+
+    def _plan(self, prompt: str, max_tokens: int = 0):
+        """返回 (文本块列表, finish_reason, usage)；按错误率抛出 MockBackendError"""
+        if random.random() < self.options["error_rate"]:
+            if random.random() < 0.5:
+                raise MockBackendError(429, self.options["retry_after"])
+            raise MockBackendError(503)
+        text = generate_text(prompt, self.model_name, max_tokens)
+        finish_reason = "length" if max_tokens and estimate_tokens(text) >= int(max_tokens) else "stop"
+        if random.random() < self.options["truncate_rate"]:
+            text = text[:max(len(text) // 2, 1)]
+            finish_reason = "length"
+        chunks = [text[i:i + 8] for i in range(0, len(text), 8)]
+        return chunks, finish_reason, make_usage(prompt, text, _cached_prefix_tokens(prompt))
+
+    def _chunk_delay(self, chunk: str) -> float:
+        tps = self.options["tps"]
+        return estimate_tokens(chunk) / tps if tps > 0 else 0.0
+
+    def stream(self, prompt: str, max_tokens: int = 0):
+        """逐块产出 (文本, finish_reason, usage)，只有最后一块的 finish_reason 与 usage 非空"""
+        chunks, finish_reason, usage = self._plan(prompt, max_tokens)
+        time.sleep(self.options["latency"])
+        for i, chunk in enumerate(chunks):
+            time.sleep(self._chunk_delay(chunk))
+            last = i == len(chunks) - 1
+            yield chunk, (finish_reason if last else None), (usage if last else None)
+
+    def complete(self, prompt: str, max_tokens: int = 0):
+        """返回 (完整文本, finish_reason, usage)"""
+        chunks, finish_reason, usage = self._plan(prompt, max_tokens)
+        time.sleep(self.options["latency"] + sum(self._chunk_delay(c) for c in chunks))
+        return "".join(chunks), finish_reason, usage
+
+    async def acomplete(self, prompt: str, max_tokens: int = 0):
+        chunks, finish_reason, usage = self._plan(prompt, max_tokens)
+        await asyncio.sleep(self.options["latency"] + sum(self._chunk_delay(c) for c in chunks))
+        return "".join(chunks), finish_reason, usage
+
+class MockEmbedding:
+    def __init__(self, options: dict = None):
+        self.options = options or parse_options()
+
+    def _check(self, texts: list):
+        if self.options["max_embed_batch"] and len(texts) > self.options["max_embed_batch"]:
+            raise MockBackendError(413)
+        if random.random() < self.options["error_rate"]:
+            raise MockBackendError(429, self.options["retry_after"])
+
+    def embed(self, texts: list) -> list:
+        self._check(texts)
+        time.sleep(self.options["embed_latency"])
+        return [embed_text(t, self.options["dim"]) for t in texts]
+
+    async def aembed(self, texts: list) -> list:
+        self._check(texts)
+        await asyncio.sleep(self.options["embed_latency"])
+        return [embed_text(t, self.options["dim"]) for t in texts]
+
+class _MockRequestHandler(BaseHTTPRequestHandler):
+    """OpenAI 兼容接口的最小实现；server.options 为模拟参数"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug(f"[MockServer] {self.address_string()} {format % args}")
+
+    def _send_json(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, error: MockBackendError):
+        self._send_json(
+            error.status_code,
+            {"error": {"message": str(error), "type": "mock_error", "code": error.status_code}},
+            error.response.headers
+        )
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "invalid json"}})
+            return
+        path = urlsplit(self.path).path.rstrip("/")
+        try:
+            if path.endswith("/chat/completions"):
+                self._chat(payload)
+            elif path.endswith("/api/embed"):
+                inputs = payload.get("input", "")
+                inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+                vectors = MockEmbedding(self.server.options).embed(inputs)
+                self._send_json(200, {"model": payload.get("model", "mock"), "embeddings": vectors})
+            elif path.endswith("/api/embeddings"):
+                vectors = MockEmbedding(self.server.options).embed([payload.get("prompt", "")])
+                self._send_json(200, {"embedding": vectors[0]})
+            elif path.endswith("/embeddings"):
+                inputs = payload.get("input", "")
+                inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+                vectors = MockEmbedding(self.server.options).embed(inputs)
+                self._send_json(200, {
+                    "object": "list",
+                    "model": payload.get("model", "mock"),
+                    "data": [{"object": "embedding", "index": i, "embedding": v} for i, v in enumerate(vectors)],
+                    "usage": {"prompt_tokens": sum(estimate_tokens(t) for t in inputs), "total_tokens": sum(estimate_tokens(t) for t in inputs)}
+                })
+            else:
+                self._send_json(404, {"error": {"message": f"unknown endpoint {path}"}})
+        except MockBackendError as e:
+            self._send_error(e)
+
+    def _send_chunk(self, completion_id: str, created: int, model: str, choices: list, usage: dict = None):
+        event = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": choices
+        }
+        if usage is not None:
+            event["usage"] = usage
+        self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def _chat(self, payload: dict):
+        messages = payload.get("messages") or []
+        prompt = "\n".join(str(m.get("content", "")) for m in messages if m.get("role") != "system")
+        model = payload.get("model", "mock")
+        max_tokens = int(payload.get("max_tokens") or payload.get("max_completion_tokens") or 0)
+        llm = MockLLM(model, self.server.options)
+        created = int(time.time())
+        completion_id = "chatcmpl-mock-" + hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+        if not payload.get("stream"):
+            text, finish_reason, usage = llm.complete(prompt, max_tokens)
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}],
+                "usage": usage
+            })
+            return
+
+        stream = llm.stream(prompt, max_tokens)
+        first = next(stream, None)  # 错误需在发送响应头之前抛出
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        head = [first] if first is not None else []
+        include_usage = bool((payload.get("stream_options") or {}).get("include_usage"))
+        for chunk, finish_reason, usage in itertools.chain(head, stream):
+            events = [{"index": 0, "delta": {"content": chunk}, "finish_reason": finish_reason}]
+            self._send_chunk(completion_id, created, model, events)
+            if usage and include_usage:
+                # 与 OpenAI 一致：用量在最后一个 choices 为空的块中返回
+                self._send_chunk(completion_id, created, model, [], usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+def create_mock_server(host: str = "127.0.0.1", port: int = 8765, **options) -> ThreadingHTTPServer:
+    """创建（不启动）模拟服务；port=0 时自动分配端口，可从 server.server_address 读取"""
+    server = ThreadingHTTPServer((host, port), _MockRequestHandler)
+    server.daemon_threads = True
+    server.options = parse_options(**options)
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容模拟服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=DEFAULT_OPTIONS["latency"])
+    parser.add_argument("--tps", type=float, default=DEFAULT_OPTIONS["tps"])
+    parser.add_argument("--error-rate", type=float, default=DEFAULT_OPTIONS["error_rate"])
+    parser.add_argument("--retry-after", type=float, default=DEFAULT_OPTIONS["retry_after"])
+    parser.add_argument("--truncate-rate", type=float, default=DEFAULT_OPTIONS["truncate_rate"])
+    parser.add_argument("--dim", type=int, default=DEFAULT_OPTIONS["dim"])
+    parser.add_argument("--max-embed-batch", type=int, default=DEFAULT_OPTIONS["max_embed_batch"])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = create_mock_server(
+        args.host, args.port,
+        latency=args.latency, tps=args.tps, error_rate=args.error_rate,
+        retry_after=args.retry_after, truncate_rate=args.truncate_rate, dim=args.dim,
+        max_embed_batch=args.max_embed_batch
+    )
+    logging.info(f"Mock server listening on http://{args.host}:{server.server_address[1]}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -11,4 +11,18 @@ from .chapter import (
 )
 from .finalization import finalize_chapter, enrich_chapter_text
 from .knowledge import import_knowledge_file
-from .vectorstore_utils import clear_vector_store
\ No newline at end of file
+from .vectorstore_utils import clear_vector_store, compact_vector_store, migrate_chroma_to_flat
+from .batch import (
+    run_batch,
+    consistency_audit_tasks,
+    LocalBatchBackend,
+    OpenAIBatchBackend
+)
+from .async_pipeline import (
+    asummarize_recent_chapters,
+    aget_filtered_knowledge_context,
+    agenerate_chapter_draft,
+    afinalize_chapter,
+    aenrich_chapter_text,
+    gather_with_concurrency
+)
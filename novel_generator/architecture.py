@@ -84,7 +84,7 @@ def Novel_architecture_generate(
             user_guidance=user_guidance,  # 修复：添加内容指导
             story_index=story_index
         )
-        core_seed_result = invoke_with_cleaning(llm_adapter, prompt_core)
+        core_seed_result = invoke_with_cleaning(llm_adapter, prompt_core, stage="core_seed", cache_dir=filepath)
         if not core_seed_result.strip():
             logging.warning("core_seed_prompt generation failed and returned empty.")
             save_data_to_json(partial_data, partial_data_path)
@@ -100,7 +100,7 @@ def Novel_architecture_generate(
             core_seed=partial_data["core_seed_result"].strip(),
             user_guidance=user_guidance,
             series_character_arc=series_character_arc_text)
-        character_dynamics_result = invoke_with_cleaning(llm_adapter, prompt_character)
+        character_dynamics_result = invoke_with_cleaning(llm_adapter, prompt_character, stage="character_dynamics", cache_dir=filepath)
         if not character_dynamics_result.strip():
             logging.warning("character_dynamics_prompt generation failed.")
             save_data_to_json(partial_data, partial_data_path)
@@ -115,7 +115,7 @@ def Novel_architecture_generate(
         prompt_char_state_init = create_character_state_prompt.format(
             character_dynamics=partial_data["character_dynamics_result"].strip()
         )
-        character_state_init = invoke_with_cleaning(llm_adapter, prompt_char_state_init)
+        character_state_init = invoke_with_cleaning(llm_adapter, prompt_char_state_init, stage="char_state_init", cache_dir=filepath)
         if not character_state_init.strip():
             logging.warning("create_character_state_prompt generation failed.")
             save_data_to_json(partial_data, partial_data_path)
@@ -132,9 +132,8 @@ def Novel_architecture_generate(
         prompt_world = world_building_prompt.format(
             core_seed=partial_data["core_seed_result"].strip(),
             user_guidance=user_guidance,  # 修复：添加用户指导
-            series_blueprint=series_blueprint_text,
-            core_seed=partial_data["core_seed_result"].strip())
-        world_building_result = invoke_with_cleaning(llm_adapter, prompt_world)
+            series_blueprint=series_blueprint_text)
+        world_building_result = invoke_with_cleaning(llm_adapter, prompt_world, stage="world_building", cache_dir=filepath)
         if not world_building_result.strip():
             logging.warning("world_building_prompt generation failed.")
             save_data_to_json(partial_data, partial_data_path)
@@ -152,7 +151,7 @@ def Novel_architecture_generate(
             world_building=partial_data["world_building_result"].strip(),
             user_guidance=user_guidance  # 修复：添加用户指导
         )
-        plot_arch_result = invoke_with_cleaning(llm_adapter, prompt_plot)
+        plot_arch_result = invoke_with_cleaning(llm_adapter, prompt_plot, stage="plot_architecture", cache_dir=filepath)
         if not plot_arch_result.strip():
             logging.warning("plot_architecture_prompt generation failed.")
             save_data_to_json(partial_data, partial_data_path)
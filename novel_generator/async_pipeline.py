@@ -0,0 +1,296 @@
+# novel_generator/async_pipeline.py
+# -*- coding: utf-8 -*-
+"""
+异步版本的生成入口（摘要、知识过滤、章节草稿、定稿、扩写）。
+LLM 调用走适配器的原生 ainvoke，可在同一个事件循环中并发驱动大量章节/摘要请求；
+依赖 Chroma 等同步库的步骤（构造章节提示词、写入向量库）放入线程池执行。
+"""
+import asyncio
+import logging
+import os
+from llm_adapters import create_llm_adapter
+from embedding_adapters import create_embedding_adapter
+from prompt_definitions import update_character_state_prompt
+from novel_generator.common import ainvoke_with_cleaning
+from novel_generator.chapter import (
+    MAX_DRAFT_CONTINUATIONS,
+    build_chapter_prompt,
+    format_continuation_prompt,
+    stitch_continuation,
+    format_recent_chapters_summary_prompt,
+    finish_recent_chapters_summary,
+    format_knowledge_filter_prompt
+)
+from novel_generator.finalization import format_enrich_prompt, format_summary_prompt
+from novel_generator.vectorstore_utils import update_vector_store
+from utils import read_file, clear_file_content, save_string_to_txt
+
+async def gather_with_concurrency(limit: int, *aws):
+    """与 asyncio.gather 相同，但同时运行的协程数不超过 limit"""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*(run(aw) for aw in aws))
+
+async def asummarize_recent_chapters(
+    interface_format: str,
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    temperature: float,
+    max_tokens: int,
+    chapters_text_list: list,
+    novel_number: int,
+    chapter_info: dict,
+    next_chapter_info: dict,
+    timeout: int = 600,
+    cache_dir: str = ""
+) -> str:
+    """summarize_recent_chapters 的异步版本"""
+    try:
+        prompt = format_recent_chapters_summary_prompt(chapters_text_list, novel_number, chapter_info, next_chapter_info)
+        if not prompt:
+            return ""
+        llm_adapter = create_llm_adapter(
+            interface_format=interface_format,
+            base_url=base_url,
+            model_name=model_name,
+            api_key=api_key,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            timeout=timeout
+        )
+        response_text = await ainvoke_with_cleaning(llm_adapter, prompt, stage="summary", cache_dir=cache_dir)
+        return finish_recent_chapters_summary(response_text)
+    except Exception as e:
+        logging.error(f"Error in asummarize_recent_chapters: {str(e)}")
+        return ""
+
+async def aget_filtered_knowledge_context(
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    interface_format: str,
+    chapter_info: dict,
+    retrieved_texts: list,
+    max_tokens: int = 2048,
+    timeout: int = 600,
+    cache_dir: str = ""
+) -> str:
+    """get_filtered_knowledge_context 的异步版本"""
+    if not retrieved_texts:
+        return "（无相关知识库内容）"
+    try:
+        llm_adapter = create_llm_adapter(
+            interface_format=interface_format,
+            base_url=base_url,
+            model_name=model_name,
+            api_key=api_key,
+            temperature=0.3,
+            max_tokens=max_tokens,
+            timeout=timeout
+        )
+        prompt = format_knowledge_filter_prompt(chapter_info, retrieved_texts)
+        filtered_content = await ainvoke_with_cleaning(llm_adapter, prompt, stage="knowledge_filter", cache_dir=cache_dir)
+        return filtered_content if filtered_content else "（知识内容过滤失败）"
+    except Exception as e:
+        logging.error(f"Error in knowledge filtering: {str(e)}")
+        return "（内容过滤过程出错）"
+
+async def agenerate_chapter_draft(
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    filepath: str,
+    novel_number: int,
+    word_number: int,
+    temperature: float,
+    user_guidance: str,
+    characters_involved: str,
+    key_items: str,
+    scene_location: str,
+    time_constraint: str,
+    embedding_api_key: str,
+    embedding_url: str,
+    embedding_interface_format: str,
+    embedding_model_name: str,
+    embedding_retrieval_k: int = 2,
+    interface_format: str = "openai",
+    max_tokens: int = 2048,
+    timeout: int = 600,
+    custom_prompt_text: str = None
+) -> str:
+    """
+    generate_chapter_draft 的异步版本。
+    未提供 custom_prompt_text 时，build_chapter_prompt（含向量检索）在线程池中执行；
+    输出因长度限制被截断时的续写方式与同步版本相同。
+    """
+    if custom_prompt_text is None:
+        prompt_text = await asyncio.to_thread(
+            build_chapter_prompt,
+            api_key=api_key,
+            base_url=base_url,
+            model_name=model_name,
+            filepath=filepath,
+            novel_number=novel_number,
+            word_number=word_number,
+            temperature=temperature,
+            user_guidance=user_guidance,
+            characters_involved=characters_involved,
+            key_items=key_items,
+            scene_location=scene_location,
+            time_constraint=time_constraint,
+            embedding_api_key=embedding_api_key,
+            embedding_url=embedding_url,
+            embedding_interface_format=embedding_interface_format,
+            embedding_model_name=embedding_model_name,
+            embedding_retrieval_k=embedding_retrieval_k,
+            interface_format=interface_format,
+            max_tokens=max_tokens,
+            timeout=timeout
+        )
+    else:
+        prompt_text = custom_prompt_text
+
+    chapters_dir = os.path.join(filepath, "chapters")
+    os.makedirs(chapters_dir, exist_ok=True)
+
+    llm_adapter = create_llm_adapter(
+        interface_format=interface_format,
+        base_url=base_url,
+        model_name=model_name,
+        api_key=api_key,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        timeout=timeout
+    )
+
+    result_info = {}
+    chapter_content = await ainvoke_with_cleaning(llm_adapter, prompt_text, stage="draft", cache_dir=filepath, result_info=result_info)
+    continuations = 0
+    while chapter_content and result_info.get("finish_reason") == "length" and continuations < MAX_DRAFT_CONTINUATIONS:
+        continuations += 1
+        logging.info(f"[Draft] Chapter {novel_number} was truncated at {len(chapter_content)} chars, requesting continuation {continuations}.")
+        continuation = await ainvoke_with_cleaning(
+            llm_adapter,
+            format_continuation_prompt(novel_number, word_number, chapter_content),
+            stage="draft_continuation",
+            cache_dir=filepath,
+            result_info=result_info,
+            keep_leading_newlines=True
+        )
+        chapter_content += stitch_continuation(chapter_content, continuation)
+    if result_info.get("finish_reason") == "length":
+        logging.warning(f"[Draft] Chapter {novel_number} is still truncated after {continuations} continuations.")
+    if not chapter_content.strip():
+        # 与同步版本一致：空结果不覆盖已有草稿
+        logging.warning("Generated chapter draft is empty.")
+        return chapter_content
+    chapter_file = os.path.join(chapters_dir, f"chapter_{novel_number}.txt")
+    clear_file_content(chapter_file)
+    save_string_to_txt(chapter_content, chapter_file)
+    logging.info(f"[Draft] Chapter {novel_number} generated as a draft (async).")
+    return chapter_content
+
+async def afinalize_chapter(
+    novel_number: int,
+    word_number: int,
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    temperature: float,
+    filepath: str,
+    embedding_api_key: str,
+    embedding_url: str,
+    embedding_interface_format: str,
+    embedding_model_name: str,
+    interface_format: str,
+    max_tokens: int,
+    timeout: int = 600
+):
+    """
+    finalize_chapter 的异步版本。
+    前文摘要与角色状态只依赖旧状态和本章文本，二者并发请求。
+    """
+    chapters_dir = os.path.join(filepath, "chapters")
+    chapter_file = os.path.join(chapters_dir, f"chapter_{novel_number}.txt")
+    chapter_text = read_file(chapter_file).strip()
+    if not chapter_text:
+        logging.warning(f"Chapter {novel_number} is empty, cannot finalize.")
+        return
+
+    global_summary_file = os.path.join(filepath, "global_summary.txt")
+    old_global_summary = read_file(global_summary_file)
+    character_state_file = os.path.join(filepath, "character_state.txt")
+    old_character_state = read_file(character_state_file)
+
+    llm_adapter = create_llm_adapter(
+        interface_format=interface_format,
+        base_url=base_url,
+        model_name=model_name,
+        api_key=api_key,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        timeout=timeout
+    )
+
+    prompt_summary = format_summary_prompt(chapter_text, old_global_summary, model_name, max_tokens)
+    prompt_char_state = update_character_state_prompt.format(
+        chapter_text=chapter_text,
+        old_state=old_character_state
+    )
+    new_global_summary, new_char_state = await asyncio.gather(
+        ainvoke_with_cleaning(llm_adapter, prompt_summary, stage="finalize_summary", cache_dir=filepath),
+        ainvoke_with_cleaning(llm_adapter, prompt_char_state, stage="char_state", cache_dir=filepath)
+    )
+    if not new_global_summary.strip():
+        new_global_summary = old_global_summary
+    if not new_char_state.strip():
+        new_char_state = old_character_state
+
+    clear_file_content(global_summary_file)
+    save_string_to_txt(new_global_summary, global_summary_file)
+    clear_file_content(character_state_file)
+    save_string_to_txt(new_char_state, character_state_file)
+
+    await asyncio.to_thread(
+        update_vector_store,
+        embedding_adapter=create_embedding_adapter(
+            embedding_interface_format,
+            embedding_api_key,
+            embedding_url,
+            embedding_model_name
+        ),
+        new_chapter=chapter_text,
+        filepath=filepath,
+        chapter_number=novel_number
+    )
+
+    logging.info(f"Chapter {novel_number} has been finalized (async).")
+
+async def aenrich_chapter_text(
+    chapter_text: str,
+    word_number: int,
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    temperature: float,
+    interface_format: str,
+    max_tokens: int,
+    timeout: int = 600
+) -> str:
+    """enrich_chapter_text 的异步版本"""
+    llm_adapter = create_llm_adapter(
+        interface_format=interface_format,
+        base_url=base_url,
+        model_name=model_name,
+        api_key=api_key,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        timeout=timeout
+    )
+    enriched_text = await ainvoke_with_cleaning(llm_adapter, format_enrich_prompt(chapter_text, word_number), stage="enrich")
+    return enriched_text if enriched_text else chapter_text
@@ -0,0 +1,412 @@
+# novel_generator/batch.py
+# -*- coding: utf-8 -*-
+"""
+离线批处理模式：把不需要即时返回的大量 LLM 调用（批量一致性审校、多个项目的章节目录等）
+整理成 OpenAI Batch 格式的 JSONL 一次提交，按批处理价格与吞吐执行。
+
+工作方式为"重放"：
+1. run_batch 在批处理上下文中执行各任务（普通的 novel_generator 生成函数即可）；
+2. 任务内的 invoke_with_cleaning 等遇到尚无结果的提示词时登记请求并抛出 BatchDeferred，任务暂停；
+3. 登记的请求写入 JSONL 提交给后端（OpenAIBatchBackend 或本地替身 LocalBatchBackend），轮询至完成；
+4. 结果写入清单（batch_manifest.json）后重新执行未完成的任务，已有结果的提示词直接返回，
+   直到所有任务完成。多步任务（如分块生成章节目录）每轮推进一步。
+清单记录每个请求与批次的状态，中断后以同一 job_dir 再次调用 run_batch 即可续跑：
+已完成的结果直接复用，已提交但未完成的批次继续轮询而不会重复提交。
+"""
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from openai import OpenAI
+
+from http_pool import get_http_client
+from llm_adapters import check_base_url
+from llm_usage import record_usage, stage_context
+from utils import read_file, save_string_to_txt, clear_file_content
+
+BATCH_MANIFEST_FILENAME = "batch_manifest.json"
+BATCH_ENDPOINT = "/v1/chat/completions"
+# 批次的终止状态（与 OpenAI Batch API 一致）
+FINAL_BATCH_STATUSES = {"completed", "failed", "expired", "cancelled"}
+# 连续多少次查询批次状态失败（每次已含重试）后放弃该批次，避免 Key 失效、批次被删除时无限轮询
+MAX_POLL_FAILURES = 5
+
+_active_job = contextvars.ContextVar("batch_job", default=None)
+
+class BatchDeferred(BaseException):
+    """
+    批处理模式下提示词已登记、结果尚未就绪。
+    继承 BaseException，避免被生成函数中的 except Exception 吞掉；由 run_batch 捕获。
+    """
+
+class BatchRequestFailed(Exception):
+    """批处理请求多次失败，放弃该请求"""
+
+def active_batch():
+    """当前处于批处理上下文时返回 BatchJob，否则返回 None"""
+    return _active_job.get()
+
+def _output_content(line: dict):
+    """从 Batch 输出的一行中取出 (content, usage, error)"""
+    response = line.get("response") or {}
+    body = response.get("body") or {}
+    error = line.get("error") or body.get("error")
+    if error or response.get("status_code", 200) >= 400:
+        return None, None, error or f"HTTP {response.get('status_code')}"
+    try:
+        content = body["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None, None, "missing choices in batch response"
+    return content or "", body.get("usage"), None
+
+class BatchJob:
+    """
+    一次批处理作业的清单与待提交请求。
+    清单保存在 job_dir/batch_manifest.json，请求的 custom_id 由 (模型, 参数, 阶段, 提示词) 哈希得到，
+    重新执行任务时同一调用会得到同一 custom_id。
+    """
+    def __init__(self, job_dir: str, max_attempts: int = 3):
+        self.job_dir = job_dir
+        self.max_attempts = max_attempts
+        self.manifest_path = os.path.join(job_dir, BATCH_MANIFEST_FILENAME)
+        self._lock = threading.Lock()
+        self._queued = {}  # custom_id -> (stage, adapter, body)，仅存在于本次运行的内存中
+        self._poll_failures = {}  # batch_id -> 连续查询失败次数
+        os.makedirs(job_dir, exist_ok=True)
+        self.manifest = {"version": 1, "requests": {}, "batches": {}}
+        if os.path.exists(self.manifest_path):
+            try:
+                self.manifest = json.loads(read_file(self.manifest_path))
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Corrupted batch manifest {self.manifest_path}: {e}")
+
+    def _save(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def request_body(llm_adapter, prompt: str) -> dict:
+        body = {
+            "model": getattr(llm_adapter, "model_name", ""),
+            "messages": [{"role": "user", "content": prompt}]
+        }
+        for name in ("temperature", "max_tokens"):
+            value = getattr(llm_adapter, name, None)
+            if value is not None:
+                body[name] = value
+        return body
+
+    @staticmethod
+    def make_custom_id(stage: str, body: dict) -> str:
+        raw = json.dumps([stage, body], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+    def resolve(self, llm_adapter, prompt: str, stage: str = "") -> str:
+        """
+        返回该调用的批处理结果；尚无结果时登记请求并抛出 BatchDeferred。
+        多次失败的请求抛出 BatchRequestFailed。
+        """
+        body = self.request_body(llm_adapter, prompt)
+        custom_id = self.make_custom_id(stage, body)
+        with self._lock:
+            entry = self.manifest["requests"].get(custom_id)
+            if entry is not None and entry["status"] == "done":
+                return entry["result"]
+            if entry is not None and entry["status"] == "failed" and entry["attempts"] >= self.max_attempts:
+                raise BatchRequestFailed(f"Batch request {custom_id} ({stage}) failed: {entry.get('error')}")
+            if entry is None or entry["status"] == "failed":
+                self._queued[custom_id] = (stage, llm_adapter, body)
+                if entry is None:
+                    entry = {"stage": stage, "model": body["model"], "attempts": 0, "batch_id": None, "result": None, "error": None}
+                    self.manifest["requests"][custom_id] = entry
+                entry["status"] = "queued"
+                self._save()
+            elif entry["status"] == "queued" and custom_id not in self._queued:
+                # 上次运行登记后未来得及提交
+                self._queued[custom_id] = (stage, llm_adapter, body)
+        raise BatchDeferred(custom_id)
+
+    def outstanding_batches(self) -> list:
+        return [batch_id for batch_id, info in self.manifest["batches"].items() if info["status"] not in FINAL_BATCH_STATUSES]
+
+    def submit(self, backend) -> int:
+        """把本轮登记的请求写成 JSONL 并提交，返回提交的请求数"""
+        with self._lock:
+            queued = dict(self._queued)
+            self._queued.clear()
+            # 后端只能执行指向其自身接口的请求，其它请求直接判为失败，不再重试
+            for custom_id, (stage, llm_adapter, _) in list(queued.items()):
+                if backend.accepts(llm_adapter):
+                    continue
+                del queued[custom_id]
+                error = (f"adapter {getattr(llm_adapter, 'provider', '')} {getattr(llm_adapter, 'base_url', '')} "
+                         f"is not served by batch backend {type(backend).__name__}")
+                logging.error(f"[Batch] Rejected request {custom_id} ({stage}): {error}")
+                self.manifest["requests"][custom_id].update(status="failed", attempts=self.max_attempts, error=error)
+            self._save()
+        if not queued:
+            return 0
+        input_path = os.path.join(self.job_dir, f"batch_input_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}.jsonl")
+        lines = [
+            json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}, ensure_ascii=False)
+            for custom_id, (_, _, body) in queued.items()
+        ]
+        save_string_to_txt("\n".join(lines) + "\n", input_path)
+        batch_id = backend.submit(input_path, queued)
+        logging.info(f"[Batch] Submitted {len(queued)} requests as batch {batch_id}.")
+        with self._lock:
+            self.manifest["batches"][batch_id] = {
+                "status": "submitted",
+                "input_file": os.path.basename(input_path),
+                "custom_ids": list(queued),
+                "created_at": time.time()
+            }
+            for custom_id in queued:
+                entry = self.manifest["requests"][custom_id]
+                entry["status"] = "submitted"
+                entry["batch_id"] = batch_id
+                entry["attempts"] += 1
+            self._save()
+        return len(queued)
+
+    def _apply_results(self, batch_id: str, lines: list):
+        info = self.manifest["batches"][batch_id]
+        seen = set()
+        for line in lines:
+            custom_id = line.get("custom_id")
+            entry = self.manifest["requests"].get(custom_id)
+            if entry is None or entry["status"] == "done":
+                continue
+            seen.add(custom_id)
+            content, usage, error = _output_content(line)
+            if error is None:
+                entry.update(status="done", result=content, error=None)
+                if usage:
+                    with stage_context(entry["stage"]):
+                        record_usage(usage, "batch", entry["model"])
+            else:
+                entry.update(status="failed", error=str(error))
+        for custom_id in info["custom_ids"]:
+            entry = self.manifest["requests"].get(custom_id)
+            if custom_id not in seen and entry is not None and entry["status"] == "submitted":
+                entry.update(status="failed", error=f"batch {batch_id} ended as {info['status']} without a result")
+
+    def wait(self, backend, poll_interval: float = 30.0):
+        """轮询所有未结束的批次（包括上次运行提交的），结束后把结果写入清单"""
+        while True:
+            outstanding = self.outstanding_batches()
+            if not outstanding:
+                return
+            for batch_id in outstanding:
+                state = backend.poll(batch_id)
+                if state is None:
+                    failures = self._poll_failures.get(batch_id, 0) + 1
+                    self._poll_failures[batch_id] = failures
+                    if failures < MAX_POLL_FAILURES:
+                        continue
+                    logging.error(f"[Batch] Giving up batch {batch_id} after {failures} failed polls.")
+                    state = {"status": "failed", "error": f"status unavailable after {failures} polls"}
+                unreachable = self._poll_failures.pop(batch_id, 0) >= MAX_POLL_FAILURES
+                with self._lock:
+                    info = self.manifest["batches"][batch_id]
+                    info.update(state)
+                    if info["status"] in FINAL_BATCH_STATUSES:
+                        lines = backend.fetch(batch_id, info) if info["status"] != "cancelled" and not unreachable else []
+                        self._apply_results(batch_id, lines)
+                        logging.info(f"[Batch] Batch {batch_id} {info['status']}, {len(lines)} results.")
+                    self._save()
+            if self.outstanding_batches():
+                time.sleep(poll_interval)
+
+class LocalBatchBackend:
+    """
+    本地替身：用各请求原本的 LLM 适配器在线程池中执行批次（含重试），输出与 OpenAI Batch 相同格式的 JSONL。
+    适合未提供 Batch API 的服务商，以及配合 Mock 接口做离线测试。批次只存在于本进程中，
+    中断后续跑时未完成的本地批次会被视为过期并重新提交。
+    """
+    def __init__(self, max_workers: int = 4):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="local-batch")
+        self._batches = {}
+
+    @staticmethod
+    def _run(custom_id: str, stage: str, llm_adapter, prompt: str) -> dict:
+        from novel_generator.common import invoke_with_cleaning  # common 依赖本模块，延迟导入避免循环
+        try:
+            content = invoke_with_cleaning(llm_adapter, prompt, stage=stage)
+        except Exception as e:
+            return {"custom_id": custom_id, "response": None, "error": {"message": f"{type(e).__name__}: {e}"}}
+        body = {"choices": [{"message": {"role": "assistant", "content": content}}]}
+        return {"custom_id": custom_id, "response": {"status_code": 200, "body": body}, "error": None}
+
+    def accepts(self, llm_adapter) -> bool:
+        return True
+
+    def submit(self, input_path: str, requests: dict) -> str:
+        batch_id = f"local-{uuid.uuid4().hex[:12]}"
+        self._batches[batch_id] = [
+            self._executor.submit(self._run, custom_id, stage, llm_adapter, body["messages"][0]["content"])
+            for custom_id, (stage, llm_adapter, body) in requests.items()
+        ]
+        return batch_id
+
+    def poll(self, batch_id: str) -> dict:
+        futures = self._batches.get(batch_id)
+        if futures is None:
+            return {"status": "expired"}
+        done = sum(future.done() for future in futures)
+        return {"status": "completed" if done == len(futures) else "in_progress", "completed": done, "total": len(futures)}
+
+    def fetch(self, batch_id: str, info: dict) -> list:
+        futures = self._batches.pop(batch_id, [])
+        return [future.result() for future in futures]
+
+class OpenAIBatchBackend:
+    """通过 OpenAI Batch API（或兼容该接口的服务）提交批次"""
+    def __init__(self, api_key: str, base_url: str = "https://api.openai.com/v1", completion_window: str = "24h", timeout: int = 600):
+        self.base_url = check_base_url(base_url)
+        self.completion_window = completion_window
+        self._client = OpenAI(
+            base_url=self.base_url,
+            api_key=api_key,
+            timeout=timeout,
+            max_retries=0,  # 重试统一由 novel_generator.common.RetryPolicy 负责
+            http_client=get_http_client(self.base_url, timeout)
+        )
+
+    def _call(self, func, **kwargs):
+        from novel_generator.common import call_with_retry  # common 依赖本模块，延迟导入避免循环
+        return call_with_retry(func, **kwargs)
+
+    def accepts(self, llm_adapter) -> bool:
+        """批次以本后端的账号与地址执行，只接受 base_url 相同的适配器（Azure 等接口的 base_url 不会相同）"""
+        base_url = getattr(llm_adapter, "base_url", "") or ""
+        return bool(base_url) and check_base_url(base_url).rstrip("/") == self.base_url.rstrip("/")
+
+    def submit(self, input_path: str, requests: dict) -> str:
+        def create():
+            with open(input_path, "rb") as f:
+                uploaded = self._client.files.create(file=f, purpose="batch")
+            return self._client.batches.create(
+                input_file_id=uploaded.id,
+                endpoint=BATCH_ENDPOINT,
+                completion_window=self.completion_window
+            ).id
+        batch_id = self._call(create)
+        if not batch_id:
+            raise RuntimeError(f"Failed to submit batch input {input_path}.")
+        return batch_id
+
+    def poll(self, batch_id: str):
+        batch = self._call(self._client.batches.retrieve, batch_id=batch_id)
+        if batch is None:
+            return None
+        counts = getattr(batch, "request_counts", None)
+        return {
+            "status": batch.status,
+            "output_file_id": batch.output_file_id,
+            "error_file_id": batch.error_file_id,
+            "completed": getattr(counts, "completed", None),
+            "total": getattr(counts, "total", None)
+        }
+
+    def fetch(self, batch_id: str, info: dict) -> list:
+        lines = []
+        for key in ("output_file_id", "error_file_id"):
+            file_id = info.get(key)
+            if not file_id:
+                continue
+            content = self._call(self._client.files.content, file_id=file_id)
+            if content is None:
+                raise RuntimeError(f"Failed to download {key} {file_id} of batch {batch_id}.")
+            lines.extend(json.loads(line) for line in content.text.splitlines() if line.strip())
+        return lines
+
+def run_batch(tasks: dict, job_dir: str, backend=None, poll_interval: float = 30.0, max_rounds: int = 50) -> dict:
+    """
+    以批处理模式执行 tasks（{名称: 无参可调用对象}），返回 {名称: 返回值或异常}。
+    任务需可重复执行（novel_generator 的生成函数会从已保存的中间结果续跑）。
+    backend 默认为 LocalBatchBackend。
+    """
+    backend = backend or LocalBatchBackend()
+    job = BatchJob(job_dir)
+    outcomes = {}
+    pending = dict(tasks)
+    for round_index in range(1, max_rounds + 1):
+        deferred = {}
+        for name, task in pending.items():
+            token = _active_job.set(job)
+            try:
+                outcomes[name] = task()
+            except BatchDeferred:
+                deferred[name] = task
+            except Exception as e:
+                logging.error(f"[Batch] Task {name} failed: {e}")
+                outcomes[name] = e
+            finally:
+                _active_job.reset(token)
+        if not deferred:
+            break
+        # 先等待上次运行遗留的批次，避免重复提交其中的请求
+        job.wait(backend, poll_interval)
+        submitted = job.submit(backend)
+        logging.info(f"[Batch] Round {round_index}: {len(deferred)} tasks waiting, {submitted} requests submitted.")
+        job.wait(backend, poll_interval)
+        pending = deferred
+    else:
+        for name in pending:
+            outcomes[name] = RuntimeError(f"Batch task {name} did not finish within {max_rounds} rounds.")
+    return outcomes
+
+def consistency_audit_tasks(
+    filepath: str,
+    chapters: list,
+    interface_format: str,
+    api_key: str,
+    base_url: str,
+    model_name: str,
+    temperature: float = 0.3,
+    max_tokens: int = 2048,
+    timeout: int = 600
+) -> dict:
+    """
+    为项目的若干章节生成一致性审校任务，结果写入 filepath/consistency_reports/chapter_N.txt。
+    """
+    from consistency_checker import check_consistency
+
+    reports_dir = os.path.join(filepath, "consistency_reports")
+
+    def make_task(chap_num: int):
+        def task():
+            chapter_text = read_file(os.path.join(filepath, "chapters", f"chapter_{chap_num}.txt"))
+            if not chapter_text.strip():
+                return ""
+            result = check_consistency(
+                novel_setting=read_file(os.path.join(filepath, "Novel_architecture.txt")),
+                character_state=read_file(os.path.join(filepath, "character_state.txt")),
+                global_summary=read_file(os.path.join(filepath, "global_summary.txt")),
+                chapter_text=chapter_text,
+                api_key=api_key,
+                base_url=base_url,
+                model_name=model_name,
+                temperature=temperature,
+                interface_format=interface_format,
+                max_tokens=max_tokens,
+                timeout=timeout,
+                filepath=filepath
+            )
+            os.makedirs(reports_dir, exist_ok=True)
+            report_file = os.path.join(reports_dir, f"chapter_{chap_num}.txt")
+            clear_file_content(report_file)
+            save_string_to_txt(result, report_file)
+            return result
+        return task
+
+    return {f"{filepath}#chapter_{chap_num}": make_task(chap_num) for chap_num in chapters}
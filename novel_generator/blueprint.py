@@ -8,8 +8,10 @@ import re
 import logging
 from novel_generator.common import invoke_with_cleaning
 from llm_adapters import create_llm_adapter
-from prompt_definitions import chapter_blueprint_prompt, chunked_chapter_blueprint_prompt
+from prompt_definitions import chapter_blueprint_prompt, chunked_chapter_blueprint_prompt, chunked_chapter_blueprint_prompt_stable
 from utils import read_file, clear_file_content, save_string_to_txt
+from novel_generator.prompt_budget import PromptSection, format_with_budget
+from novel_generator.prompt_layout import stable_prefix_enabled, normalize_static_text
 
 def compute_chunk_size(number_of_chapters: int, max_tokens: int) -> int:
     """
@@ -41,6 +43,49 @@ def limit_chapter_blueprint(blueprint_text: str, limit_chapters: int = 100) -> s
     selected = chapters[-limit_chapters:]
     return "\n\n".join(selected).strip()
 
+def format_chunked_blueprint_prompt(
+    architecture_text: str,
+    chapter_list: str,
+    number_of_chapters: int,
+    n: int,
+    m: int,
+    user_guidance: str,
+    model_name: str,
+    max_tokens: int
+) -> str:
+    """
+    在 token 预算内构造分块目录提示词：
+    超出预算时先裁剪已有目录（保留最近的章节），再裁剪小说架构。
+    稳定前缀布局下小说架构放在最前面，且只按固定占比裁剪，使各分块的前缀保持一致。
+    """
+    if stable_prefix_enabled():
+        return format_with_budget(
+            chunked_chapter_blueprint_prompt_stable,
+            model_name,
+            max_tokens,
+            sections=[
+                PromptSection("chapter_list", chapter_list, priority=1, keep="tail"),
+                PromptSection("novel_setting", normalize_static_text(architecture_text), priority=2, keep="head", max_share=0.5)
+            ],
+            number_of_chapters=number_of_chapters,
+            n=n,
+            m=m,
+            user_guidance=user_guidance
+        )
+    return format_with_budget(
+        chunked_chapter_blueprint_prompt,
+        model_name,
+        max_tokens,
+        sections=[
+            PromptSection("chapter_list", chapter_list, priority=1, keep="tail"),
+            PromptSection("novel_architecture", architecture_text, priority=2, keep="head", min_tokens=1000)
+        ],
+        number_of_chapters=number_of_chapters,
+        n=n,
+        m=m,
+        user_guidance=user_guidance
+    )
+
 def Chapter_blueprint_generate(
     interface_format: str,
     api_key: str,
@@ -102,16 +147,12 @@ def Chapter_blueprint_generate(
         while current_start <= number_of_chapters:
             current_end = min(current_start + chunk_size - 1, number_of_chapters)
             limited_blueprint = limit_chapter_blueprint(final_blueprint, 100)
-            chunk_prompt = chunked_chapter_blueprint_prompt.format(
-                novel_architecture=architecture_text,
-                chapter_list=limited_blueprint,
-                number_of_chapters=number_of_chapters,
-                n=current_start,
-                m=current_end,
-                user_guidance=user_guidance  # 新增参数
+            chunk_prompt = format_chunked_blueprint_prompt(
+                architecture_text, limited_blueprint, number_of_chapters,
+                current_start, current_end, user_guidance, llm_model, max_tokens
             )
             logging.info(f"Generating chapters [{current_start}..{current_end}] in a chunk...")
-            chunk_result = invoke_with_cleaning(llm_adapter, chunk_prompt)
+            chunk_result = invoke_with_cleaning(llm_adapter, chunk_prompt, stage="blueprint_chunk", cache_dir=filepath)
             if not chunk_result.strip():
                 logging.warning(f"Chunk generation for chapters [{current_start}..{current_end}] is empty.")
                 clear_file_content(filename_dir)
@@ -131,7 +172,7 @@ def Chapter_blueprint_generate(
             number_of_chapters=number_of_chapters,
             user_guidance=user_guidance  # 新增参数
         )
-        blueprint_text = invoke_with_cleaning(llm_adapter, prompt)
+        blueprint_text = invoke_with_cleaning(llm_adapter, prompt, stage="blueprint", cache_dir=filepath)
         if not blueprint_text.strip():
             logging.warning("Chapter blueprint generation result is empty.")
             return
@@ -147,16 +188,12 @@ def Chapter_blueprint_generate(
     while current_start <= number_of_chapters:
         current_end = min(current_start + chunk_size - 1, number_of_chapters)
         limited_blueprint = limit_chapter_blueprint(final_blueprint, 100)
-        chunk_prompt = chunked_chapter_blueprint_prompt.format(
-            novel_architecture=architecture_text,
-            chapter_list=limited_blueprint,
-            number_of_chapters=number_of_chapters,
-            n=current_start,
-            m=current_end,
-            user_guidance=user_guidance  # 新增参数
+        chunk_prompt = format_chunked_blueprint_prompt(
+            architecture_text, limited_blueprint, number_of_chapters,
+            current_start, current_end, user_guidance, llm_model, max_tokens
         )
         logging.info(f"Generating chapters [{current_start}..{current_end}] in a chunk...")
-        chunk_result = invoke_with_cleaning(llm_adapter, chunk_prompt)
+        chunk_result = invoke_with_cleaning(llm_adapter, chunk_prompt, stage="blueprint_chunk", cache_dir=filepath)
         if not chunk_result.strip():
             logging.warning(f"Chunk generation for chapters [{current_start}..{current_end}] is empty.")
             clear_file_content(filename_dir)
@@ -11,18 +11,35 @@ from llm_adapters import create_llm_adapter
 from prompt_definitions import (
     first_chapter_draft_prompt, 
     next_chapter_draft_prompt, 
+    first_chapter_draft_prompt_stable,
+    next_chapter_draft_prompt_stable,
     summarize_recent_chapters_prompt,
+    chapter_continuation_prompt,
     knowledge_filter_prompt,
     knowledge_search_prompt
 )
 from chapter_directory_parser import get_chapter_info_from_blueprint
-from novel_generator.common import invoke_with_cleaning
-from utils import read_file, clear_file_content, save_string_to_txt
+from novel_generator.common import invoke_with_cleaning, invoke_stream_with_cleaning
+from novel_generator.prompt_budget import PromptSection, format_with_budget
+from novel_generator.prompt_layout import stable_prefix_enabled, normalize_static_text
+from utils import read_file, save_string_to_txt
 from novel_generator.vectorstore_utils import (
-    get_relevant_context_from_vector_store,
+    get_relevant_contexts_from_vector_store,
+    combine_retrieved_texts,
+    exclude_recent_chapters_filter,
+    select_diverse_contexts,
     load_vector_store  # 添加导入
 )
 
+# 距当前章节不超过该章数的历史章节片段不参与检索（没有元数据的旧片段在 apply_content_rules 中标为 SKIP）
+RECENT_CHAPTER_WINDOW = 2
+# 距当前章节不超过该章数的历史章节片段需要大幅改写后才能引用
+REWRITE_CHAPTER_WINDOW = 5
+# 每个关键词组先取回 k 的该倍数条候选，再跨组做 MMR 去重选出 k 条
+MMR_CANDIDATE_FACTOR = 2
+# 已由 apply_content_rules 按远近规则处理过的片段标记
+_CONTENT_RULE_TAG = re.compile(r"\[(SKIP|MOD40%|OK|PRIOR)\]")
+
 def get_last_n_chapters_text(chapters_dir: str, current_chapter_num: int, n: int = 3) -> list:
     """
     从目录 chapters_dir 中获取最近 n 章的文本内容，返回文本列表。
@@ -49,22 +66,18 @@ def summarize_recent_chapters(
     novel_number: int,            # 新增参数
     chapter_info: dict,           # 新增参数
     next_chapter_info: dict,      # 新增参数
-    timeout: int = 600
+    timeout: int = 600,
+    cache_dir: str = ""
 ) -> str:  # 修改返回值类型为 str，不再是 tuple
     """
     根据前三章内容生成当前章节的精准摘要。
     如果解析失败，则返回空字符串。
     """
     try:
-        combined_text = "\n".join(chapters_text_list).strip()
-        if not combined_text:
+        prompt = format_recent_chapters_summary_prompt(chapters_text_list, novel_number, chapter_info, next_chapter_info)
+        if not prompt:
             return ""
-            
-        # 限制组合文本长度
-        max_combined_length = 4000
-        if len(combined_text) > max_combined_length:
-            combined_text = combined_text[-max_combined_length:]
-            
+
         llm_adapter = create_llm_adapter(
             interface_format=interface_format,
             base_url=base_url,
@@ -74,44 +87,59 @@ def summarize_recent_chapters(
             max_tokens=max_tokens,
             timeout=timeout
         )
-        
-        # 确保所有参数都有默认值
-        chapter_info = chapter_info or {}
-        next_chapter_info = next_chapter_info or {}
-        
-        prompt = summarize_recent_chapters_prompt.format(
-            combined_text=combined_text,
-            novel_number=novel_number,
-            chapter_title=chapter_info.get("chapter_title", "未命名"),
-            chapter_role=chapter_info.get("chapter_role", "常规章节"),
-            chapter_purpose=chapter_info.get("chapter_purpose", "内容推进"),
-            suspense_level=chapter_info.get("suspense_level", "中等"),
-            foreshadowing=chapter_info.get("foreshadowing", "无"),
-            plot_twist_level=chapter_info.get("plot_twist_level", "★☆☆☆☆"),
-            chapter_summary=chapter_info.get("chapter_summary", ""),
-            next_chapter_number=novel_number + 1,
-            next_chapter_title=next_chapter_info.get("chapter_title", "（未命名）"),
-            next_chapter_role=next_chapter_info.get("chapter_role", "过渡章节"),
-            next_chapter_purpose=next_chapter_info.get("chapter_purpose", "承上启下"),
-            next_chapter_summary=next_chapter_info.get("chapter_summary", "衔接过渡内容"),
-            next_chapter_suspense_level=next_chapter_info.get("suspense_level", "中等"),
-            next_chapter_foreshadowing=next_chapter_info.get("foreshadowing", "无特殊伏笔"),
-            next_chapter_plot_twist_level=next_chapter_info.get("plot_twist_level", "★☆☆☆☆")
-        )
-        
-        response_text = invoke_with_cleaning(llm_adapter, prompt)
-        summary = extract_summary_from_response(response_text)
-        
-        if not summary:
-            logging.warning("Failed to extract summary, using full response")
-            return response_text[:2000]  # 限制长度
-            
-        return summary[:2000]  # 限制摘要长度
-        
+
+        response_text = invoke_with_cleaning(llm_adapter, prompt, stage="summary", cache_dir=cache_dir)
+        return finish_recent_chapters_summary(response_text)
+
     except Exception as e:
         logging.error(f"Error in summarize_recent_chapters: {str(e)}")
         return ""
 
+def format_recent_chapters_summary_prompt(chapters_text_list: list, novel_number: int, chapter_info: dict, next_chapter_info: dict) -> str:
+    """构造 summarize_recent_chapters_prompt；前文为空时返回空字符串"""
+    combined_text = "\n".join(chapters_text_list).strip()
+    if not combined_text:
+        return ""
+
+    # 限制组合文本长度
+    max_combined_length = 4000
+    if len(combined_text) > max_combined_length:
+        combined_text = combined_text[-max_combined_length:]
+
+    # 确保所有参数都有默认值
+    chapter_info = chapter_info or {}
+    next_chapter_info = next_chapter_info or {}
+
+    return summarize_recent_chapters_prompt.format(
+        combined_text=combined_text,
+        novel_number=novel_number,
+        chapter_title=chapter_info.get("chapter_title", "未命名"),
+        chapter_role=chapter_info.get("chapter_role", "常规章节"),
+        chapter_purpose=chapter_info.get("chapter_purpose", "内容推进"),
+        suspense_level=chapter_info.get("suspense_level", "中等"),
+        foreshadowing=chapter_info.get("foreshadowing", "无"),
+        plot_twist_level=chapter_info.get("plot_twist_level", "★☆☆☆☆"),
+        chapter_summary=chapter_info.get("chapter_summary", ""),
+        next_chapter_number=novel_number + 1,
+        next_chapter_title=next_chapter_info.get("chapter_title", "（未命名）"),
+        next_chapter_role=next_chapter_info.get("chapter_role", "过渡章节"),
+        next_chapter_purpose=next_chapter_info.get("chapter_purpose", "承上启下"),
+        next_chapter_summary=next_chapter_info.get("chapter_summary", "衔接过渡内容"),
+        next_chapter_suspense_level=next_chapter_info.get("suspense_level", "中等"),
+        next_chapter_foreshadowing=next_chapter_info.get("foreshadowing", "无特殊伏笔"),
+        next_chapter_plot_twist_level=next_chapter_info.get("plot_twist_level", "★☆☆☆☆")
+    )
+
+def finish_recent_chapters_summary(response_text: str) -> str:
+    """从模型回复中提取并截断当前章节摘要"""
+    summary = extract_summary_from_response(response_text)
+
+    if not summary:
+        logging.warning("Failed to extract summary, using full response")
+        return response_text[:2000]  # 限制长度
+
+    return summary[:2000]  # 限制摘要长度
+
 def extract_summary_from_response(response_text: str) -> str:
     """从响应文本中提取摘要部分"""
     if not response_text:
@@ -170,21 +198,30 @@ def parse_search_keywords(response_text: str) -> list:
         if '·' in line
     ][:5]  # 最多取5组
 
-def apply_content_rules(texts: list, novel_number: int) -> list:
-    """应用内容处理规则"""
+def _apply_distance_rule(text: str, time_distance: int) -> str:
+    if time_distance <= RECENT_CHAPTER_WINDOW:
+        return f"[SKIP] 跳过近章内容：{text[:120]}..."
+    if time_distance <= REWRITE_CHAPTER_WINDOW:
+        return f"[MOD40%] {text}（需修改≥40%）"
+    return f"[OK] {text}（可引用核心）"
+
+def apply_content_rules(texts: list, novel_number: int, metadatas: list = None) -> list:
+    """
+    应用内容处理规则。
+    带元数据的片段按其来源与章节号判断远近；旧版本写入、没有元数据的片段从文本中猜测章节号。
+    两者使用同一远近规则。
+    """
     processed = []
-    for text in texts:
-        if re.search(r'第[\d]+章', text) or re.search(r'chapter_[\d]+', text):
+    for text, metadata in zip(texts, metadatas or [None] * len(texts)):
+        source = (metadata or {}).get("source")
+        if source == "chapter" and metadata.get("chapter") is not None:
+            processed.append(_apply_distance_rule(text, novel_number - int(metadata["chapter"])))
+        elif source in ("knowledge", "text"):
+            processed.append(f"[PRIOR] {text}（优先使用）")
+        elif re.search(r'第[\d]+章', text) or re.search(r'chapter_[\d]+', text):
             chap_nums = list(map(int, re.findall(r'\d+', text)))
             recent_chap = max(chap_nums) if chap_nums else 0
-            time_distance = novel_number - recent_chap
-            
-            if time_distance <= 2:
-                processed.append(f"[SKIP] 跳过近章内容：{text[:120]}...")
-            elif 3 <= time_distance <= 5:
-                processed.append(f"[MOD40%] {text}（需修改≥40%）")
-            else:
-                processed.append(f"[OK] {text}（可引用核心）")
+            processed.append(_apply_distance_rule(text, novel_number - recent_chap))
         else:
             processed.append(f"[PRIOR] {text}（优先使用）")
     return processed
@@ -193,6 +230,10 @@ def apply_knowledge_rules(contexts: list, chapter_num: int) -> list:
     """应用知识库使用规则"""
     processed = []
     for text in contexts:
+        # 检索阶段已按片段元数据处理过远近规则的内容直接保留
+        if _CONTENT_RULE_TAG.search(text):
+            processed.append(text)
+            continue
         # 检测历史章节内容
         if "第" in text and "章" in text:
             # 提取章节号判断时间远近
@@ -212,6 +253,32 @@ def apply_knowledge_rules(contexts: list, chapter_num: int) -> list:
             processed.append(f"[外部知识] {text}")
     return processed
 
+def format_knowledge_filter_prompt(chapter_info: dict, retrieved_texts: list) -> str:
+    """对检索结果应用知识库规则并构造 knowledge_filter_prompt"""
+    processed_texts = apply_knowledge_rules(retrieved_texts, chapter_info.get('chapter_number', 0))
+
+    # 限制检索文本长度并格式化
+    formatted_texts = []
+    max_text_length = 600
+    for i, text in enumerate(processed_texts, 1):
+        if len(text) > max_text_length:
+            text = text[:max_text_length] + "..."
+        formatted_texts.append(f"[预处理结果{i}]\n{text}")
+
+    # 使用格式化函数处理章节信息
+    formatted_chapter_info = (
+        f"当前章节定位：{chapter_info.get('chapter_role', '')}\n"
+        f"核心目标：{chapter_info.get('chapter_purpose', '')}\n"
+        f"关键要素：{chapter_info.get('characters_involved', '')} | "
+        f"{chapter_info.get('key_items', '')} | "
+        f"{chapter_info.get('scene_location', '')}"
+    )
+
+    return knowledge_filter_prompt.format(
+        chapter_info=formatted_chapter_info,
+        retrieved_texts="\n\n".join(formatted_texts) if formatted_texts else "（无检索结果）"
+    )
+
 def get_filtered_knowledge_context(
     api_key: str,
     base_url: str,
@@ -229,7 +296,6 @@ def get_filtered_knowledge_context(
         return "（无相关知识库内容）"
 
     try:
-        processed_texts = apply_knowledge_rules(retrieved_texts, chapter_info.get('chapter_number', 0))
         llm_adapter = create_llm_adapter(
             interface_format=interface_format,
             base_url=base_url,
@@ -239,30 +305,9 @@ def get_filtered_knowledge_context(
             max_tokens=max_tokens,
             timeout=timeout
         )
-        
-        # 限制检索文本长度并格式化
-        formatted_texts = []
-        max_text_length = 600
-        for i, text in enumerate(processed_texts, 1):
-            if len(text) > max_text_length:
-                text = text[:max_text_length] + "..."
-            formatted_texts.append(f"[预处理结果{i}]\n{text}")
-
-        # 使用格式化函数处理章节信息
-        formatted_chapter_info = (
-            f"当前章节定位：{chapter_info.get('chapter_role', '')}\n"
-            f"核心目标：{chapter_info.get('chapter_purpose', '')}\n"
-            f"关键要素：{chapter_info.get('characters_involved', '')} | "
-            f"{chapter_info.get('key_items', '')} | "
-            f"{chapter_info.get('scene_location', '')}"
-        )
 
-        prompt = knowledge_filter_prompt.format(
-            chapter_info=formatted_chapter_info,
-            retrieved_texts="\n\n".join(formatted_texts) if formatted_texts else "（无检索结果）"
-        )
-        
-        filtered_content = invoke_with_cleaning(llm_adapter, prompt)
+        prompt = format_knowledge_filter_prompt(chapter_info, retrieved_texts)
+        filtered_content = invoke_with_cleaning(llm_adapter, prompt, stage="knowledge_filter", cache_dir=filepath)
         return filtered_content if filtered_content else "（知识内容过滤失败）"
         
     except Exception as e:
@@ -333,9 +378,20 @@ def build_chapter_prompt(
     chapters_dir = os.path.join(filepath, "chapters")
     os.makedirs(chapters_dir, exist_ok=True)
 
+    # 稳定前缀布局：小说设定放在最前面，并按固定占比裁剪，使同一项目的前缀逐字节一致
+    stable_prefix = stable_prefix_enabled()
+    if stable_prefix:
+        novel_architecture_text = normalize_static_text(novel_architecture_text)
+
     # 第一章特殊处理
     if novel_number == 1:
-        return first_chapter_draft_prompt.format(
+        return format_with_budget(
+            first_chapter_draft_prompt_stable if stable_prefix else first_chapter_draft_prompt,
+            model_name,
+            max_tokens,
+            sections=[
+                PromptSection("novel_setting", novel_architecture_text, priority=1, keep="head")
+            ],
             novel_number=novel_number,
             word_number=word_number,
             chapter_title=chapter_title,
@@ -349,8 +405,7 @@ def build_chapter_prompt(
             key_items=key_items,
             scene_location=scene_location,
             time_constraint=time_constraint,
-            user_guidance=user_guidance,
-            novel_setting=novel_architecture_text
+            user_guidance=user_guidance
         )
 
     # 获取前文内容和摘要
@@ -369,7 +424,8 @@ def build_chapter_prompt(
             novel_number=novel_number,
             chapter_info=chapter_info,
             next_chapter_info=next_chapter_info,
-            timeout=timeout
+            timeout=timeout,
+            cache_dir=filepath
         )
         logging.info("Summary generated successfully")
     except Exception as e:
@@ -410,7 +466,7 @@ def build_chapter_prompt(
             time_constraint=time_constraint
         )
         
-        search_response = invoke_with_cleaning(llm_adapter, search_prompt)
+        search_response = invoke_with_cleaning(llm_adapter, search_prompt, stage="keyword_search", cache_dir=filepath)
         keyword_groups = parse_search_keywords(search_response)
 
         # 执行向量检索
@@ -424,17 +480,26 @@ def build_chapter_prompt(
         )
         
         store = load_vector_store(embedding_adapter, filepath)
-        if store:
+        if store and keyword_groups:
             collection_size = store._collection.count()
             actual_k = min(embedding_retrieval_k, max(1, collection_size))
-            
-            for group in keyword_groups:
-                context = get_relevant_context_from_vector_store(
-                    embedding_adapter=embedding_adapter,
-                    query=group,
-                    filepath=filepath,
-                    k=actual_k
+
+            # 所有关键词组一次嵌入、一次检索；近几章的片段由元数据条件直接排除
+            group_results = get_relevant_contexts_from_vector_store(
+                embedding_adapter=embedding_adapter,
+                queries=keyword_groups,
+                filepath=filepath,
+                k=actual_k * MMR_CANDIDATE_FACTOR,
+                where=exclude_recent_chapters_filter(novel_number, RECENT_CHAPTER_WINDOW),
+                with_embeddings=True
+            )
+            # 不同关键词组常检索到相同或高度重叠的片段，跨组去重后每组保留 actual_k 条
+            group_results = select_diverse_contexts(group_results, actual_k)
+            for group, results in zip(keyword_groups, group_results):
+                ruled = apply_content_rules(
+                    [text for text, _, _ in results], novel_number, [metadata for _, _, metadata in results]
                 )
+                context = combine_retrieved_texts(ruled)
                 if context:
                     if any(kw in group.lower() for kw in ["技法", "手法", "模板"]):
                         all_contexts.append(f"[TECHNIQUE] {context}")
@@ -443,8 +508,8 @@ def build_chapter_prompt(
                     else:
                         all_contexts.append(f"[GENERAL] {context}")
 
-        # 应用内容规则
-        processed_contexts = apply_content_rules(all_contexts, novel_number)
+        # 内容规则已在检索结果上按片段应用
+        processed_contexts = all_contexts
         
         # 执行知识过滤
         chapter_info_for_filter = {
@@ -479,13 +544,20 @@ def build_chapter_prompt(
         logging.error(f"知识处理流程异常：{str(e)}")
         filtered_context = "（知识库处理失败）"
 
-    # 返回最终提示词
-    return next_chapter_draft_prompt.format(
+    # 返回最终提示词（按 token 预算裁剪，优先级低的段落先被压缩）
+    sections = [
+        PromptSection("filtered_context", filtered_context, priority=1, keep="head", max_share=0.2),
+        PromptSection("global_summary", global_summary_text, priority=2, keep="tail", max_share=0.35),
+        PromptSection("character_state", character_state_text, priority=3, keep="head", max_share=0.25),
+        PromptSection("previous_chapter_excerpt", previous_excerpt, priority=4, keep="tail", max_share=0.1),
+        PromptSection("short_summary", short_summary, priority=5, keep="head", max_share=0.1)
+    ]
+    return format_with_budget(
+        next_chapter_draft_prompt_stable if stable_prefix else next_chapter_draft_prompt,
+        model_name,
+        max_tokens,
+        sections=sections,
         user_guidance=user_guidance if user_guidance else "无特殊指导",
-        global_summary=global_summary_text,
-        previous_chapter_excerpt=previous_excerpt,
-        character_state=character_state_text,
-        short_summary=short_summary,
         novel_number=novel_number,
         chapter_title=chapter_title,
         chapter_role=chapter_role,
@@ -506,10 +578,37 @@ def build_chapter_prompt(
         next_chapter_suspense_level=next_chapter_suspense,
         next_chapter_foreshadowing=next_chapter_foreshadow,
         next_chapter_plot_twist_level=next_chapter_twist,
-        next_chapter_summary=next_chapter_summary,
-        filtered_context=filtered_context
+        next_chapter_summary=next_chapter_summary
+    )
+
+# 续写请求附带的已写正文末尾字数
+CONTINUATION_TAIL_CHARS = 1200
+# 单章最多续写次数
+MAX_DRAFT_CONTINUATIONS = 3
+# 拼接时查找续写开头与已写末尾重复内容的最大长度
+MAX_STITCH_OVERLAP = 200
+
+def format_continuation_prompt(novel_number: int, word_number: int, draft_text: str) -> str:
+    """已写正文因长度限制被截断时，只带上末尾一段上下文请求续写"""
+    return chapter_continuation_prompt.format(
+        novel_number=novel_number,
+        word_number=word_number,
+        written_number=len(draft_text),
+        draft_tail=draft_text[-CONTINUATION_TAIL_CHARS:]
     )
 
+def stitch_continuation(draft_text: str, continuation: str) -> str:
+    """
+    返回续写中需要追加到 draft_text 之后的部分：去掉续写开头与已写末尾重复的内容。
+    续写以换行开头（从新段落接着写）且没有重复内容时，保留开头的换行。
+    """
+    body = continuation.lstrip()
+    lead = continuation[:len(continuation) - len(body)]
+    for size in range(min(len(draft_text), len(body), MAX_STITCH_OVERLAP), 0, -1):
+        if draft_text.endswith(body[:size]):
+            return body[size:]
+    return lead + body
+
 def generate_chapter_draft(
     api_key: str,
     base_url: str,
@@ -531,10 +630,15 @@ def generate_chapter_draft(
     interface_format: str = "openai",
     max_tokens: int = 2048,
     timeout: int = 600,
-    custom_prompt_text: str = None
+    custom_prompt_text: str = None,
+    on_chunk=None
 ) -> str:
     """
-    生成章节草稿，支持自定义提示词
+    生成章节草稿，支持自定义提示词。
+    以流式方式生成，每收到一段内容就追加写入 chapter_N.txt，
+    若提供 on_chunk 回调，也会将每段内容传给它（如用于界面实时显示）。
+    输出因 max_tokens 被截断（finish_reason 为 "length"）时，只带上末尾一段正文请求续写并拼接，
+    最多续写 MAX_DRAFT_CONTINUATIONS 次。
     """
     if custom_prompt_text is None:
         prompt_text = build_chapter_prompt(
@@ -575,11 +679,54 @@ def generate_chapter_draft(
         timeout=timeout
     )
 
-    chapter_content = invoke_with_cleaning(llm_adapter, prompt_text)
+    chapter_file = os.path.join(chapters_dir, f"chapter_{novel_number}.txt")
+    chunks = []
+    chapter_fp = None
+    result_info = {}
+
+    def emit(chunk: str):
+        nonlocal chapter_fp
+        if not chunk:
+            return
+        # 收到首段内容后才覆盖旧文件，避免请求失败时丢失已有草稿
+        if chapter_fp is None:
+            chapter_fp = open(chapter_file, 'w', encoding='utf-8')
+        chapter_fp.write(chunk)
+        chapter_fp.flush()
+        chunks.append(chunk)
+        if on_chunk:
+            on_chunk(chunk)
+
+    try:
+        for chunk in invoke_stream_with_cleaning(llm_adapter, prompt_text, stage="draft", cache_dir=filepath, result_info=result_info):
+            emit(chunk)
+
+        continuations = 0
+        while chunks and result_info.get("finish_reason") == "length" and continuations < MAX_DRAFT_CONTINUATIONS:
+            continuations += 1
+            draft_text = "".join(chunks)
+            logging.info(f"[Draft] Chapter {novel_number} was truncated at {len(draft_text)} chars, requesting continuation {continuations}.")
+            continuation_prompt = format_continuation_prompt(novel_number, word_number, draft_text)
+            # 续写开头先攒够 MAX_STITCH_OVERLAP 字，去掉与已写末尾重复的部分后再输出
+            head = ""
+            stitched = False
+            for chunk in invoke_stream_with_cleaning(llm_adapter, continuation_prompt, stage="draft_continuation", cache_dir=filepath, result_info=result_info, keep_leading_newlines=True):
+                if stitched:
+                    emit(chunk)
+                    continue
+                head += chunk
+                if len(head) >= MAX_STITCH_OVERLAP:
+                    emit(stitch_continuation(draft_text, head))
+                    stitched = True
+            if not stitched:
+                emit(stitch_continuation(draft_text, head))
+        if result_info.get("finish_reason") == "length":
+            logging.warning(f"[Draft] Chapter {novel_number} is still truncated after {continuations} continuations.")
+    finally:
+        if chapter_fp is not None:
+            chapter_fp.close()
+    chapter_content = "".join(chunks)
     if not chapter_content.strip():
         logging.warning("Generated chapter draft is empty.")
-    chapter_file = os.path.join(chapters_dir, f"chapter_{novel_number}.txt")
-    clear_file_content(chapter_file)
-    save_string_to_txt(chapter_content, chapter_file)
     logging.info(f"[Draft] Chapter {novel_number} generated as a draft.")
     return chapter_content
@@ -3,32 +3,150 @@
 """
 通用重试、清洗、日志工具
 """
+import asyncio
+import email.utils
 import logging
+import random
 import re
 import time
-import traceback
+from typing import Optional
+from novel_generator.llm_cache import LLMResponseCache, get_stage_cache, log_cache_event
+from novel_generator.batch import active_batch
+from llm_metrics import call_scope, last_finish_reason, record_coalesced
+from single_flight import SingleFlight
 
-def call_with_retry(func, max_retries=3, sleep_time=2, fallback_return=None, **kwargs):
+_retry_settings = {
+    "max_retries": 3,
+    "base_delay": 2.0,
+    "max_delay": 60.0,
+    "max_elapsed": 900.0
+}
+
+# 可重试：请求超时、冲突、限流与服务端错误；其余 4xx（鉴权失败、模型不存在、参数错误等）重试也无济于事
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429}
+FATAL_ERROR_MARKERS = ("invalid_api_key", "model_not_found", "authentication", "unauthorized", "permission denied")
+
+_llm_flight = SingleFlight("llm")
+
+class EmptyResponseError(Exception):
+    """LLM 返回了空内容，按可重试错误处理"""
+
+def get_status_code(error: Exception) -> Optional[int]:
+    """从 openai / requests / httpx / azure / genai 等库的异常中取出 HTTP 状态码"""
+    for value in (
+        getattr(error, "status_code", None),
+        getattr(getattr(error, "response", None), "status_code", None),
+        getattr(error, "code", None),
+    ):
+        if isinstance(value, int) and 100 <= value < 600:
+            return value
+    return None
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """读取异常所带响应中的 Retry-After / retry-after-ms 头，返回需等待的秒数"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        retry_after_ms = headers.get("retry-after-ms")
+        if retry_after_ms:
+            return max(float(retry_after_ms) / 1000.0, 0.0)
+        retry_after = headers.get("retry-after")
+        if not retry_after:
+            return None
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            # HTTP-date 格式
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+            return max(retry_at.timestamp() - time.time(), 0.0)
+    except Exception:
+        return None
+
+def is_retryable_error(error: Exception) -> bool:
+    if isinstance(error, EmptyResponseError):
+        return True
+    status = get_status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES or status >= 500
+    if isinstance(error, (TimeoutError, ConnectionError, asyncio.TimeoutError)):
+        return True
+    name = type(error).__name__.lower()
+    if "timeout" in name or "connect" in name:
+        return True
+    message = str(error).lower()
+    if any(marker in message for marker in FATAL_ERROR_MARKERS):
+        return False
+    # 无法识别的错误保持以往行为，按可重试处理
+    return True
+
+class RetryPolicy:
+    """
+    重试策略：指数退避 + 完全抖动（full jitter），并限制总耗时。
+    服务端返回 Retry-After 时至少等待其指定的时间；不可重试的错误立即放弃。
+    未指定的参数取 config.json 中 "retry" 的配置。
+    """
+    def __init__(self, max_retries: int = None, base_delay: float = None, max_delay: float = None, max_elapsed: float = None):
+        self.max_retries = int(max_retries if max_retries is not None else _retry_settings["max_retries"])
+        self.base_delay = float(base_delay if base_delay is not None else _retry_settings["base_delay"])
+        self.max_delay = float(max_delay if max_delay is not None else _retry_settings["max_delay"])
+        self.max_elapsed = float(max_elapsed if max_elapsed is not None else _retry_settings["max_elapsed"])
+
+    def next_delay(self, attempt: int, error: Exception, started: float) -> Optional[float]:
+        """
+        第 attempt 次尝试失败后应等待的秒数；不应再重试时返回 None。
+        :param started: 首次尝试开始时的 time.monotonic()
+        """
+        if attempt >= self.max_retries or not is_retryable_error(error):
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        if self.max_elapsed and time.monotonic() - started + delay > self.max_elapsed:
+            logging.warning(f"[RetryPolicy] Giving up: next retry would exceed {self.max_elapsed:.0f}s in total.")
+            return None
+        logging.info(
+            f"[RetryPolicy] Attempt {attempt}/{self.max_retries} failed ({type(error).__name__}: {error}), "
+            f"retrying in {delay:.2f}s" + (f" (Retry-After={retry_after:.2f}s)" if retry_after is not None else "")
+        )
+        return delay
+
+def configure_retry_policy(settings: dict):
+    """
+    根据 config.json 中的 "retry" 配置调整默认重试策略，例如：
+    {"max_retries": 5, "base_delay": 2, "max_delay": 60, "max_elapsed": 900}
+    """
+    for key, value in (settings or {}).items():
+        if key in _retry_settings:
+            _retry_settings[key] = value
+
+def call_with_retry(func, max_retries=None, sleep_time=None, fallback_return=None, policy: RetryPolicy = None, **kwargs):
     """
     通用的重试机制封装。
     :param func: 要执行的函数
-    :param max_retries: 最大重试次数
-    :param sleep_time: 重试前的等待秒数
+    :param max_retries: 最大尝试次数，None 时取 config.json 的 retry.max_retries
+    :param sleep_time: 首次重试前的基础等待秒数，之后按指数退避；None 时取 retry.base_delay
     :param fallback_return: 如果多次重试仍失败时的返回值
+    :param policy: 自定义重试策略，指定时忽略 max_retries 与 sleep_time
     :param kwargs: 传给func的命名参数
     :return: func的结果，若失败则返回 fallback_return
     """
-    for attempt in range(1, max_retries + 1):
+    policy = policy or RetryPolicy(max_retries=max_retries, base_delay=sleep_time)
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
         try:
             return func(**kwargs)
         except Exception as e:
             logging.warning(f"[call_with_retry] Attempt {attempt} failed with error: {e}")
-            traceback.print_exc()
-            if attempt < max_retries:
-                time.sleep(sleep_time)
-            else:
-                logging.error("Max retries reached, returning fallback_return.")
+            logging.debug("[call_with_retry] Traceback:", exc_info=True)
+            delay = policy.next_delay(attempt, e, started)
+            if delay is None:
+                logging.error("Retry gave up, returning fallback_return.")
                 return fallback_return
+            time.sleep(delay)
 
 def remove_think_tags(text: str) -> str:
     """移除 <think>...</think> 包裹的内容"""
@@ -42,20 +160,100 @@ def debug_log(prompt: str, response_content: str):
         f"\n[######################################### Response #########################################]\n{response_content}\n"
     )
 
-def invoke_with_cleaning(llm_adapter, prompt: str, max_retries: int = 3) -> str:
-    """调用 LLM 并清理返回结果"""
+def _lookup_cache(llm_adapter, prompt: str, stage: str, cache_dir: str):
+    """返回 (cache, key, cached_result)；该阶段未启用缓存时 cache 为 None"""
+    cache = get_stage_cache(stage, cache_dir)
+    if cache is None:
+        return None, None, None
+    key = cache.make_key(llm_adapter, prompt)
+    cached = cache.get(key)
+    log_cache_event(cache, stage, cached is not None)
+    return cache, key, cached
+
+def _resolve_batch(llm_adapter, prompt: str, stage: str, cache, cache_key) -> Optional[str]:
+    """
+    处于批处理上下文（novel_generator.batch.run_batch）时返回该提示词清理后的批处理结果，否则返回 None。
+    结果尚未就绪时由 BatchJob.resolve 抛出 BatchDeferred。
+    """
+    job = active_batch()
+    if job is None:
+        return None
+    result = job.resolve(llm_adapter, prompt, stage).replace("```", "").strip()
+    if result and cache is not None:
+        cache.put(cache_key, result)
+    return result
+
+def _set_finish_reason(result_info: Optional[dict], finish_reason: Optional[str]):
+    if result_info is not None:
+        result_info["finish_reason"] = finish_reason
+
+def _cache_complete(cache, cache_key, result: str, finish_reason: Optional[str]):
+    # 因长度限制被截断的结果不缓存，否则命中缓存后无法得知需要续写
+    if cache is not None and finish_reason != "length":
+        cache.put(cache_key, result)
+
+def _flight_key(llm_adapter, prompt: str) -> str:
+    """在途合并的请求键：与响应缓存相同的 (适配器, 模型, 参数, 提示词) 哈希，提示词去除首尾空白"""
+    return LLMResponseCache.make_key(llm_adapter, prompt.strip())
+
+def _coalesced_recorder(llm_adapter, stage: str, cache_dir: str):
+    def record(waited: float):
+        with call_scope(stage, cache_dir):
+            record_coalesced(llm_adapter.provider, getattr(llm_adapter, "model_name", ""), waited)
+    return record
+
+def _strip_head(text: str, keep_leading_newlines: bool) -> str:
+    """去掉开头空白；keep_leading_newlines 为 True 时保留从第一个换行起的空白（续写以新段落开头时不与上文粘连）"""
+    stripped = text.lstrip()
+    if not keep_leading_newlines or not stripped:
+        return stripped
+    lead = text[:len(text) - len(stripped)].replace("\r\n", "\n")
+    if "\n" not in lead:
+        return stripped
+    return lead[lead.index("\n"):] + stripped
+
+def invoke_with_cleaning(llm_adapter, prompt: str, max_retries: int = None, stage: str = "", cache_dir: str = "", result_info: dict = None, keep_leading_newlines: bool = False) -> str:
+    """
+    调用 LLM 并清理返回结果。
+    stage 为调用阶段名，cache_dir 为项目目录；该阶段启用了响应缓存时，命中则直接返回缓存内容。
+    相同请求已在进行时等待其结果而不重复调用。
+    result_info 为字典时写入 "finish_reason"（"stop" / "length" 等，缓存命中或后端未提供时为 None）。
+    keep_leading_newlines 为 True 时保留结果开头的换行（用于续写拼接）。
+    """
     print("\n" + "="*50)
     print("发送到 LLM 的提示词:")
     print("-"*50)
     print(prompt)
     print("="*50 + "\n")
-    
-    result = ""
-    retry_count = 0
-    
-    while retry_count < max_retries:
+
+    _set_finish_reason(result_info, None)
+    cache, cache_key, cached = _lookup_cache(llm_adapter, prompt, stage, cache_dir)
+    if cached is not None:
+        return cached
+    batch_result = _resolve_batch(llm_adapter, prompt, stage, cache, cache_key)
+    if batch_result is not None:
+        return batch_result
+
+    # 相同请求正在进行时（界面重复触发、多个项目共用同一提示词等）等待其结果，不重复调用
+    result, finish_reason = _llm_flight.do(
+        _flight_key(llm_adapter, prompt),
+        lambda: _invoke_with_retry(llm_adapter, prompt, max_retries, stage, cache_dir, cache, cache_key, keep_leading_newlines),
+        on_coalesced=_coalesced_recorder(llm_adapter, stage, cache_dir)
+    )
+    _set_finish_reason(result_info, finish_reason)
+    return result
+
+def _invoke_with_retry(llm_adapter, prompt: str, max_retries: int, stage: str, cache_dir: str, cache, cache_key, keep_leading_newlines: bool = False) -> tuple:
+    """返回 (清理后的结果, finish_reason)"""
+    policy = RetryPolicy(max_retries=max_retries)
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        calls = []
         try:
-            result = llm_adapter.invoke(prompt)
+            with call_scope(stage, cache_dir, attempt, calls):
+                result = llm_adapter.invoke(prompt)
             print("\n" + "="*50)
             print("LLM 返回的内容:")
             print("-"*50)
@@ -63,15 +261,158 @@ def invoke_with_cleaning(llm_adapter, prompt: str, max_retries: int = 3) -> str:
             print("="*50 + "\n")
             
             # 清理结果中的特殊格式标记
-            result = result.replace("```", "").strip()
+            result = _strip_head(result.replace("```", "").rstrip(), keep_leading_newlines)
             if result:
-                return result
-            retry_count += 1
+                finish_reason = last_finish_reason(calls)
+                _cache_complete(cache, cache_key, result, finish_reason)
+                return result, finish_reason
+            error = EmptyResponseError("LLM returned an empty response.")
         except Exception as e:
-            print(f"调用失败 ({retry_count + 1}/{max_retries}): {str(e)}")
-            retry_count += 1
-            if retry_count >= max_retries:
-                raise e
-    
+            print(f"调用失败 ({attempt}/{policy.max_retries}): {str(e)}")
+            error = e
+        delay = policy.next_delay(attempt, error, started)
+        if delay is None:
+            if isinstance(error, EmptyResponseError):
+                return "", None
+            raise error
+        time.sleep(delay)
+
+async def ainvoke_with_cleaning(llm_adapter, prompt: str, max_retries: int = None, stage: str = "", cache_dir: str = "", result_info: dict = None, keep_leading_newlines: bool = False) -> str:
+    """invoke_with_cleaning 的异步版本，使用适配器的 ainvoke"""
+    logging.debug(f"[ainvoke_with_cleaning] Prompt:\n{prompt}")
+    _set_finish_reason(result_info, None)
+    cache, cache_key, cached = _lookup_cache(llm_adapter, prompt, stage, cache_dir)
+    if cached is not None:
+        return cached
+    batch_result = _resolve_batch(llm_adapter, prompt, stage, cache, cache_key)
+    if batch_result is not None:
+        return batch_result
+
+    result, finish_reason = await _llm_flight.ado(
+        _flight_key(llm_adapter, prompt),
+        lambda: _ainvoke_with_retry(llm_adapter, prompt, max_retries, stage, cache_dir, cache, cache_key, keep_leading_newlines),
+        on_coalesced=_coalesced_recorder(llm_adapter, stage, cache_dir)
+    )
+    _set_finish_reason(result_info, finish_reason)
     return result
 
+async def _ainvoke_with_retry(llm_adapter, prompt: str, max_retries: int, stage: str, cache_dir: str, cache, cache_key, keep_leading_newlines: bool = False) -> tuple:
+    policy = RetryPolicy(max_retries=max_retries)
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        calls = []
+        try:
+            with call_scope(stage, cache_dir, attempt, calls):
+                result = await llm_adapter.ainvoke(prompt)
+            logging.debug(f"[ainvoke_with_cleaning] Response:\n{result}")
+            result = _strip_head(result.replace("```", "").rstrip(), keep_leading_newlines)
+            if result:
+                finish_reason = last_finish_reason(calls)
+                _cache_complete(cache, cache_key, result, finish_reason)
+                return result, finish_reason
+            error = EmptyResponseError("LLM returned an empty response.")
+        except Exception as e:
+            logging.warning(f"[ainvoke_with_cleaning] 调用失败 ({attempt}/{policy.max_retries}): {str(e)}")
+            error = e
+        delay = policy.next_delay(attempt, error, started)
+        if delay is None:
+            if isinstance(error, EmptyResponseError):
+                return "", None
+            raise error
+        await asyncio.sleep(delay)
+
+def _iter_in_scope(iterator, stage: str, project_dir: str, attempt: int, observer: list = None):
+    """每次从 iterator 取下一块时都处于 call_scope 的上下文中，yield 给调用方时不泄漏该上下文"""
+    try:
+        while True:
+            with call_scope(stage, project_dir, attempt, observer):
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    return
+            yield chunk
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+
+def invoke_stream_with_cleaning(llm_adapter, prompt: str, max_retries: int = None, stage: str = "", cache_dir: str = "", result_info: dict = None, keep_leading_newlines: bool = False):
+    """
+    流式调用 LLM，逐块 yield 清理后的文本。
+    清理规则与 invoke_with_cleaning 一致（去掉 ``` 并去除首尾空白），
+    为此会暂存块尾的反引号与空白，直到后续内容到达再决定是否输出。
+    只有在尚未输出任何内容时才会重试。缓存命中时一次性 yield 缓存内容。
+    result_info、keep_leading_newlines 的含义同 invoke_with_cleaning，result_info 在流结束后写入。
+    """
+    print("\n" + "="*50)
+    print("发送到 LLM 的提示词:")
+    print("-"*50)
+    print(prompt)
+    print("="*50 + "\n")
+
+    _set_finish_reason(result_info, None)
+    cache, cache_key, cached = _lookup_cache(llm_adapter, prompt, stage, cache_dir)
+    if cached is not None:
+        yield cached
+        return
+    batch_result = _resolve_batch(llm_adapter, prompt, stage, cache, cache_key)
+    if batch_result is not None:
+        if batch_result:
+            yield batch_result
+        return
+
+    policy = RetryPolicy(max_retries=max_retries)
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        emitted = False
+        pending = ""
+        parts = []
+        calls = []
+        try:
+            print("\n" + "="*50)
+            print("LLM 返回的内容(流式):")
+            print("-"*50)
+            for chunk in _iter_in_scope(llm_adapter.invoke_stream(prompt), stage, cache_dir, attempt, calls):
+                if not chunk:
+                    continue
+                print(chunk, end="", flush=True)
+                pending = (pending + chunk).replace("```", "")
+                cut = len(pending.rstrip("` \t\r\n"))
+                out, pending = pending[:cut], pending[cut:]
+                if not emitted:
+                    out = _strip_head(out, keep_leading_newlines)
+                if out:
+                    emitted = True
+                    parts.append(out)
+                    yield out
+            print("\n" + "="*50 + "\n")
+
+            tail = pending.rstrip()
+            if not emitted:
+                tail = _strip_head(tail, keep_leading_newlines)
+            if tail:
+                emitted = True
+                parts.append(tail)
+                yield tail
+            if emitted:
+                finish_reason = last_finish_reason(calls)
+                _set_finish_reason(result_info, finish_reason)
+                _cache_complete(cache, cache_key, "".join(parts), finish_reason)
+                return
+            error = EmptyResponseError("LLM returned an empty response.")
+        except Exception as e:
+            print(f"流式调用失败 ({attempt}/{policy.max_retries}): {str(e)}")
+            # 已经输出的内容无法撤回，不能再重试
+            if emitted:
+                raise e
+            error = e
+        delay = policy.next_delay(attempt, error, started)
+        if delay is None:
+            if isinstance(error, EmptyResponseError):
+                return
+            raise error
+        time.sleep(delay)
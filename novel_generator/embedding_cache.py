@@ -0,0 +1,252 @@
+# novel_generator/embedding_cache.py
+# -*- coding: utf-8 -*-
+"""
+Embedding 向量的本地持久缓存（存放在项目的 vectorstore/embedding_cache 目录下）
+键为 (Embedding 接口格式, model_name, 规范化文本的 sha256)；
+向量按维度分别存放在内存映射的 float16（或 float32）数组文件中，SQLite 只保存键到行号的索引，
+按总大小做 LRU 淘汰，被淘汰的行号留给后续写入复用。
+重复导入知识文件、重新定稿章节、重复的检索关键词都不必再次请求 Embedding 接口。
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import List, Optional
+
+import numpy as np
+
+EMBEDDING_CACHE_DIRNAME = "embedding_cache"
+EMBEDDING_CACHE_INDEX = "index.sqlite3"
+DEFAULT_MAX_CACHE_MB = 256
+
+# SQLite 单条语句的参数个数有上限，批量查询按此分组
+_SQL_CHUNK = 500
+
+_cache_settings = {
+    "enabled": True,
+    "max_bytes": DEFAULT_MAX_CACHE_MB * 1024 * 1024,
+    "dtype": "float16"
+}
+_caches = {}
+_caches_lock = threading.Lock()
+
+def normalize_text(text: str) -> str:
+    """Unicode NFC 规范化，去掉首尾空白并把连续空白合并为一个空格"""
+    return " ".join(unicodedata.normalize("NFC", str(text)).split())
+
+class EmbeddingCache:
+    """内存映射数组 + SQLite 索引的向量缓存，线程安全"""
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_CACHE_MB * 1024 * 1024, dtype: str = "float16"):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._arrays = {}
+        self._conn = sqlite3.connect(os.path.join(cache_dir, EMBEDDING_CACHE_INDEX), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache ("
+            "key TEXT PRIMARY KEY, dim INTEGER NOT NULL, slot INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embedding_cache_access ON embedding_cache(last_access)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS free_slots (dim INTEGER NOT NULL, slot INTEGER NOT NULL, PRIMARY KEY (dim, slot))"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        # 数组文件的精度在创建时确定，之后修改配置只影响新建的缓存
+        row = self._conn.execute("SELECT value FROM meta WHERE name = 'dtype'").fetchone()
+        if row is None:
+            self._conn.execute("INSERT INTO meta (name, value) VALUES ('dtype', ?)", (np.dtype(dtype).name,))
+            row = (np.dtype(dtype).name,)
+        self._conn.commit()
+        self.dtype = np.dtype(row[0])
+
+    @staticmethod
+    def make_key(interface_format: str, model_name: str, text: str) -> str:
+        digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+        raw = json.dumps([(interface_format or "").strip().lower(), model_name or "", digest])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _vector_path(self, dim: int) -> str:
+        return os.path.join(self.cache_dir, f"vectors_{dim}d.{self.dtype.name}")
+
+    def _array(self, dim: int, min_rows: int = 0):
+        """dim 维的内存映射数组，行数不足 min_rows 时扩容（按倍数增长）；文件不存在且无需写入时返回 None"""
+        array = self._arrays.get(dim)
+        if array is not None and array.shape[0] >= max(min_rows, 1):
+            return array
+        path = self._vector_path(dim)
+        row_bytes = self.dtype.itemsize * dim
+        rows = os.path.getsize(path) // row_bytes if os.path.exists(path) else 0
+        if rows < min_rows:
+            rows = max(min_rows, rows * 2, 1024)
+            if array is not None:
+                array.flush()
+            with open(path, "ab") as f:
+                f.truncate(rows * row_bytes)
+        if rows == 0:
+            return None
+        array = np.memmap(path, dtype=self.dtype, mode="r+", shape=(rows, dim))
+        self._arrays[dim] = array
+        return array
+
+    def get_many(self, keys: List[str]) -> List[Optional[List[float]]]:
+        """按 keys 顺序返回向量，未命中的位置为 None"""
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), _SQL_CHUNK):
+                chunk = keys[start:start + _SQL_CHUNK]
+                rows = self._conn.execute(
+                    f"SELECT key, dim, slot FROM embedding_cache WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, dim, slot in rows:
+                    array = self._array(dim)
+                    if array is not None and slot < array.shape[0]:
+                        found[key] = array[slot].astype(np.float32).tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embedding_cache SET last_access = ? WHERE key = ?", [(now, key) for key in found]
+                )
+                self._conn.commit()
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return [found.get(key) for key in keys]
+
+    def put_many(self, keys: List[str], vectors: List[List[float]]):
+        """写入向量；空向量或含非有限值（超出 float16 范围等）的向量不缓存"""
+        with self._lock:
+            now = time.time()
+            for key, vector in zip(keys, vectors):
+                if not vector:
+                    continue
+                values = np.asarray(vector, dtype=self.dtype)
+                if values.ndim != 1 or not np.all(np.isfinite(values)):
+                    continue
+                dim = values.shape[0]
+                row = self._conn.execute("SELECT dim, slot FROM embedding_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None and row[0] == dim:
+                    slot = row[1]
+                else:
+                    if row is not None:
+                        self._release(key, *row)
+                    slot = self._allocate(dim)
+                self._array(dim, slot + 1)[slot] = values
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO embedding_cache (key, dim, slot, last_access) VALUES (?, ?, ?, ?)",
+                    (key, dim, slot, now)
+                )
+            for array in self._arrays.values():
+                array.flush()
+            self._evict()
+            self._conn.commit()
+
+    def _allocate(self, dim: int) -> int:
+        """优先复用被淘汰的行号，否则追加到末尾"""
+        row = self._conn.execute("SELECT slot FROM free_slots WHERE dim = ? ORDER BY slot LIMIT 1", (dim,)).fetchone()
+        if row is not None:
+            self._conn.execute("DELETE FROM free_slots WHERE dim = ? AND slot = ?", (dim, row[0]))
+            return row[0]
+        used = self._conn.execute("SELECT COALESCE(MAX(slot) + 1, 0) FROM embedding_cache WHERE dim = ?", (dim,)).fetchone()[0]
+        freed = self._conn.execute("SELECT COALESCE(MAX(slot) + 1, 0) FROM free_slots WHERE dim = ?", (dim,)).fetchone()[0]
+        return max(used, freed)
+
+    def _release(self, key: str, dim: int, slot: int):
+        self._conn.execute("DELETE FROM embedding_cache WHERE key = ?", (key,))
+        self._conn.execute("INSERT OR IGNORE INTO free_slots (dim, slot) VALUES (?, ?)", (dim, slot))
+
+    def _evict(self):
+        """向量总大小超过上限时，按最近访问时间从旧到新淘汰；数组文件不缩小，空出的行留待复用"""
+        total = self._conn.execute("SELECT COALESCE(SUM(dim), 0) FROM embedding_cache").fetchone()[0] * self.dtype.itemsize
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT key, dim, slot FROM embedding_cache ORDER BY last_access ASC").fetchall()
+        evicted = 0
+        for key, dim, slot in rows:
+            if total <= self.max_bytes:
+                break
+            self._release(key, dim, slot)
+            total -= dim * self.dtype.itemsize
+            evicted += 1
+        logging.info(f"[EmbeddingCache] Evicted {evicted} vectors, size now {total} bytes.")
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, dims = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(dim), 0) FROM embedding_cache").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": count,
+            "bytes": dims * self.dtype.itemsize
+        }
+
+def configure_embedding_cache(settings: dict):
+    """
+    根据 config.json 中的 "embedding_cache" 配置调整缓存行为，例如：
+    {"enabled": true, "max_mb": 512, "dtype": "float32"}
+    """
+    settings = settings or {}
+    if "enabled" in settings:
+        _cache_settings["enabled"] = bool(settings["enabled"])
+    if "dtype" in settings:
+        _cache_settings["dtype"] = np.dtype(settings["dtype"]).name
+    if "max_mb" in settings:
+        _cache_settings["max_bytes"] = int(float(settings["max_mb"]) * 1024 * 1024)
+        with _caches_lock:
+            for cache in _caches.values():
+                cache.max_bytes = _cache_settings["max_bytes"]
+
+def get_embedding_cache(store_dir: str) -> Optional[EmbeddingCache]:
+    """获取向量库目录 store_dir 对应的缓存实例；缓存关闭或打开失败时返回 None"""
+    if not _cache_settings["enabled"] or not store_dir:
+        return None
+    cache_dir = os.path.abspath(os.path.join(store_dir, EMBEDDING_CACHE_DIRNAME))
+    with _caches_lock:
+        cache = _caches.get(cache_dir)
+        if cache is None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                cache = EmbeddingCache(cache_dir, _cache_settings["max_bytes"], _cache_settings["dtype"])
+            except Exception as e:
+                logging.warning(f"[EmbeddingCache] Failed to open cache at {cache_dir}: {e}")
+                return None
+            _caches[cache_dir] = cache
+        return cache
+
+def cached_embed(cache: Optional[EmbeddingCache], embedding_adapter, texts: List[str], embed_func) -> List[List[float]]:
+    """
+    先查缓存，只把未命中的文本（同一批内去重）交给 embed_func(texts) 请求接口，再写回缓存。
+    embed_func 失败返回空列表或条数不符时原样返回其结果，由调用方按失败处理。
+    """
+    if cache is None or not texts:
+        return embed_func(texts)
+    interface_format = getattr(embedding_adapter, "provider", "") or type(embedding_adapter).__name__
+    model_name = getattr(embedding_adapter, "model_name", "")
+    keys = [cache.make_key(interface_format, model_name, t) for t in texts]
+    vectors = cache.get_many(keys)
+    pending = {}
+    for i, (key, vector) in enumerate(zip(keys, vectors)):
+        if vector is None:
+            pending.setdefault(key, []).append(i)
+    if pending:
+        missing_keys = list(pending)
+        result = embed_func([texts[pending[key][0]] for key in missing_keys])
+        if not result or len(result) != len(missing_keys):
+            return result
+        cache.put_many(missing_keys, result)
+        for key, vector in zip(missing_keys, result):
+            for i in pending[key]:
+                vectors[i] = vector
+    stats = cache.stats()
+    logging.info(
+        f"[EmbeddingCache] {len(texts) - sum(len(v) for v in pending.values())}/{len(texts)} cached "
+        f"(hits={stats['hits']}, misses={stats['misses']}, hit_rate={stats['hit_rate']})"
+    )
+    return vectors
@@ -10,8 +10,21 @@ from embedding_adapters import create_embedding_adapter
 from prompt_definitions import summary_prompt, update_character_state_prompt
 from novel_generator.common import invoke_with_cleaning
 from utils import read_file, clear_file_content, save_string_to_txt
+from novel_generator.prompt_budget import PromptSection, format_with_budget
 from novel_generator.vectorstore_utils import update_vector_store
 
+def format_summary_prompt(chapter_text: str, global_summary: str, model_name: str, max_tokens: int) -> str:
+    """在 token 预算内构造 summary_prompt，超出时优先裁剪旧摘要的较早部分"""
+    return format_with_budget(
+        summary_prompt,
+        model_name,
+        max_tokens,
+        sections=[
+            PromptSection("global_summary", global_summary, priority=1, keep="tail"),
+            PromptSection("chapter_text", chapter_text, priority=2, keep="head")
+        ]
+    )
+
 def finalize_chapter(
     novel_number: int,
     word_number: int,
@@ -54,11 +67,8 @@ def finalize_chapter(
         timeout=timeout
     )
 
-    prompt_summary = summary_prompt.format(
-        chapter_text=chapter_text,
-        global_summary=old_global_summary
-    )
-    new_global_summary = invoke_with_cleaning(llm_adapter, prompt_summary)
+    prompt_summary = format_summary_prompt(chapter_text, old_global_summary, model_name, max_tokens)
+    new_global_summary = invoke_with_cleaning(llm_adapter, prompt_summary, stage="finalize_summary", cache_dir=filepath)
     if not new_global_summary.strip():
         new_global_summary = old_global_summary
 
@@ -66,7 +76,7 @@ def finalize_chapter(
         chapter_text=chapter_text,
         old_state=old_character_state
     )
-    new_char_state = invoke_with_cleaning(llm_adapter, prompt_char_state)
+    new_char_state = invoke_with_cleaning(llm_adapter, prompt_char_state, stage="char_state", cache_dir=filepath)
     if not new_char_state.strip():
         new_char_state = old_character_state
 
@@ -83,11 +93,18 @@ def finalize_chapter(
             embedding_model_name
         ),
         new_chapter=chapter_text,
-        filepath=filepath
+        filepath=filepath,
+        chapter_number=novel_number
     )
 
     logging.info(f"Chapter {novel_number} has been finalized.")
 
+def format_enrich_prompt(chapter_text: str, word_number: int) -> str:
+    return f"""以下章节文本较短，请在保持剧情连贯的前提下进行扩写，使其更充实，接近 {word_number} 字左右：
+原内容：
+{chapter_text}
+"""
+
 def enrich_chapter_text(
     chapter_text: str,
     word_number: int,
@@ -111,9 +128,6 @@ def enrich_chapter_text(
         max_tokens=max_tokens,
         timeout=timeout
     )
-    prompt = f"""以下章节文本较短，请在保持剧情连贯的前提下进行扩写，使其更充实，接近 {word_number} 字左右：
-原内容：
-{chapter_text}
-"""
-    enriched_text = invoke_with_cleaning(llm_adapter, prompt)
+    prompt = format_enrich_prompt(chapter_text, word_number)
+    enriched_text = invoke_with_cleaning(llm_adapter, prompt, stage="enrich")
     return enriched_text if enriched_text else chapter_text
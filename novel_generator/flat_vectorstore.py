@@ -0,0 +1,392 @@
+# novel_generator/flat_vectorstore.py
+# -*- coding: utf-8 -*-
+"""
+不依赖 Chroma 的轻量向量库（存放在项目的 vectorstore/flat 目录下）
+向量按行归一化后存放在内存映射的 float32 矩阵中，检索时一次矩阵乘法得到所有查询的余弦相似度；
+片段 ID、文本与 metadata 存放在旁边的 SQLite 中。片段数达到 hnsw_threshold 且安装了 hnswlib 时改用 HNSW 近似检索。
+FlatCollection 提供与 Chroma collection 相同的 get / query / add / update / delete / count 接口，
+距离为余弦距离（1 - 余弦相似度）。
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import List, Optional
+
+import numpy as np
+
+from .lexical_index import matches_where
+
+FLAT_STORE_DIRNAME = "flat"
+FLAT_VECTORS_FILENAME = "vectors.f32"
+FLAT_SEGMENTS_FILENAME = "segments.sqlite3"
+FLAT_HNSW_FILENAME = "hnsw.bin"
+DEFAULT_HNSW_THRESHOLD = 20000
+
+_SQL_CHUNK = 500
+
+_flat_settings = {
+    "hnsw_threshold": DEFAULT_HNSW_THRESHOLD,
+    "hnsw_ef": 64,
+    "hnsw_m": 16
+}
+_collections = {}
+_collections_lock = threading.Lock()
+
+def configure_flat_store(settings: dict):
+    """应用 "vector_store" 配置中 flat 后端的参数：hnsw_threshold、hnsw_ef、hnsw_m"""
+    for key, value in (settings or {}).items():
+        if key in _flat_settings:
+            _flat_settings[key] = int(value)
+
+def _hnswlib():
+    try:
+        import hnswlib
+        return hnswlib
+    except ImportError:
+        return None
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+class FlatCollection:
+    """内存映射矩阵 + SQLite 的向量集合，线程安全；删除空出的行留给后续写入复用"""
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(path, FLAT_SEGMENTS_FILENAME), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS segments ("
+            "row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, document TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.commit()
+        meta = dict(self._conn.execute("SELECT name, value FROM meta").fetchall())
+        self.dim = int(meta["dim"]) if "dim" in meta else None
+        # 每次增删片段 version 加一；HNSW 文件保存时记录对应的 version，不一致时重建
+        self._version = int(meta.get("version", 0))
+        self._hnsw_version = int(meta.get("hnsw_version", -1))
+        self._ids = []
+        self._documents = []
+        self._metadatas = []
+        self._row_of = {}
+        for row, doc_id, document, metadata in self._conn.execute("SELECT row, id, document, metadata FROM segments"):
+            self._ensure_rows(row + 1)
+            self._ids[row] = doc_id
+            self._documents[row] = document
+            self._metadatas[row] = json.loads(metadata)
+            self._row_of[doc_id] = row
+        self._free = [row for row, doc_id in enumerate(self._ids) if doc_id is None]
+        self._matrix = None
+        self._hnsw = None
+        self._masks = {}
+
+    def _ensure_rows(self, rows: int):
+        while len(self._ids) < rows:
+            self._ids.append(None)
+            self._documents.append(None)
+            self._metadatas.append(None)
+
+    def _vectors(self, min_rows: int = 0) -> Optional[np.memmap]:
+        """向量矩阵，行数不足 min_rows 时扩容（按倍数增长）；尚未写入过向量时返回 None"""
+        if self.dim is None:
+            return None
+        if self._matrix is not None and self._matrix.shape[0] >= max(min_rows, 1):
+            return self._matrix
+        path = os.path.join(self.path, FLAT_VECTORS_FILENAME)
+        row_bytes = 4 * self.dim
+        rows = os.path.getsize(path) // row_bytes if os.path.exists(path) else 0
+        if rows < min_rows:
+            rows = max(min_rows, rows * 2, 1024)
+            if self._matrix is not None:
+                self._matrix.flush()
+            with open(path, "ab") as f:
+                f.truncate(rows * row_bytes)
+        if rows == 0:
+            return None
+        self._matrix = np.memmap(path, dtype=np.float32, mode="r+", shape=(rows, self.dim))
+        return self._matrix
+
+    def _bump_version(self):
+        self._version += 1
+        self._masks.clear()
+        self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('version', ?)", (str(self._version),))
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._row_of)
+
+    def add(self, ids: List[str], embeddings, documents: List[str], metadatas: List[dict] = None):
+        """写入片段；已存在的 ID 原位覆盖"""
+        ids = list(ids)
+        if not ids:
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[0] != len(ids) or len(documents) != len(ids):
+            raise ValueError(f"Mismatched add: {len(ids)} ids, {len(documents)} documents, embeddings {vectors.shape}")
+        metadatas = metadatas or [{}] * len(ids)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('dim', ?)", (str(self.dim),))
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match store dimension {self.dim}")
+            rows = []
+            for doc_id in ids:
+                row = self._row_of.get(doc_id)
+                if row is None:
+                    row = self._free.pop(0) if self._free else len(self._ids)
+                    self._ensure_rows(row + 1)
+                    self._row_of[doc_id] = row
+                rows.append(row)
+            matrix = self._vectors(max(rows) + 1)
+            normalized = _normalize(vectors)
+            matrix[rows] = normalized
+            matrix.flush()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO segments (row, id, document, metadata) VALUES (?, ?, ?, ?)",
+                [(row, doc_id, str(document), json.dumps(metadata or {}, ensure_ascii=False))
+                 for row, doc_id, document, metadata in zip(rows, ids, documents, metadatas)]
+            )
+            for row, doc_id, document, metadata in zip(rows, ids, documents, metadatas):
+                self._ids[row] = doc_id
+                self._documents[row] = str(document)
+                self._metadatas[row] = dict(metadata or {})
+            self._bump_version()
+            if self._hnsw is not None:
+                if self._hnsw.get_max_elements() < matrix.shape[0]:
+                    self._hnsw.resize_index(matrix.shape[0])
+                self._hnsw.add_items(normalized, np.asarray(rows))
+                self._save_hnsw()
+            self._conn.commit()
+
+    def update(self, ids: List[str], metadatas: List[dict] = None, documents: List[str] = None):
+        """更新已存在片段的 metadata / 文本（不改向量），不存在的 ID 忽略"""
+        with self._lock:
+            updates = []
+            for i, doc_id in enumerate(ids):
+                row = self._row_of.get(doc_id)
+                if row is None:
+                    continue
+                if metadatas is not None:
+                    self._metadatas[row] = dict(metadatas[i] or {})
+                if documents is not None:
+                    self._documents[row] = str(documents[i])
+                updates.append((self._documents[row], json.dumps(self._metadatas[row], ensure_ascii=False), row))
+            self._conn.executemany("UPDATE segments SET document = ?, metadata = ? WHERE row = ?", updates)
+            self._masks.clear()
+            self._conn.commit()
+
+    def delete(self, ids: List[str] = None, where: dict = None):
+        with self._lock:
+            if ids is None:
+                ids = [doc_id for doc_id in self._row_of]
+            rows = [self._row_of[doc_id] for doc_id in ids
+                    if doc_id in self._row_of and matches_where(self._metadatas[self._row_of[doc_id]], where)]
+            if not rows:
+                return
+            for start in range(0, len(rows), _SQL_CHUNK):
+                chunk = rows[start:start + _SQL_CHUNK]
+                self._conn.execute(f"DELETE FROM segments WHERE row IN ({','.join('?' * len(chunk))})", chunk)
+            for row in rows:
+                del self._row_of[self._ids[row]]
+                self._ids[row] = None
+                self._documents[row] = None
+                self._metadatas[row] = None
+                if self._hnsw is not None:
+                    self._hnsw.mark_deleted(row)
+            self._free = sorted(self._free + rows)
+            self._bump_version()
+            if self._hnsw is not None:
+                self._save_hnsw()
+            self._conn.commit()
+
+    def _rows(self, ids: List[str] = None, where: dict = None) -> List[int]:
+        if ids is not None:
+            rows = [self._row_of[doc_id] for doc_id in ids if doc_id in self._row_of]
+        else:
+            rows = [row for row, doc_id in enumerate(self._ids) if doc_id is not None]
+        return [row for row in rows if matches_where(self._metadatas[row], where)]
+
+    def _result(self, rows: List[int], include) -> dict:
+        result = {"ids": [self._ids[row] for row in rows]}
+        if "documents" in include:
+            result["documents"] = [self._documents[row] for row in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [dict(self._metadatas[row]) for row in rows]
+        if "embeddings" in include:
+            matrix = self._vectors()
+            result["embeddings"] = [matrix[row].tolist() for row in rows]
+        return result
+
+    def get(self, ids: List[str] = None, where: dict = None, include=("documents", "metadatas"),
+            limit: int = None, offset: int = 0) -> dict:
+        with self._lock:
+            rows = self._rows(ids, where)
+            if limit is not None:
+                rows = rows[offset:offset + limit]
+            elif offset:
+                rows = rows[offset:]
+            return self._result(rows, include)
+
+    def _mask(self, size: int, where: Optional[dict]) -> np.ndarray:
+        """长度为 size 的布尔数组：行中有片段且满足 where；按 where 缓存，写入后失效"""
+        key = json.dumps(where, sort_keys=True, ensure_ascii=False) if where else ""
+        mask = self._masks.get(key)
+        if mask is None or mask.shape[0] != size:
+            mask = np.zeros(size, dtype=bool)
+            for row, doc_id in enumerate(self._ids[:size]):
+                if doc_id is not None and matches_where(self._metadatas[row], where):
+                    mask[row] = True
+            self._masks[key] = mask
+        return mask
+
+    def query(self, query_embeddings, n_results: int = 10, where: dict = None,
+              include=("documents", "metadatas", "distances")) -> dict:
+        """余弦检索，所有查询一次完成；返回与 Chroma 相同的嵌套列表结构"""
+        with self._lock:
+            queries = np.asarray(query_embeddings, dtype=np.float32)
+            if queries.ndim == 1:
+                queries = queries[None, :]
+            keys = ["ids"] + [key for key in ("documents", "metadatas", "distances", "embeddings") if key in include]
+            result = {key: [] for key in keys}
+            matrix = self._vectors()
+            if matrix is None or not self._row_of or n_results <= 0:
+                for key in keys:
+                    result[key] = [[] for _ in range(queries.shape[0])]
+                return result
+            if queries.shape[1] != self.dim:
+                raise ValueError(f"Query dimension {queries.shape[1]} does not match store dimension {self.dim}")
+            queries = _normalize(queries)
+            size = len(self._ids)
+            mask = self._mask(size, where)
+            k = min(n_results, int(mask.sum()))
+            neighbours = self._hnsw_search(queries, k, mask) if k else None
+            if neighbours is None:
+                neighbours = self._exact_search(matrix[:size], queries, k, mask)
+            for rows, distances in neighbours:
+                row_result = self._result(rows, include)
+                for key in keys:
+                    if key == "distances":
+                        result[key].append([float(d) for d in distances])
+                    else:
+                        result[key].append(row_result[key])
+            return result
+
+    @staticmethod
+    def _exact_search(matrix: np.ndarray, queries: np.ndarray, k: int, mask: np.ndarray) -> list:
+        if k == 0:
+            return [([], []) for _ in range(queries.shape[0])]
+        similarities = queries @ matrix.T
+        similarities[:, ~mask] = -np.inf
+        neighbours = []
+        for scores in similarities:
+            top = np.argpartition(-scores, k - 1)[:k] if k < scores.shape[0] else np.arange(scores.shape[0])
+            top = top[np.argsort(-scores[top])]
+            neighbours.append((top.tolist(), (1.0 - scores[top]).tolist()))
+        return neighbours
+
+    def _hnsw_search(self, queries: np.ndarray, k: int, mask: np.ndarray) -> Optional[list]:
+        """片段数达到阈值时用 HNSW 检索；未安装 hnswlib、片段较少或过滤后结果不足时返回 None（改用精确检索）"""
+        if len(self._row_of) < _flat_settings["hnsw_threshold"] or not self._ensure_hnsw():
+            return None
+        self._hnsw.set_ef(max(_flat_settings["hnsw_ef"], k))
+        try:
+            if int(mask.sum()) == len(self._row_of):
+                labels, distances = self._hnsw.knn_query(queries, k=k)
+            else:
+                labels, distances = self._hnsw.knn_query(
+                    queries, k=k, num_threads=1, filter=lambda label: bool(mask[label]) if label < mask.shape[0] else False
+                )
+        except RuntimeError as e:
+            logging.debug(f"[FlatVectorStore] HNSW query fell back to exact search: {e}")
+            return None
+        return [(row_labels.tolist(), row_distances.tolist()) for row_labels, row_distances in zip(labels, distances)]
+
+    def _ensure_hnsw(self) -> bool:
+        if self._hnsw is not None:
+            return True
+        hnswlib = _hnswlib()
+        if hnswlib is None:
+            return False
+        matrix = self._vectors()
+        path = os.path.join(self.path, FLAT_HNSW_FILENAME)
+        index = hnswlib.Index(space="cosine", dim=self.dim)
+        if os.path.exists(path) and self._hnsw_version == self._version:
+            index.load_index(path, max_elements=matrix.shape[0])
+        else:
+            rows = [row for row, doc_id in enumerate(self._ids) if doc_id is not None]
+            index.init_index(max_elements=matrix.shape[0], ef_construction=200, M=_flat_settings["hnsw_m"])
+            index.add_items(np.asarray(matrix[rows]), np.asarray(rows))
+            logging.info(f"[FlatVectorStore] Built HNSW index over {len(rows)} segments.")
+        self._hnsw = index
+        if self._hnsw_version != self._version:
+            self._save_hnsw()
+            self._conn.commit()
+        return True
+
+    def _save_hnsw(self):
+        self._hnsw.save_index(os.path.join(self.path, FLAT_HNSW_FILENAME))
+        self._hnsw_version = self._version
+        self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('hnsw_version', ?)", (str(self._version),))
+
+    def close(self):
+        with self._lock:
+            if self._matrix is not None:
+                self._matrix.flush()
+                self._matrix = None
+            self._hnsw = None
+            self._conn.close()
+
+class FlatVectorStore:
+    """
+    flat 后端的向量库，用法与 langchain_chroma.Chroma 一致：
+    embeddings、add_texts(texts, metadatas, ids)，以及 _collection / _persist_directory 属性。
+    """
+    def __init__(self, persist_directory: str, embedding_function=None):
+        self._persist_directory = persist_directory
+        self._embedding_function = embedding_function
+        self._collection = open_flat_collection(persist_directory)
+
+    @property
+    def embeddings(self):
+        return self._embedding_function
+
+    def add_texts(self, texts: List[str], metadatas: List[dict], ids: List[str]) -> List[str]:
+        texts = list(texts)
+        vectors = self._embedding_function.embed_documents(texts)
+        if vectors is None or len(vectors) != len(texts) or not all(len(v) for v in vectors):
+            raise ValueError(f"Embedding failed for {len(texts)} segments.")
+        self._collection.add(ids=ids, embeddings=vectors, documents=texts, metadatas=metadatas)
+        return list(ids)
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding, metadatas: List[dict], ids: List[str], persist_directory: str):
+        store = cls(persist_directory, embedding)
+        store.add_texts(texts, metadatas, ids)
+        return store
+
+def has_flat_store(store_dir: str) -> bool:
+    return os.path.exists(os.path.join(store_dir, FLAT_STORE_DIRNAME, FLAT_SEGMENTS_FILENAME))
+
+def open_flat_collection(store_dir: str) -> FlatCollection:
+    """获取向量库目录 store_dir 下的 flat 集合；同一目录在进程内只打开一次"""
+    path = os.path.abspath(os.path.join(store_dir, FLAT_STORE_DIRNAME))
+    with _collections_lock:
+        collection = _collections.get(path)
+        if collection is None:
+            os.makedirs(path, exist_ok=True)
+            collection = FlatCollection(path)
+            _collections[path] = collection
+        return collection
+
+def close_flat_collection(store_dir: str):
+    """关闭并移除 store_dir 对应的 flat 集合（清空向量库前调用，释放文件句柄）"""
+    path = os.path.abspath(os.path.join(store_dir, FLAT_STORE_DIRNAME))
+    with _collections_lock:
+        collection = _collections.pop(path, None)
+    if collection is not None:
+        collection.close()
@@ -10,8 +10,7 @@ import traceback
 import nltk
 import warnings
 from utils import read_file
-from novel_generator.vectorstore_utils import load_vector_store, init_vector_store
-from langchain.docstore.document import Document
+from novel_generator.vectorstore_utils import load_vector_store, init_vector_store, upsert_segments
 
 # 禁用特定的Torch警告
 warnings.filterwarnings('ignore', message='.*Torch was not compiled with flash attention.*')
@@ -51,8 +50,13 @@ def import_knowledge_file(
     embedding_interface_format: str,
     embedding_model_name: str,
     file_path: str,
-    filepath: str
+    filepath: str,
+    source_name: str = ""
 ):
+    """
+    把知识文件切分后写入向量库。source_name 为原始文件名（界面经临时文件导入时传入），
+    记录在片段的 file_name 元数据中；为空时取 file_path 的文件名。
+    """
     logging.info(f"开始导入知识库文件: {file_path}, 接口格式: {embedding_interface_format}, 模型: {embedding_model_name}")
     if not os.path.exists(file_path):
         logging.warning(f"知识库文件不存在: {file_path}")
@@ -62,6 +66,7 @@ def import_knowledge_file(
         logging.warning("知识库文件内容为空。")
         return
     paragraphs = advanced_split_content(content)
+    file_name = source_name or os.path.basename(file_path)
     from embedding_adapters import create_embedding_adapter
     embedding_adapter = create_embedding_adapter(
         embedding_interface_format,
@@ -72,16 +77,16 @@ def import_knowledge_file(
     store = load_vector_store(embedding_adapter, filepath)
     if not store:
         logging.info("Vector store does not exist or load failed. Initializing a new one for knowledge import...")
-        store = init_vector_store(embedding_adapter, paragraphs, filepath)
+        store = init_vector_store(embedding_adapter, paragraphs, filepath, source="knowledge", file_name=file_name)
         if store:
             logging.info("知识库文件已成功导入至向量库(新初始化)。")
         else:
             logging.warning("知识库导入失败，跳过。")
     else:
         try:
-            docs = [Document(page_content=str(p)) for p in paragraphs]
-            store.add_documents(docs)
-            logging.info("知识库文件已成功导入至向量库(追加模式)。")
+            # 片段 ID 由内容决定，重复导入同一文件不会产生重复片段
+            stats = upsert_segments(store, paragraphs, "knowledge", file_name=file_name)
+            logging.info(f"知识库文件已成功导入至向量库(追加模式，新增 {stats['added']} 段，已存在 {stats['unchanged']} 段)。")
         except Exception as e:
             logging.warning(f"知识库导入失败: {e}")
             traceback.print_exc()
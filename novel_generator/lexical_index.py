@@ -0,0 +1,213 @@
+# novel_generator/lexical_index.py
+# -*- coding: utf-8 -*-
+"""
+向量库片段的本地倒排索引（SQLite，存放在项目的 vectorstore 目录下）
+中文按字的二元 / 三元组（bigram / trigram）切分，英文与数字按词切分，BM25 打分。
+检索关键词多为人名、物品、地名等专有名词，稠密向量容易漏召回，由该索引补充字面匹配的结果，
+在 vectorstore_utils 中与 Chroma 的结果做倒数排名融合（RRF）。
+"""
+import json
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+from typing import List, Optional
+
+LEXICAL_INDEX_FILENAME = "lexical_index.sqlite3"
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_CJK_RANGES = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+_TOKEN_RE = re.compile(rf"[{_CJK_RANGES}]+|[a-z0-9]+")
+_CJK_RE = re.compile(rf"[{_CJK_RANGES}]")
+
+_SQL_CHUNK = 500
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def tokenize(text: str) -> List[str]:
+    """中文连续片段切成字的二元与三元组（单字保留原字），英文与数字按词切分并转小写"""
+    text = unicodedata.normalize("NFKC", str(text or "")).lower()
+    terms = []
+    for run in _TOKEN_RE.findall(text):
+        if not _CJK_RE.match(run):
+            terms.append(run)
+        elif len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+            terms.extend(run[i:i + 3] for i in range(len(run) - 2))
+    return terms
+
+def matches_where(metadata: dict, where: Optional[dict]) -> bool:
+    """
+    按 Chroma 的 where 语法判断 metadata 是否满足条件，
+    支持 $and / $or 与 $eq、$ne、$in、$nin、$lt、$lte、$gt、$gte。
+    """
+    if not where:
+        return True
+    metadata = metadata or {}
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches_where(metadata, sub) for sub in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_where(metadata, sub) for sub in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for op, expected in condition.items():
+                if op == "$eq":
+                    ok = value == expected
+                elif op == "$ne":
+                    ok = value != expected
+                elif op == "$in":
+                    ok = value in expected
+                elif op == "$nin":
+                    ok = value not in expected
+                elif value is None:
+                    ok = False
+                elif op == "$lt":
+                    ok = value < expected
+                elif op == "$lte":
+                    ok = value <= expected
+                elif op == "$gt":
+                    ok = value > expected
+                elif op == "$gte":
+                    ok = value >= expected
+                else:
+                    raise ValueError(f"Unsupported where operator: {op}")
+                if not ok:
+                    return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+class LexicalIndex:
+    """基于 SQLite 的 n-gram 倒排索引，线程安全"""
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS docs ("
+            "id TEXT PRIMARY KEY, length INTEGER NOT NULL, text TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            "term TEXT NOT NULL, doc_id TEXT NOT NULL, tf INTEGER NOT NULL, PRIMARY KEY (term, doc_id)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_postings_doc ON postings(doc_id)")
+        self._conn.commit()
+
+    def _remove(self, ids: List[str]):
+        for start in range(0, len(ids), _SQL_CHUNK):
+            chunk = ids[start:start + _SQL_CHUNK]
+            marks = ",".join("?" * len(chunk))
+            self._conn.execute(f"DELETE FROM postings WHERE doc_id IN ({marks})", chunk)
+            self._conn.execute(f"DELETE FROM docs WHERE id IN ({marks})", chunk)
+
+    def add(self, ids: List[str], texts: List[str], metadatas: List[dict] = None):
+        """写入（或覆盖）片段"""
+        metadatas = metadatas or [{}] * len(ids)
+        with self._lock:
+            self._remove(list(ids))
+            for doc_id, text, metadata in zip(ids, texts, metadatas):
+                counts = Counter(tokenize(text))
+                self._conn.execute(
+                    "INSERT INTO docs (id, length, text, metadata) VALUES (?, ?, ?, ?)",
+                    (doc_id, sum(counts.values()), text, json.dumps(metadata or {}, ensure_ascii=False))
+                )
+                self._conn.executemany(
+                    "INSERT INTO postings (term, doc_id, tf) VALUES (?, ?, ?)",
+                    [(term, doc_id, tf) for term, tf in counts.items()]
+                )
+            self._conn.commit()
+
+    def remove(self, ids: List[str]):
+        with self._lock:
+            self._remove(list(ids))
+            self._conn.commit()
+
+    def update_metadata(self, ids: List[str], metadatas: List[dict]):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE docs SET metadata = ? WHERE id = ?",
+                [(json.dumps(metadata or {}, ensure_ascii=False), doc_id) for doc_id, metadata in zip(ids, metadatas)]
+            )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM postings")
+            self._conn.execute("DELETE FROM docs")
+            self._conn.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def search(self, query: str, k: int = 10, where: dict = None) -> List[tuple]:
+        """BM25 检索，返回 [(id, 文本, 得分, metadata), ...]，按得分从高到低"""
+        terms = set(tokenize(query))
+        if not terms or k <= 0:
+            return []
+        with self._lock:
+            total, avg_length = self._conn.execute("SELECT COUNT(*), AVG(length) FROM docs").fetchone()
+            if not total:
+                return []
+            avg_length = avg_length or 1.0
+            scores = {}
+            for term in terms:
+                rows = self._conn.execute(
+                    "SELECT p.doc_id, p.tf, d.length FROM postings p JOIN docs d ON d.id = p.doc_id WHERE p.term = ?",
+                    (term,)
+                ).fetchall()
+                if not rows:
+                    continue
+                idf = math.log((total - len(rows) + 0.5) / (len(rows) + 0.5) + 1.0)
+                for doc_id, tf, length in rows:
+                    norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+            results = []
+            for doc_id, score in sorted(scores.items(), key=lambda item: -item[1]):
+                text, metadata = self._conn.execute("SELECT text, metadata FROM docs WHERE id = ?", (doc_id,)).fetchone()
+                metadata = json.loads(metadata)
+                if matches_where(metadata, where):
+                    results.append((doc_id, text, score, metadata))
+                    if len(results) >= k:
+                        break
+            return results
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def get_lexical_index(store_dir: str) -> Optional[LexicalIndex]:
+    """获取向量库目录 store_dir 对应的倒排索引实例；打开失败时返回 None"""
+    db_path = os.path.abspath(os.path.join(store_dir, LEXICAL_INDEX_FILENAME))
+    with _indexes_lock:
+        index = _indexes.get(db_path)
+        if index is None:
+            try:
+                os.makedirs(store_dir, exist_ok=True)
+                index = LexicalIndex(db_path)
+            except Exception as e:
+                logging.warning(f"[LexicalIndex] Failed to open index at {db_path}: {e}")
+                return None
+            _indexes[db_path] = index
+        return index
+
+def close_lexical_index(store_dir: str):
+    """关闭并移除 store_dir 对应的索引实例（清空向量库前调用，释放文件句柄）"""
+    db_path = os.path.abspath(os.path.join(store_dir, LEXICAL_INDEX_FILENAME))
+    with _indexes_lock:
+        index = _indexes.pop(db_path, None)
+    if index is not None:
+        index.close()
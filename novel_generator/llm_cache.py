@@ -0,0 +1,145 @@
+# novel_generator/llm_cache.py
+# -*- coding: utf-8 -*-
+"""
+LLM 响应的本地持久缓存（SQLite，存放在项目目录下）
+键为 (适配器类型, model_name, base_url, temperature, max_tokens, prompt) 的哈希，
+按总大小做 LRU 淘汰；只有在启用缓存的阶段（stage）才会读写。
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+LLM_CACHE_FILENAME = "llm_cache.sqlite3"
+
+# 默认只缓存低温、结果可复用的阶段
+DEFAULT_CACHED_STAGES = {"keyword_search", "knowledge_filter"}
+DEFAULT_MAX_CACHE_MB = 64
+
+_cache_settings = {
+    "enabled": True,
+    "stages": set(DEFAULT_CACHED_STAGES),
+    "max_bytes": DEFAULT_MAX_CACHE_MB * 1024 * 1024
+}
+_caches = {}
+_caches_lock = threading.Lock()
+
+class LLMResponseCache:
+    """基于 SQLite 的内容寻址缓存，线程安全"""
+    def __init__(self, db_path: str, max_bytes: int = DEFAULT_MAX_CACHE_MB * 1024 * 1024):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_access ON llm_cache(last_access)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(llm_adapter, prompt: str) -> str:
+        parts = [
+            type(llm_adapter).__name__,
+            getattr(llm_adapter, "model_name", ""),
+            getattr(llm_adapter, "base_url", ""),
+            getattr(llm_adapter, "temperature", None),
+            getattr(llm_adapter, "max_tokens", None),
+            prompt
+        ]
+        raw = json.dumps(parts, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key: str, response: str):
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time())
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """总大小超过上限时，按最近访问时间从旧到新删除"""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT key, size FROM llm_cache ORDER BY last_access ASC").fetchall()
+        evicted = 0
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        logging.info(f"[LLMCache] Evicted {evicted} entries, size now {total} bytes.")
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": count, "bytes": size}
+
+def configure_llm_cache(settings: dict):
+    """
+    根据 config.json 中的 "llm_cache" 配置调整缓存行为，例如：
+    {"enabled": true, "stages": ["keyword_search", "knowledge_filter", "core_seed"], "max_mb": 128}
+    """
+    settings = settings or {}
+    if "enabled" in settings:
+        _cache_settings["enabled"] = bool(settings["enabled"])
+    if "stages" in settings:
+        _cache_settings["stages"] = set(settings["stages"])
+    if "max_mb" in settings:
+        _cache_settings["max_bytes"] = int(float(settings["max_mb"]) * 1024 * 1024)
+        with _caches_lock:
+            for cache in _caches.values():
+                cache.max_bytes = _cache_settings["max_bytes"]
+
+def get_llm_cache(cache_dir: str) -> Optional[LLMResponseCache]:
+    """获取 cache_dir 对应的缓存实例，同一目录共享一个实例"""
+    if not cache_dir:
+        return None
+    db_path = os.path.abspath(os.path.join(cache_dir, LLM_CACHE_FILENAME))
+    with _caches_lock:
+        cache = _caches.get(db_path)
+        if cache is None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                cache = LLMResponseCache(db_path, _cache_settings["max_bytes"])
+            except Exception as e:
+                logging.warning(f"[LLMCache] Failed to open cache at {db_path}: {e}")
+                return None
+            _caches[db_path] = cache
+        return cache
+
+def get_stage_cache(stage: str, cache_dir: str) -> Optional[LLMResponseCache]:
+    """仅当缓存开启且 stage 在启用列表中时返回缓存实例"""
+    if not _cache_settings["enabled"] or not stage or stage not in _cache_settings["stages"]:
+        return None
+    return get_llm_cache(cache_dir)
+
+def log_cache_event(cache: LLMResponseCache, stage: str, hit: bool):
+    logging.info(
+        f"[LLMCache] {'hit' if hit else 'miss'} stage={stage} "
+        f"(hits={cache.hits}, misses={cache.misses})"
+    )
@@ -0,0 +1,179 @@
+# novel_generator/prompt_budget.py
+# -*- coding: utf-8 -*-
+"""
+提示词 token 预算管理：
+按模型上下文长度与 max_tokens 计算可用预算，统计各段落 token 数，
+先按各段落的占比上限裁剪，整体仍超出时从优先级最低的段落开始压缩/截断，并记录裁剪情况。
+"""
+import functools
+import logging
+import re
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken 不可用时退化为按字符估算
+    tiktoken = None
+
+# 常见模型的上下文长度（按名称片段匹配，越具体的放越前面）
+MODEL_CONTEXT_WINDOWS = [
+    ("gpt-4o", 128000),
+    ("gpt-4.1", 1000000),
+    ("gpt-4-turbo", 128000),
+    ("gpt-4-32k", 32768),
+    ("gpt-4", 8192),
+    ("gpt-3.5", 16385),
+    ("o1", 128000),
+    ("o3", 200000),
+    ("deepseek", 64000),
+    ("qwen", 32768),
+    ("glm", 128000),
+    ("moonshot", 128000),
+    ("kimi", 128000),
+    ("doubao", 128000),
+    ("gemini", 1000000),
+    ("claude", 200000),
+]
+DEFAULT_CONTEXT_WINDOW = 32768
+# 为模板格式化误差、消息封装等预留的比例
+SAFETY_MARGIN = 0.05
+
+TRUNCATION_MARK = "……"
+
+def get_context_window(model_name: str) -> int:
+    name = (model_name or "").lower()
+    for fragment, window in MODEL_CONTEXT_WINDOWS:
+        if fragment in name:
+            return window
+    return DEFAULT_CONTEXT_WINDOW
+
+@functools.lru_cache(maxsize=32)
+def get_tokenizer(model_name: str):
+    """按模型缓存 tokenizer；无法获取时返回 None"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except Exception:
+        try:
+            return tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logging.warning(f"[PromptBudget] Failed to load tokenizer, falling back to estimation: {e}")
+            return None
+
+def _char_cost(ch: str) -> float:
+    # 中文等宽字符约 1 token/字，其余约 4 字符/token
+    return 1.0 if ord(ch) > 0x2E7F else 0.25
+
+def _compress(text: str) -> str:
+    """去掉行尾空白并合并多余空行"""
+    text = re.sub(r'[ \t]+\n', '\n', text)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+class PromptSection:
+    """
+    提示词中的一个可裁剪段落
+    :param priority: 数值越小越先被裁剪
+    :param keep: 截断时保留开头("head")还是结尾("tail")
+    :param max_share: 占可用预算的比例上限，None 表示不单独设限
+    :param min_tokens: 整体超预算时最少保留的 token 数
+    """
+    def __init__(self, name: str, text: str, priority: int, keep: str = "head", max_share: float = None, min_tokens: int = 0):
+        self.name = name
+        self.text = text or ""
+        self.priority = priority
+        self.keep = keep
+        self.max_share = max_share
+        self.min_tokens = min_tokens
+
+class PromptBudget:
+    def __init__(self, model_name: str, max_tokens: int, context_window: int = None):
+        self.model_name = model_name or ""
+        self.context_window = context_window or get_context_window(self.model_name)
+        reserved = int(self.context_window * SAFETY_MARGIN) + int(max_tokens or 0)
+        # 配置不合理（max_tokens 接近上下文长度）时，至少保留四分之一给提示词
+        self.available = max(self.context_window - reserved, self.context_window // 4)
+        self._encoding = get_tokenizer(self.model_name)
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return int(sum(_char_cost(ch) for ch in text) + 0.999)
+
+    def truncate(self, text: str, limit: int, keep: str = "head") -> str:
+        if limit <= 0:
+            return ""
+        if self.count(text) <= limit:
+            return text
+        limit = max(limit - self.count(TRUNCATION_MARK), 1)
+        if self._encoding is not None:
+            tokens = self._encoding.encode(text, disallowed_special=())
+            kept = tokens[:limit] if keep == "head" else tokens[-limit:]
+            piece = self._encoding.decode(kept).replace("\ufffd", "")
+        else:
+            chars = text if keep == "head" else text[::-1]
+            cost = 0.0
+            end = 0
+            for end, ch in enumerate(chars):
+                cost += _char_cost(ch)
+                if cost > limit:
+                    break
+            piece = chars[:end]
+            if keep != "head":
+                piece = piece[::-1]
+        return piece + TRUNCATION_MARK if keep == "head" else TRUNCATION_MARK + piece
+
+    def fit(self, sections: list, overhead_tokens: int = 0):
+        """
+        对 sections 进行裁剪，返回 ({name: text}, report)。
+        report 中每一项为 {"section", "before", "after", "reason"}。
+        """
+        texts = {s.name: s.text for s in sections}
+        counts = {s.name: self.count(s.text) for s in sections}
+        report = []
+
+        def shrink(section, limit, reason):
+            before = counts[section.name]
+            text = _compress(texts[section.name])
+            if self.count(text) > limit:
+                text = self.truncate(text, limit, section.keep)
+            texts[section.name] = text
+            counts[section.name] = self.count(text)
+            report.append({"section": section.name, "before": before, "after": counts[section.name], "reason": reason})
+
+        for section in sections:
+            if section.max_share is None:
+                continue
+            cap = int(self.available * section.max_share)
+            if counts[section.name] > cap:
+                shrink(section, cap, "cap")
+
+        total = overhead_tokens + sum(counts.values())
+        for section in sorted(sections, key=lambda s: s.priority):
+            overflow = total - self.available
+            if overflow <= 0:
+                break
+            if counts[section.name] <= section.min_tokens:
+                continue
+            limit = max(section.min_tokens, counts[section.name] - overflow)
+            shrink(section, limit, "overflow")
+            total = overhead_tokens + sum(counts.values())
+
+        if total > self.available:
+            logging.warning(f"[PromptBudget] Prompt still exceeds budget: {total} > {self.available} tokens.")
+        return texts, report
+
+def format_with_budget(template: str, model_name: str, max_tokens: int, sections: list, context_window: int = None, **fields) -> str:
+    """
+    在 token 预算内格式化 template：sections 为可裁剪段落，fields 为其余固定字段。
+    裁剪情况写入日志。
+    """
+    budget = PromptBudget(model_name, max_tokens, context_window)
+    overhead = budget.count(template.format(**fields, **{s.name: "" for s in sections}))
+    texts, report = budget.fit(sections, overhead)
+    for item in report:
+        logging.info(
+            f"[PromptBudget] {item['section']}: {item['before']} -> {item['after']} tokens ({item['reason']})"
+        )
+    return template.format(**fields, **texts)
@@ -0,0 +1,33 @@
+# novel_generator/prompt_layout.py
+# -*- coding: utf-8 -*-
+"""
+提示词布局模式：
+- "classic"：使用 prompt_definitions 中的原始模板；
+- "stable_prefix"：项目固定资料（小说设定）与写作规则放在提示词最前面且逐字节一致，
+  逐章变化的字段放在其后，以命中服务商（DeepSeek、OpenAI 等）的提示词前缀缓存。
+  该模式只调整已有段落的顺序，不增删内容（原模板不含小说设定的后续章节草稿，这里同样不含）。
+命中情况可通过 llm_usage.get_usage_stats() 按阶段查看。
+"""
+import logging
+
+LAYOUT_CLASSIC = "classic"
+LAYOUT_STABLE_PREFIX = "stable_prefix"
+
+_layout_settings = {"mode": LAYOUT_CLASSIC}
+
+def configure_prompt_layout(settings):
+    """应用 config.json 中的 "prompt_layout"，可写 "stable_prefix" 或 {"mode": "stable_prefix"}"""
+    if isinstance(settings, dict):
+        settings = settings.get("mode")
+    mode = (settings or LAYOUT_CLASSIC).strip().lower()
+    if mode not in (LAYOUT_CLASSIC, LAYOUT_STABLE_PREFIX):
+        logging.warning(f"[PromptLayout] Unknown mode '{settings}', using '{LAYOUT_CLASSIC}'.")
+        mode = LAYOUT_CLASSIC
+    _layout_settings["mode"] = mode
+
+def stable_prefix_enabled() -> bool:
+    return _layout_settings["mode"] == LAYOUT_STABLE_PREFIX
+
+def normalize_static_text(text: str) -> str:
+    """统一换行与首尾空白，保证同一份资料每次生成的前缀逐字节一致"""
+    return (text or "").replace("\r\n", "\n").strip()
@@ -67,7 +67,7 @@ def Novel_series_generate(
             genre=genre,
             num_stories=num_stories,
         )
-        series_blueprint_result = invoke_with_cleaning(llm_adapter, prompt_core)
+        series_blueprint_result = invoke_with_cleaning(llm_adapter, prompt_core, stage="series_blueprint", cache_dir=filepath)
         if not series_blueprint_result.strip():
             logging.warning("series_blueprint generation failed and returned empty.")
             save_data_to_json(partial_data, partial_data_path)
@@ -82,7 +82,7 @@ def Novel_series_generate(
         prompt_character = series_character_arc_prompt.format(
             series_blueprint=partial_data["series_blueprint_result"].strip(),
             num_characters=num_stories * 2)
-        series_character_arc_result = invoke_with_cleaning(llm_adapter, prompt_character)
+        series_character_arc_result = invoke_with_cleaning(llm_adapter, prompt_character, stage="series_character_arc", cache_dir=filepath)
         if not series_character_arc_result.strip():
             logging.warning("series_character_arc_prompt generation failed.")
             save_data_to_json(partial_data, partial_data_path)
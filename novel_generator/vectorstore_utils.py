@@ -2,84 +2,380 @@
 # -*- coding: utf-8 -*-
 """
 向量库相关操作（初始化、更新、检索、清空、文本切分等）
+chromadb / langchain 只在 Chroma 后端内导入，nltk 只在切分章节时导入，使用 flat 后端时不加载这些依赖。
 """
 import os
+import hashlib
 import logging
 import traceback
-import nltk
 import numpy as np
 import re
 import ssl
-import requests
+import threading
+import time
 import warnings
-from langchain_chroma import Chroma
 
 # 禁用特定的Torch警告
 warnings.filterwarnings('ignore', message='.*Torch was not compiled with flash attention.*')
 os.environ["TOKENIZERS_PARALLELISM"] = "false"  # 禁用tokenizer并行警告
 
-from chromadb.config import Settings
-from langchain.docstore.document import Document
-from sklearn.metrics.pairwise import cosine_similarity
-from .common import call_with_retry
+from .embedding_cache import EMBEDDING_CACHE_DIRNAME, cached_embed, get_embedding_cache, normalize_text
+from .lexical_index import LEXICAL_INDEX_FILENAME, close_lexical_index, get_lexical_index
+from .flat_vectorstore import (
+    FLAT_STORE_DIRNAME,
+    FlatVectorStore,
+    close_flat_collection,
+    configure_flat_store,
+    has_flat_store,
+    open_flat_collection
+)
+
+# 已打开的向量库：(向量库目录绝对路径, Embedding 配置) -> 向量库实例，同一进程内复用客户端与 collection
+_store_registry = {}
+_store_registry_lock = threading.RLock()
+# 每个向量库目录一把写锁，同一章节的片段替换不会与其它写入交错
+_write_locks = {}
+
+COLLECTION_NAME = "novel_collection"
+# 片段 metadata 中 source 的取值：chapter 为定稿章节，knowledge 为导入的知识文件，
+# legacy 为旧版本写入、没有元数据的片段（首次打开向量库时补标）
+NON_CHAPTER_SOURCES = ("knowledge", "text", "legacy")
+# 倒数排名融合（RRF）的平滑常数，以及稠密 / 字面检索各自取回的候选倍数
+RRF_K = 60
+HYBRID_CANDIDATE_FACTOR = 3
+# 跨关键词组的 MMR 选择：相关度权重，以及视为重复片段的余弦相似度阈值
+MMR_LAMBDA = 0.7
+DUPLICATE_SIMILARITY = 0.95
+
+_vector_store_settings = {
+    "backend": "chroma"
+}
 
 def get_vectorstore_dir(filepath: str) -> str:
     """获取 vectorstore 路径"""
     return os.path.join(filepath, "vectorstore")
 
+def _write_lock(store_dir: str) -> threading.Lock:
+    with _store_registry_lock:
+        return _write_locks.setdefault(os.path.abspath(store_dir), threading.Lock())
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+def make_segment_id(source: str, chapter_number, index: int, text: str) -> str:
+    """由 (来源, 章节号, 片段序号, 内容哈希) 确定的片段 ID，重复写入同一内容不会产生新条目"""
+    chapter = "-" if chapter_number is None else int(chapter_number)
+    return f"{source}:{chapter}:{index}:{content_hash(text)[:16]}"
+
+def _segment_documents(texts, source: str, chapter_number, file_name: str = ""):
+    """返回 (ids, texts, metadatas)，metadata 记录来源、章节号、文件名、写入时间、片段序号与内容哈希"""
+    ids, segments, metadatas = [], [], []
+    imported_at = int(time.time())
+    for index, text in enumerate(str(t) for t in texts):
+        metadata = {
+            "source": source,
+            "file_name": file_name or "",
+            "imported_at": imported_at,
+            "segment": index,
+            "content_hash": content_hash(text)
+        }
+        if chapter_number is not None:
+            metadata["chapter"] = int(chapter_number)
+        ids.append(make_segment_id(source, chapter_number, index, text))
+        segments.append(text)
+        metadatas.append(metadata)
+    return ids, segments, metadatas
+
+def exclude_recent_chapters_filter(current_chapter: int, window: int) -> dict:
+    """检索条件：排除距当前章节 window 章以内（以及当前和之后）的章节片段，知识文件等其它来源不受影响"""
+    return {"$or": [
+        {"source": {"$in": list(NON_CHAPTER_SOURCES)}},
+        {"chapter": {"$lt": int(current_chapter) - int(window)}}
+    ]}
+
+def _backfill_legacy_metadata(store):
+    """为旧版本写入、没有 source 元数据的片段补标 {"source": "legacy"}，使其仍能被带 where 条件的检索命中"""
+    collection = store._collection
+    data = collection.get(include=["metadatas"])
+    metadatas = data.get("metadatas") or [None] * len(data["ids"])
+    legacy = [(doc_id, dict(metadata or {}, source="legacy")) for doc_id, metadata in zip(data["ids"], metadatas)
+              if not (metadata or {}).get("source")]
+    for start in range(0, len(legacy), 500):
+        chunk = legacy[start:start + 500]
+        collection.update(ids=[doc_id for doc_id, _ in chunk], metadatas=[metadata for _, metadata in chunk])
+    index = get_lexical_index(getattr(store, "_persist_directory", None) or "")
+    if legacy and index is not None:
+        index.update_metadata([doc_id for doc_id, _ in legacy], [metadata for _, metadata in legacy])
+    if legacy:
+        logging.info(f"Tagged {len(legacy)} legacy segments without metadata as source=legacy.")
+
+def _sync_lexical_index(store):
+    """倒排索引与 collection 的条数不一致时（旧项目首次打开、索引文件被删除等），从 collection 全量重建"""
+    index = get_lexical_index(getattr(store, "_persist_directory", None) or "")
+    if index is None:
+        return
+    collection = store._collection
+    if index.count() == collection.count():
+        return
+    data = collection.get(include=["documents", "metadatas"])
+    metadatas = data.get("metadatas") or [None] * len(data["ids"])
+    index.clear()
+    for start in range(0, len(data["ids"]), 500):
+        index.add(data["ids"][start:start + 500], data["documents"][start:start + 500], metadatas[start:start + 500])
+    logging.info(f"[LexicalIndex] Rebuilt lexical index with {len(data['ids'])} segments.")
+
+def _registry_key(embedding_adapter, store_dir: str) -> tuple:
+    # flight_key 由 create_embedding_adapter 按 (接口, base_url, 模型, API Key) 生成，相同配置的适配器共享同一实例
+    return os.path.abspath(store_dir), getattr(embedding_adapter, "flight_key", "") or id(embedding_adapter)
+
+class VectorBackend:
+    """
+    向量库后端。create / open 返回的向量库都提供 embeddings、add_texts(texts, metadatas, ids)、
+    _collection（get / query / add / update / delete / count，与 Chroma collection 相同）与 _persist_directory，
+    写入、检索、整理代码不区分后端。
+    """
+    name = ""
+
+    def exists(self, store_dir: str) -> bool:
+        raise NotImplementedError
+
+    def paths(self, store_dir: str) -> list:
+        """该后端在 store_dir 下的文件与目录"""
+        raise NotImplementedError
+
+    def disk_usage(self, store_dir: str) -> int:
+        total = 0
+        for path in self.paths(store_dir):
+            if os.path.isdir(path):
+                for root, _, files in os.walk(path):
+                    total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+            elif os.path.exists(path):
+                total += os.path.getsize(path)
+        return total
+
+    def create(self, store_dir: str, embeddings, texts, metadatas, ids):
+        raise NotImplementedError
+
+    def open(self, store_dir: str, embeddings):
+        raise NotImplementedError
+
+    def open_collection(self, store_dir: str):
+        """不带 Embedding 的原始 collection，供整理、迁移与基准测试使用"""
+        raise NotImplementedError
+
+    def release(self, store_dir: str, stores):
+        """释放 store_dir 下已打开的向量库占用的文件句柄"""
+        pass
+
+class ChromaBackend(VectorBackend):
+    name = "chroma"
+
+    def exists(self, store_dir: str) -> bool:
+        return bool(self.paths(store_dir))
+
+    def paths(self, store_dir: str) -> list:
+        if not os.path.isdir(store_dir):
+            return []
+        return [
+            os.path.join(store_dir, name) for name in os.listdir(store_dir)
+            if name not in (EMBEDDING_CACHE_DIRNAME, FLAT_STORE_DIRNAME) and not name.startswith(LEXICAL_INDEX_FILENAME)
+        ]
+
+    @staticmethod
+    def _langchain_embeddings(embeddings):
+        from langchain.embeddings.base import Embeddings as LCEmbeddings
+
+        class LCEmbeddingWrapper(LCEmbeddings):
+            def embed_documents(self, texts):
+                return embeddings.embed_documents(texts)
+            def embed_query(self, query: str):
+                return embeddings.embed_query(query)
+
+        return LCEmbeddingWrapper()
+
+    def create(self, store_dir: str, embeddings, texts, metadatas, ids):
+        from langchain_chroma import Chroma
+        from chromadb.config import Settings
+        return Chroma.from_texts(
+            texts,
+            embedding=self._langchain_embeddings(embeddings),
+            metadatas=metadatas,
+            ids=ids,
+            persist_directory=store_dir,
+            client_settings=Settings(anonymized_telemetry=False),
+            collection_name=COLLECTION_NAME
+        )
+
+    def open(self, store_dir: str, embeddings):
+        from langchain_chroma import Chroma
+        from chromadb.config import Settings
+        return Chroma(
+            persist_directory=store_dir,
+            embedding_function=self._langchain_embeddings(embeddings),
+            client_settings=Settings(anonymized_telemetry=False),
+            collection_name=COLLECTION_NAME
+        )
+
+    def open_collection(self, store_dir: str):
+        import chromadb
+        from chromadb.config import Settings
+        client = chromadb.PersistentClient(path=store_dir, settings=Settings(anonymized_telemetry=False))
+        return client.get_collection(COLLECTION_NAME)
+
+    def release(self, store_dir: str, stores):
+        # 释放 chromadb 缓存的客户端（Windows 上否则无法删除文件）
+        for store in stores:
+            client = getattr(store, "_client", None)
+            try:
+                if client is not None and hasattr(client, "clear_system_cache"):
+                    client.clear_system_cache()
+            except Exception as e:
+                logging.debug(f"Failed to release chroma client for {store_dir}: {e}")
+
+class FlatBackend(VectorBackend):
+    """NumPy 内存映射矩阵 + SQLite 的轻量后端（见 flat_vectorstore），不需要导入 chromadb"""
+    name = "flat"
+
+    def exists(self, store_dir: str) -> bool:
+        return has_flat_store(store_dir)
+
+    def paths(self, store_dir: str) -> list:
+        path = os.path.join(store_dir, FLAT_STORE_DIRNAME)
+        return [path] if os.path.isdir(path) else []
+
+    def create(self, store_dir: str, embeddings, texts, metadatas, ids):
+        return FlatVectorStore.from_texts(texts, embedding=embeddings, metadatas=metadatas, ids=ids, persist_directory=store_dir)
+
+    def open(self, store_dir: str, embeddings):
+        return FlatVectorStore(store_dir, embeddings)
+
+    def open_collection(self, store_dir: str):
+        return open_flat_collection(store_dir)
+
+    def release(self, store_dir: str, stores):
+        close_flat_collection(store_dir)
+
+_BACKENDS = {backend.name: backend for backend in (ChromaBackend(), FlatBackend())}
+
+def get_vector_backend(name: str) -> VectorBackend:
+    return _BACKENDS[name]
+
+def available_vector_backends(store_dir: str) -> list:
+    """store_dir 中已有数据的后端名称"""
+    return [name for name, backend in _BACKENDS.items() if backend.exists(store_dir)]
+
+def configure_vector_store(settings: dict):
+    """
+    根据 config.json 中的 "vector_store" 配置选择新建向量库使用的后端，例如：
+    {"backend": "flat", "hnsw_threshold": 20000}
+    已存在的向量库按目录中的文件自动识别后端；两种都存在（迁移后）时使用配置的后端。
+    """
+    settings = settings or {}
+    backend = str(settings.get("backend", _vector_store_settings["backend"])).strip().lower()
+    if backend not in _BACKENDS:
+        logging.warning(f"Unknown vector store backend '{backend}', using chroma.")
+        backend = "chroma"
+    _vector_store_settings["backend"] = backend
+    configure_flat_store(settings)
+
+def _backend_for(store_dir: str) -> VectorBackend:
+    """store_dir 使用的后端：配置的后端已有数据时用它，否则用目录中已存在的后端，都没有时用配置的后端"""
+    configured = _BACKENDS[_vector_store_settings["backend"]]
+    if configured.exists(store_dir):
+        return configured
+    for backend in _BACKENDS.values():
+        if backend.exists(store_dir):
+            return backend
+    return configured
+
+def _release_stores(store_dir: str):
+    """从注册表移除 store_dir 下的所有向量库，并释放各后端与倒排索引占用的文件句柄"""
+    store_dir = os.path.abspath(store_dir)
+    with _store_registry_lock:
+        keys = [key for key in _store_registry if key[0] == store_dir]
+        stores = [_store_registry.pop(key) for key in keys]
+    for backend in _BACKENDS.values():
+        backend.release(store_dir, stores)
+    close_lexical_index(store_dir)
+
+def _has_vector_store(store_dir: str) -> bool:
+    """store_dir 下有任一后端的数据（Embedding 缓存与倒排索引不算），即已创建过向量库"""
+    return any(backend.exists(store_dir) for backend in _BACKENDS.values())
+
+class CachedEmbeddings:
+    """
+    向量库使用的 Embeddings（embed_documents / embed_query，Chroma 后端再包装为 langchain 的 Embeddings）：
+    先查 store_dir 下的 Embedding 缓存，未命中的文本再请求接口，失败时返回空列表。
+    embed_documents 的各批请求已由适配器的 EmbeddingExecutor 按重试策略逐批重试，这里只调用一次，
+    避免整批重发已成功的批次；embed_query 是单次请求，由 call_with_retry 重试。
+    """
+    def __init__(self, embedding_adapter, store_dir: str):
+        self.embedding_adapter = embedding_adapter
+        self.cache = get_embedding_cache(store_dir)
+
+    def embed_documents(self, texts):
+        # novel_generator.common 会导入 LLM SDK，延迟到实际请求时导入
+        from .common import call_with_retry
+        embedding_adapter = self.embedding_adapter
+        return cached_embed(self.cache, embedding_adapter, texts, lambda batch: call_with_retry(
+            func=embedding_adapter.embed_documents,
+            max_retries=1,
+            fallback_return=[],
+            texts=batch
+        ))
+
+    def embed_query(self, query: str):
+        from .common import call_with_retry
+        embedding_adapter = self.embedding_adapter
+        res = cached_embed(self.cache, embedding_adapter, [query], lambda batch: [call_with_retry(
+            func=embedding_adapter.embed_query,
+            fallback_return=[],
+            query=batch[0]
+        )])
+        return res[0] if res else []
+
 def clear_vector_store(filepath: str) -> bool:
-    """清空 清空向量库"""
+    """清空 清空向量库（保留 Embedding 缓存，重建时相同文本无需重新请求接口）"""
     import shutil
     store_dir = get_vectorstore_dir(filepath)
-    if not os.path.exists(store_dir):
+    _release_stores(store_dir)
+    if not _has_vector_store(store_dir):
         logging.info("No vector store found to clear.")
         return False
     try:
-        shutil.rmtree(store_dir)
-        logging.info(f"Vector store directory '{store_dir}' removed.")
+        for name in os.listdir(store_dir):
+            if name == EMBEDDING_CACHE_DIRNAME:
+                continue
+            path = os.path.join(store_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        logging.info(f"Vector store directory '{store_dir}' cleared.")
         return True
     except Exception as e:
         logging.error(f"无法删除向量库文件夹，请关闭程序后手动删除 {store_dir}。\n {str(e)}")
         traceback.print_exc()
         return False
 
-def init_vector_store(embedding_adapter, texts, filepath: str):
+def init_vector_store(embedding_adapter, texts, filepath: str, source: str = "text", chapter_number: int = None, file_name: str = ""):
     """
-    在 filepath 下创建/加载一个 Chroma 向量库并插入 texts。
+    在 filepath 下创建一个向量库（后端见 configure_vector_store）并插入 texts。
+    片段 ID 与 metadata 见 make_segment_id / _segment_documents。
     如果Embedding失败，则返回 None，不中断任务。
     """
-    from langchain.embeddings.base import Embeddings as LCEmbeddings
-
     store_dir = get_vectorstore_dir(filepath)
     os.makedirs(store_dir, exist_ok=True)
-    documents = [Document(page_content=str(t)) for t in texts]
+    ids, segments, metadatas = _segment_documents(texts, source, chapter_number, file_name)
 
     try:
-        class LCEmbeddingWrapper(LCEmbeddings):
-            def embed_documents(self, texts):
-                return call_with_retry(
-                    func=embedding_adapter.embed_documents,
-                    max_retries=3,
-                    fallback_return=[],
-                    texts=texts
-                )
-            def embed_query(self, query: str):
-                res = call_with_retry(
-                    func=embedding_adapter.embed_query,
-                    max_retries=3,
-                    fallback_return=[],
-                    query=query
-                )
-                return res
-
-        chroma_embedding = LCEmbeddingWrapper()
-        vectorstore = Chroma.from_documents(
-            documents,
-            embedding=chroma_embedding,
-            persist_directory=store_dir,
-            client_settings=Settings(anonymized_telemetry=False),
-            collection_name="novel_collection"
-        )
+        embeddings = CachedEmbeddings(embedding_adapter, store_dir)
+        vectorstore = _backend_for(store_dir).create(store_dir, embeddings, segments, metadatas, ids)
+        index = get_lexical_index(store_dir)
+        if index is not None:
+            index.add(ids, segments, metadatas)
+        with _store_registry_lock:
+            _store_registry[_registry_key(embedding_adapter, store_dir)] = vectorstore
         return vectorstore
     except Exception as e:
         logging.warning(f"Init vector store failed: {e}")
@@ -88,40 +384,33 @@ def init_vector_store(embedding_adapter, texts, filepath: str):
 
 def load_vector_store(embedding_adapter, filepath: str):
     """
-    读取已存在的 Chroma 向量库。若不存在则返回 None。
+    读取已存在的向量库（Chroma 或 flat，按目录中的文件识别）。若不存在则返回 None。
     如果加载失败（embedding 或IO问题），则返回 None。
+    同一目录、同一 Embedding 配置只打开一次，之后直接返回已打开的实例。
     """
-    from langchain.embeddings.base import Embeddings as LCEmbeddings
     store_dir = get_vectorstore_dir(filepath)
-    if not os.path.exists(store_dir):
+    if not _has_vector_store(store_dir):
         logging.info("Vector store not found. Will return None.")
+        _release_stores(store_dir)
         return None
 
+    key = _registry_key(embedding_adapter, store_dir)
     try:
-        class LCEmbeddingWrapper(LCEmbeddings):
-            def embed_documents(self, texts):
-                return call_with_retry(
-                    func=embedding_adapter.embed_documents,
-                    max_retries=3,
-                    fallback_return=[],
-                    texts=texts
-                )
-            def embed_query(self, query: str):
-                res = call_with_retry(
-                    func=embedding_adapter.embed_query,
-                    max_retries=3,
-                    fallback_return=[],
-                    query=query
-                )
-                return res
-
-        chroma_embedding = LCEmbeddingWrapper()
-        return Chroma(
-            persist_directory=store_dir,
-            embedding_function=chroma_embedding,
-            client_settings=Settings(anonymized_telemetry=False),
-            collection_name="novel_collection"
-        )
+        with _store_registry_lock:
+            store = _store_registry.get(key)
+            if store is None:
+                embeddings = CachedEmbeddings(embedding_adapter, store_dir)
+                store = _backend_for(store_dir).open(store_dir, embeddings)
+                try:
+                    _backfill_legacy_metadata(store)
+                except Exception as e:
+                    logging.warning(f"Failed to tag legacy segments: {e}")
+                try:
+                    _sync_lexical_index(store)
+                except Exception as e:
+                    logging.warning(f"[LexicalIndex] Failed to rebuild lexical index: {e}")
+                _store_registry[key] = store
+            return store
     except Exception as e:
         logging.warning(f"Failed to load vector store: {e}")
         traceback.print_exc()
@@ -146,6 +435,7 @@ def split_text_for_vectorstore(chapter_text: str, max_length: int = 500, similar
     if not chapter_text.strip():
         return []
     
+    import nltk
     nltk.download('punkt', quiet=True)
     nltk.download('punkt_tab', quiet=True)
     sentences = nltk.sent_tokenize(chapter_text)
@@ -173,13 +463,49 @@ def split_text_for_vectorstore(chapter_text: str, max_length: int = 500, similar
     
     return final_segments
 
-def update_vector_store(embedding_adapter, new_chapter: str, filepath: str):
+def upsert_segments(store, texts, source: str, chapter_number: int = None, file_name: str = "") -> dict:
+    """
+    按确定性 ID 写入片段：已存在的 ID 跳过（不重新嵌入），
+    指定 chapter_number 时再删除该 (来源, 章节) 下不在本次列表中的旧片段。
+    先写入新片段、后删除旧片段，读取方不会看到该章节片段缺失的中间状态；
+    同一向量库的写入由写锁串行化。返回 {"added", "unchanged", "removed"}。
+    """
+    ids, segments, metadatas = _segment_documents(texts, source, chapter_number, file_name)
+    collection = store._collection
+    store_dir = getattr(store, "_persist_directory", None) or ""
+    index = get_lexical_index(store_dir) if store_dir else None
+    with _write_lock(store_dir):
+        existing = set(collection.get(ids=ids, include=[])["ids"]) if ids else set()
+        new = [(i, text, metadata) for i, text, metadata in zip(ids, segments, metadatas) if i not in existing]
+        new_ids = [i for i, _, _ in new]
+        if new:
+            new_texts = [text for _, text, _ in new]
+            new_metadatas = [metadata for _, _, metadata in new]
+            store.add_texts(new_texts, metadatas=new_metadatas, ids=new_ids)
+            if index is not None:
+                index.add(new_ids, new_texts, new_metadatas)
+        stale = []
+        if chapter_number is not None:
+            previous = collection.get(
+                where={"$and": [{"source": source}, {"chapter": int(chapter_number)}]},
+                include=[]
+            )["ids"]
+            keep = set(ids)
+            stale = [i for i in previous if i not in keep]
+            if stale:
+                collection.delete(ids=stale)
+                if index is not None:
+                    index.remove(stale)
+    return {"added": len(new_ids), "unchanged": len(ids) - len(new_ids), "removed": len(stale)}
+
+def update_vector_store(embedding_adapter, new_chapter: str, filepath: str, chapter_number: int = None):
     """
     将最新章节文本插入到向量库中。
+    传入 chapter_number 时替换该章节此前写入的片段（重新定稿不会产生重复片段）。
     若库不存在则初始化；若初始化/更新失败，则跳过。
     """
-    from utils import read_file, clear_file_content, save_string_to_txt
     splitted_texts = split_text_for_vectorstore(new_chapter)
+    file_name = f"chapter_{chapter_number}.txt" if chapter_number is not None else ""
     if not splitted_texts:
         logging.warning("No valid text to insert into vector store. Skipping.")
         return
@@ -187,7 +513,10 @@ def update_vector_store(embedding_adapter, new_chapter: str, filepath: str):
     store = load_vector_store(embedding_adapter, filepath)
     if not store:
         logging.info("Vector store does not exist or failed to load. Initializing a new one for new chapter...")
-        store = init_vector_store(embedding_adapter, splitted_texts, filepath)
+        store = init_vector_store(
+            embedding_adapter, splitted_texts, filepath,
+            source="chapter", chapter_number=chapter_number, file_name=file_name
+        )
         if not store:
             logging.warning("Init vector store failed, skip embedding.")
         else:
@@ -195,37 +524,263 @@ def update_vector_store(embedding_adapter, new_chapter: str, filepath: str):
         return
 
     try:
-        docs = [Document(page_content=str(t)) for t in splitted_texts]
-        store.add_documents(docs)
-        logging.info("Vector store updated with the new chapter splitted segments.")
+        stats = upsert_segments(store, splitted_texts, "chapter", chapter_number, file_name)
+        logging.info(
+            f"Vector store updated with the new chapter splitted segments "
+            f"(added={stats['added']}, unchanged={stats['unchanged']}, removed={stats['removed']})."
+        )
     except Exception as e:
         logging.warning(f"Failed to update vector store: {e}")
         traceback.print_exc()
 
+def compact_vector_store(filepath: str) -> dict:
+    """
+    整理已有向量库：按规范化内容去重，同一内容只保留一条（优先保留带确定性 ID 的片段），
+    用于清理旧版本重复定稿、重复导入留下的重复片段。不需要重新嵌入。
+    返回 {"before", "after", "removed"}；向量库不存在或整理失败时返回 None。
+    """
+    store_dir = get_vectorstore_dir(filepath)
+    if not _has_vector_store(store_dir):
+        logging.info("No vector store found to compact.")
+        return None
+    try:
+        collection = _backend_for(store_dir).open_collection(store_dir)
+        with _write_lock(store_dir):
+            data = collection.get(include=["documents", "metadatas"])
+            keep = {}
+            duplicates = []
+            for doc_id, text, metadata in zip(data["ids"], data["documents"], data["metadatas"] or [None] * len(data["ids"])):
+                digest = content_hash(text or "")
+                deterministic = bool(metadata and metadata.get("content_hash"))
+                kept = keep.get(digest)
+                if kept is None:
+                    keep[digest] = (doc_id, deterministic)
+                elif deterministic and not kept[1]:
+                    duplicates.append(kept[0])
+                    keep[digest] = (doc_id, deterministic)
+                else:
+                    duplicates.append(doc_id)
+            for start in range(0, len(duplicates), 500):
+                collection.delete(ids=duplicates[start:start + 500])
+            index = get_lexical_index(store_dir)
+            if index is not None and duplicates:
+                index.remove(duplicates)
+        stats = {"before": len(data["ids"]), "after": len(data["ids"]) - len(duplicates), "removed": len(duplicates)}
+        logging.info(f"Vector store compacted: {stats}")
+        return stats
+    except Exception as e:
+        logging.warning(f"Failed to compact vector store: {e}")
+        traceback.print_exc()
+        return None
+
+def migrate_chroma_to_flat(filepath: str, batch_size: int = 500) -> dict:
+    """
+    把已有的 Chroma 向量库（连同向量、文本与 metadata，ID 不变）复制到 flat 后端，不需要重新嵌入。
+    迁移前 flat 中已有的片段会被清除；Chroma 的文件保留，确认无误后可手动删除。
+    把 "vector_store" 配置的 backend 设为 "flat"（或删除 Chroma 文件）后即使用迁移后的向量库。
+    返回 {"segments", "dim"}；没有 Chroma 向量库或迁移失败时返回 None。
+    """
+    store_dir = get_vectorstore_dir(filepath)
+    chroma = _BACKENDS["chroma"]
+    if not chroma.exists(store_dir):
+        logging.info("No Chroma vector store found to migrate.")
+        return None
+    _release_stores(store_dir)
+    try:
+        source = chroma.open_collection(store_dir)
+        target = open_flat_collection(store_dir)
+        with _write_lock(store_dir):
+            target.delete(ids=target.get(include=[])["ids"])
+            total = source.count()
+            for offset in range(0, total, batch_size):
+                data = source.get(include=["embeddings", "documents", "metadatas"], limit=batch_size, offset=offset)
+                if not len(data["ids"]):
+                    break
+                metadatas = data.get("metadatas")
+                target.add(
+                    ids=data["ids"],
+                    embeddings=data["embeddings"],
+                    documents=[d or "" for d in data["documents"]],
+                    metadatas=metadatas if metadatas is not None else [None] * len(data["ids"])
+                )
+        stats = {"segments": target.count(), "dim": target.dim}
+        logging.info(f"Migrated Chroma vector store to flat backend: {stats}")
+        return stats
+    except Exception as e:
+        logging.warning(f"Failed to migrate vector store: {e}")
+        traceback.print_exc()
+        return None
+    finally:
+        _release_stores(store_dir)
+
 def get_relevant_context_from_vector_store(embedding_adapter, query: str, filepath: str, k: int = 2) -> str:
     """
-    从向量库中检索与 query 最相关的 k 条文本，拼接后返回。
+    从向量库中检索与 query 最相关的 k 条文本（向量与字面混合检索），拼接后返回。
     如果向量库加载/检索失败，则返回空字符串。
     最终只返回最多2000字符的检索片段。
     """
+    results = get_relevant_contexts_from_vector_store(embedding_adapter, [query], filepath, k=k)[0]
+    if not results:
+        return ""
+    return combine_retrieved_texts([text for text, _, _ in results])
+
+def combine_retrieved_texts(texts, max_chars: int = 2000) -> str:
+    """拼接检索到的片段，最多保留 max_chars 个字符"""
+    combined = "\n".join(texts)
+    if len(combined) > max_chars:
+        combined = combined[:max_chars]
+    return combined
+
+def reciprocal_rank_fusion(rankings, k: int, rrf_k: int = RRF_K) -> list:
+    """
+    倒数排名融合：rankings 为若干按相关度排好序的 [(id, 片段文本, 距离或 None, metadata), ...]，
+    每个 id 的得分为其在各列表中 1 / (rrf_k + 名次) 之和，返回得分最高的 k 条 (id, 片段文本, 距离, metadata)。
+    同一 id 出现在多个列表时，距离取稠密检索给出的值。
+    """
+    scores = {}
+    items = {}
+    for ranking in rankings:
+        for rank, (doc_id, text, distance, metadata) in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (rrf_k + rank)
+            if doc_id not in items or items[doc_id][2] is None:
+                items[doc_id] = (doc_id, text, distance, metadata or {})
+    ordered = sorted(scores, key=lambda doc_id: -scores[doc_id])
+    return [items[doc_id] for doc_id in ordered[:k]]
+
+def get_relevant_contexts_from_vector_store(embedding_adapter, queries, filepath: str, k: int = 2, where: dict = None,
+                                            with_embeddings: bool = False):
+    """
+    批量混合检索：所有 queries 一次 embed_documents 得到向量，再用一次 collection.query 取稠密候选，
+    同时在本地倒排索引上做 BM25 字面检索，两路各取 k 的若干倍候选后按倒数排名融合（RRF）取前 k 条。
+    返回与 queries 一一对应的列表，每项为 [(片段文本, 距离, metadata), ...]，按融合得分排序；
+    只被字面检索命中的片段距离为 None。
+    with_embeddings 为 True 时每条结果附带片段向量：(片段文本, 距离, metadata, 向量)，供 select_diverse_contexts 使用。
+    where 为 Chroma 的元数据过滤条件（如 exclude_recent_chapters_filter），两路检索同样生效。
+    向量库加载 / 检索失败时每项为空列表；倒排索引不可用时退化为纯向量检索。
+    """
+    queries = [str(q) for q in queries]
+    empty = [[] for _ in queries]
+    if not queries:
+        return empty
     store = load_vector_store(embedding_adapter, filepath)
     if not store:
-        logging.info("No vector store found or load failed. Returning empty context.")
-        return ""
+        logging.info("No vector store found or load failed. Returning empty contexts.")
+        return empty
 
+    candidates = k * HYBRID_CANDIDATE_FACTOR
+    dense = [[] for _ in queries]
+    vectors = {}
     try:
-        docs = store.similarity_search(query, k=k)
-        if not docs:
-            logging.info(f"No relevant documents found for query '{query}'. Returning empty context.")
-            return ""
-        combined = "\n".join([d.page_content for d in docs])
-        if len(combined) > 2000:
-            combined = combined[:2000]
-        return combined
+        # 经由向量库的 embedding 包装器，命中 Embedding 缓存的查询不再请求接口
+        query_embeddings = store.embeddings.embed_documents(queries)
+        if not query_embeddings or len(query_embeddings) != len(queries) or not all(query_embeddings):
+            logging.warning("Embedding queries failed. Falling back to lexical retrieval.")
+        else:
+            result = store._collection.query(
+                query_embeddings=query_embeddings,
+                n_results=candidates,
+                where=where or None,
+                include=["documents", "distances", "metadatas"] + (["embeddings"] if with_embeddings else [])
+            )
+            for i, (ids, documents, distances, metadatas) in enumerate(zip(
+                result.get("ids") or empty, result.get("documents") or empty,
+                result.get("distances") or empty, result.get("metadatas") or empty
+            )):
+                metadatas = metadatas or [None] * len(documents or [])
+                if with_embeddings and result.get("embeddings") is not None:
+                    vectors.update(zip(ids or [], result["embeddings"][i]))
+                dense[i] = [
+                    (doc_id, doc, dist, metadata or {})
+                    for doc_id, doc, dist, metadata in zip(ids or [], documents or [], distances or [], metadatas) if doc
+                ]
     except Exception as e:
-        logging.warning(f"Similarity search failed: {e}")
+        logging.warning(f"Batched similarity search failed: {e}")
         traceback.print_exc()
-        return ""
+
+    lexical = [[] for _ in queries]
+    index = get_lexical_index(get_vectorstore_dir(filepath))
+    if index is not None:
+        try:
+            for i, query in enumerate(queries):
+                lexical[i] = [
+                    (doc_id, text, None, metadata)
+                    for doc_id, text, _, metadata in index.search(query, candidates, where)
+                ]
+        except Exception as e:
+            logging.warning(f"[LexicalIndex] Lexical search failed: {e}")
+            lexical = [[] for _ in queries]
+
+    fused = [reciprocal_rank_fusion([dense_items, lexical_items], k) for dense_items, lexical_items in zip(dense, lexical)]
+    if with_embeddings:
+        # 只被字面检索命中的片段没有随 query 返回向量，一次 get 补齐
+        missing = sorted({doc_id for items in fused for doc_id, _, _, _ in items if doc_id not in vectors})
+        if missing:
+            try:
+                data = store._collection.get(ids=missing, include=["embeddings"])
+                vectors.update(zip(data["ids"], data["embeddings"]))
+            except Exception as e:
+                logging.warning(f"Failed to fetch embeddings for lexical hits: {e}")
+    contexts = []
+    for query, items in zip(queries, fused):
+        if not items:
+            logging.info(f"No relevant documents found for query '{query}'.")
+        if with_embeddings:
+            contexts.append([(text, distance, metadata, vectors.get(doc_id)) for doc_id, text, distance, metadata in items])
+        else:
+            contexts.append([(text, distance, metadata) for _, text, distance, metadata in items])
+    return contexts
+
+def select_diverse_contexts(group_results, k: int, lambda_mult: float = MMR_LAMBDA,
+                            duplicate_similarity: float = DUPLICATE_SIMILARITY):
+    """
+    跨关键词组的最大边际相关（MMR）选择与去重。group_results 为 get_relevant_contexts_from_vector_store(with_embeddings=True)
+    的结果，每组取其排序位置作为相关度（组内第一名为 1）。贪心地在所有组的候选中选 λ·相关度 − (1−λ)·与已选片段的最大相似度
+    最高的一条，直到每组选满 k 条或没有候选；同一片段只会被一个组选中，与已选片段余弦相似度达到 duplicate_similarity 的候选直接丢弃。
+    返回与 group_results 一一对应的 [(片段文本, 距离, metadata), ...]，组内保持原有顺序。
+    """
+    candidates = []
+    for group, items in enumerate(group_results):
+        for rank, (text, distance, metadata, vector) in enumerate(items):
+            candidates.append((group, 1.0 - rank / max(len(items), 1), text, distance, metadata, vector))
+    selected = [[] for _ in group_results]
+    if not candidates:
+        return selected
+    dim = max((len(c[5]) for c in candidates if c[5] is not None), default=0)
+    matrix = np.zeros((len(candidates), max(dim, 1)), dtype=np.float32)
+    for i, candidate in enumerate(candidates):
+        if candidate[5] is not None and len(candidate[5]) == dim:
+            matrix[i] = candidate[5]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    similarity = matrix @ matrix.T
+    relevance = np.array([c[1] for c in candidates], dtype=np.float32)
+    groups = np.array([c[0] for c in candidates])
+    digests = {}
+    contents = np.array([
+        digests.setdefault((metadata or {}).get("content_hash") or content_hash(text), len(digests))
+        for _, _, text, _, metadata, _ in candidates
+    ])
+    available = np.ones(len(candidates), dtype=bool)
+    redundancy = np.zeros(len(candidates), dtype=np.float32)
+    quota = np.full(len(group_results), k)
+    picked = []
+    while available.any():
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        picked.append(best)
+        quota[groups[best]] -= 1
+        redundancy = np.maximum(redundancy, similarity[best])
+        available[best] = False
+        available &= redundancy < duplicate_similarity
+        available &= contents != contents[best]
+        available &= quota[groups] > 0
+    for i in sorted(picked):
+        group, _, text, distance, metadata, _ = candidates[i]
+        selected[group].append((text, distance, metadata))
+    if len(picked) < len(candidates):
+        logging.info(f"MMR kept {len(picked)} of {len(candidates)} retrieved segments across {len(group_results)} keyword groups.")
+    return selected
 
 def _get_sentence_transformer(model_name: str = 'paraphrase-MiniLM-L6-v2'):
     """获取sentence transformer模型，处理SSL问题"""
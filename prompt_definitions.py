@@ -702,3 +702,203 @@ Character_Import_Prompt = """\
 {content}
 <<待分析小说文本结束>>
 """
+
+# =============== 9. 稳定前缀布局 ===================
+# DeepSeek、OpenAI 等服务商会缓存重复出现的提示词前缀。以下模板供 "stable_prefix" 布局使用：
+# 同一项目内不变的资料与写作规则放在最前面且逐字节一致，逐章变化的字段统一放在其后。
+stable_project_prefix = """\
+以下为本项目的固定参考资料：
+<<小说设定>>
+{novel_setting}
+<<小说设定结束>>
+
+"""
+
+chunked_chapter_blueprint_prompt_stable = stable_project_prefix + """\
+需要生成总共{number_of_chapters}章的节奏分布，设计要求如下：
+1. 章节集群划分：
+- 每3-5章构成一个悬念单元，包含完整的小高潮
+- 单元之间设置"认知过山车"（连续2章紧张→1章缓冲）
+- 关键转折章需预留多视角铺垫
+
+2. 每章需明确：
+- 章节定位（角色/事件/主题等）
+- 核心悬念类型（信息差/道德困境/时间压力等）
+- 情感基调迁移（如从怀疑→恐惧→决绝）
+- 伏笔操作（埋设/强化/回收）
+- 认知颠覆强度（1-5级）
+
+输出格式示例：
+第n章 - [标题]
+本章定位：[角色/事件/主题/...]
+核心作用：[推进/转折/揭示/...]
+悬念密度：[紧凑/渐进/爆发/...]
+伏笔操作：埋设(A线索)→强化(B矛盾)...
+认知颠覆：★☆☆☆☆
+本章简述：[一句话概括]
+
+第n+1章 - [标题]
+本章定位：[角色/事件/主题/...]
+核心作用：[推进/转折/揭示/...]
+悬念密度：[紧凑/渐进/爆发/...]
+伏笔操作：埋设(A线索)→强化(B矛盾)...
+认知颠覆：★☆☆☆☆
+本章简述：[一句话概括]
+
+要求：
+- 使用精炼语言描述，每章字数控制在100字以内。
+- 合理安排节奏，确保整体悬念曲线的连贯性。
+- 在生成{number_of_chapters}章前不要出现结局章节。
+
+仅给出最终文本，不要解释任何内容。
+
+当前已有章节目录（若为空则说明是初始生成）：
+{chapter_list}
+
+内容指导：{user_guidance}
+
+现在请设计第{n}章到第{m}的节奏分布。
+"""
+
+first_chapter_draft_prompt_stable = stable_project_prefix + """\
+写作要求：至少设计下方2个或以上具有动态张力的场景：
+1. 对话场景：
+   - 潜台词冲突（表面谈论A，实际博弈B）
+   - 权力关系变化（通过非对称对话长度体现）
+
+2. 动作场景：
+   - 环境交互细节（至少3个感官描写）
+   - 节奏控制（短句加速+比喻减速）
+   - 动作揭示人物隐藏特质
+
+3. 心理场景：
+   - 认知失调的具体表现（行为矛盾）
+   - 隐喻系统的运用（连接世界观符号）
+   - 决策前的价值天平描写
+
+4. 环境场景：
+   - 空间透视变化（宏观→微观→异常焦点）
+   - 非常规感官组合（如"听见阳光的重量"）
+   - 动态环境反映心理（环境与人物心理对应）
+
+格式要求：
+- 仅返回章节正文文本；
+- 不使用分章节小标题；
+- 不要使用markdown格式。
+
+即将创作：第 {novel_number} 章《{chapter_title}》
+本章定位：{chapter_role}
+核心作用：{chapter_purpose}
+悬念密度：{suspense_level}
+伏笔操作：{foreshadowing}
+认知颠覆：{plot_twist_level}
+本章简述：{chapter_summary}
+
+可用元素：
+- 核心人物(可能未指定)：{characters_involved}
+- 关键道具(可能未指定)：{key_items}
+- 空间坐标(可能未指定)：{scene_location}
+- 时间压力(可能未指定)：{time_constraint}
+
+额外指导(可能未指定)：{user_guidance}
+
+完成第 {novel_number} 章的正文，字数要求{word_number}字。
+"""
+
+# 与 next_chapter_draft_prompt 内容相同，仅把固定写作规则前移作为前缀（原模板不含小说设定，这里也不加）
+next_chapter_draft_prompt_stable = """\
+🎯 知识库应用规则（适用于下文的“知识库参考”）：
+1. 内容分级：
+   - 写作技法类（优先）：
+     ▸ 场景构建模板
+     ▸ 对话写作技巧
+     ▸ 悬念营造手法
+   - 设定资料类（选择性）：
+     ▸ 独特世界观元素
+     ▸ 未使用过的技术细节
+   - 禁忌项类（必须规避）：
+     ▸ 已在前文出现过的特定情节
+     ▸ 重复的人物关系发展
+
+2. 使用限制：
+   ● 禁止直接复制已有章节的情节模式
+   ● 历史章节内容仅允许：
+     → 参照叙事节奏（不超过20%相似度）
+     → 延续必要的人物反应模式（需改编30%以上）
+   ● 第三方写作知识优先用于：
+     → 增强场景表现力（占知识应用的60%以上）
+     → 创新悬念设计（至少1处新技巧）
+
+3. 冲突检测：
+   ⚠️ 若检测到与历史章节重复：
+     - 相似度>40%：必须重构叙事角度
+     - 相似度20-40%：替换至少3个关键要素
+     - 相似度<20%：允许保留核心概念但改变表现形式
+
+格式要求：
+- 仅返回章节正文文本；
+- 不使用分章节小标题；
+- 不要使用markdown格式。
+
+参考文档：
+└── 前文摘要：
+    {global_summary}
+
+└── 角色状态：
+    {character_state}
+
+└── 前章结尾段：
+    {previous_chapter_excerpt}
+
+└── 用户指导：
+    {user_guidance}
+
+└── 当前章节摘要：
+    {short_summary}
+
+当前章节信息：
+第{novel_number}章《{chapter_title}》：
+├── 章节定位：{chapter_role}
+├── 核心作用：{chapter_purpose}
+├── 悬念密度：{suspense_level}
+├── 伏笔设计：{foreshadowing}
+├── 转折程度：{plot_twist_level}
+├── 章节简述：{chapter_summary}
+├── 字数要求：{word_number}字
+├── 核心人物：{characters_involved}
+├── 关键道具：{key_items}
+├── 场景地点：{scene_location}
+└── 时间压力：{time_constraint}
+
+下一章节目录
+第{next_chapter_number}章《{next_chapter_title}》：
+├── 章节定位：{next_chapter_role}
+├── 核心作用：{next_chapter_purpose}
+├── 悬念密度：{next_chapter_suspense_level}
+├── 伏笔设计：{next_chapter_foreshadowing}
+├── 转折程度：{next_chapter_plot_twist_level}
+└── 章节简述：{next_chapter_summary}
+
+知识库参考：（按优先级应用）
+{filtered_context}
+
+依据前面所有设定，开始完成第 {novel_number} 章的正文，字数要求{word_number}字，
+内容生成严格遵循：
+-用户指导
+-当前章节摘要
+-当前章节信息
+-无逻辑漏洞,
+确保章节内容与前文摘要、前章结尾段衔接流畅、下一章目录保证上下文完整性。
+"""
+
+# =============== 10. 截断续写 ===================
+chapter_continuation_prompt = """\
+你正在创作第{novel_number}章的正文（目标约{word_number}字，已完成约{written_number}字），上一次输出因长度限制在中途被截断。
+以下是已写正文的最后部分：
+{draft_tail}
+
+请从截断处直接续写，要求：
+- 紧接上文最后一个字继续，不要重复已写的内容，不要添加标题、说明或总结
+- 保持原有的人称、文风与情节走向
+- 完成本章剩余的情节，并在合适处自然收尾
+"""
@@ -0,0 +1,187 @@
+# rate_limiter.py
+# -*- coding: utf-8 -*-
+"""
+按 (服务商, API Key) 共享的限流器：请求数/分钟(RPM)、token 数/分钟(TPM) 两个令牌桶，外加最大并发数。
+令牌桶允许预扣为负数，后到的请求按 FIFO 顺序排队等待，使吞吐稳定在限额之下而不是反复触发 429。
+配置来自 config.json 的 "rate_limits"，例如：
+{
+    "rate_limits": {
+        "DeepSeek": {"rpm": 60, "tpm": 200000, "max_concurrency": 4},
+        "embedding:OpenAI": {"rpm": 300}
+    }
+}
+"""
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+_limits_config = {}
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+# 超过该等待时间才记录日志，避免刷屏
+LOG_WAIT_THRESHOLD = 1.0
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中文约 1 token/字，其余约 4 字符/token"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if ord(ch) > 0x2E7F)
+    return cjk + (len(text) - cjk + 3) // 4
+
+class _TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = float(per_minute) / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        """预扣 amount，返回需要等待的秒数"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def refund(self, amount: float):
+        """退还预扣的 amount（请求在发出前被取消时）"""
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+class RateLimiter:
+    def __init__(self, name: str, rpm: float = None, tpm: float = None, max_concurrency: int = None):
+        self.name = name
+        self._lock = threading.Lock()
+        self._request_bucket = _TokenBucket(rpm) if rpm else None
+        self._token_bucket = _TokenBucket(tpm) if tpm else None
+        self._semaphore = threading.BoundedSemaphore(int(max_concurrency)) if max_concurrency else None
+        self.requests = 0
+        self.waiting = 0
+        self.in_flight = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _reserve(self, requests: int, tokens: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            if self._request_bucket:
+                wait = max(wait, self._request_bucket.reserve(requests, now))
+            if self._token_bucket and tokens:
+                wait = max(wait, self._token_bucket.reserve(tokens, now))
+            self.requests += requests
+            self.waiting += 1
+            return wait
+
+    def _cancel(self, requests: int, tokens: int):
+        """等待期间被取消或出错：撤销 _reserve 的排队计数与预扣额度"""
+        with self._lock:
+            if self._request_bucket:
+                self._request_bucket.refund(requests)
+            if self._token_bucket and tokens:
+                self._token_bucket.refund(tokens)
+            self.requests -= requests
+            self.waiting -= 1
+
+    def _record(self, waited: float):
+        with self._lock:
+            self.waiting -= 1
+            self.in_flight += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        if waited >= LOG_WAIT_THRESHOLD:
+            logging.info(f"[RateLimiter] {self.name} waited {waited:.2f}s (queued={self.waiting}, in_flight={self.in_flight})")
+
+    def _done(self):
+        with self._lock:
+            self.in_flight -= 1
+        if self._semaphore:
+            self._semaphore.release()
+
+    @contextmanager
+    def limit(self, requests: int = 1, tokens: int = 0):
+        """阻塞直到允许发出请求；退出时释放并发名额"""
+        start = time.monotonic()
+        wait = self._reserve(requests, tokens)
+        try:
+            if wait > 0:
+                time.sleep(wait)
+            if self._semaphore:
+                self._semaphore.acquire()
+        except BaseException:
+            self._cancel(requests, tokens)
+            raise
+        self._record(time.monotonic() - start)
+        try:
+            yield
+        finally:
+            self._done()
+
+    @asynccontextmanager
+    async def alimit(self, requests: int = 1, tokens: int = 0):
+        """limit 的异步版本，等待期间不阻塞事件循环"""
+        start = time.monotonic()
+        wait = self._reserve(requests, tokens)
+        try:
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if self._semaphore:
+                while not self._semaphore.acquire(blocking=False):
+                    await asyncio.sleep(0.05)
+        except BaseException:
+            # 含 CancelledError：此时尚未取得并发名额，只需撤销预扣
+            self._cancel(requests, tokens)
+            raise
+        self._record(time.monotonic() - start)
+        try:
+            yield
+        finally:
+            self._done()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "waiting": self.waiting,
+                "in_flight": self.in_flight,
+                "total_wait": round(self.total_wait, 3),
+                "max_wait": round(self.max_wait, 3),
+            }
+
+def configure_rate_limits(config: dict):
+    """应用 config.json 中的 "rate_limits"；已创建的限流器会被丢弃并按新配置重建"""
+    global _limits_config
+    with _limiters_lock:
+        _limits_config = {str(k).strip().lower(): v for k, v in (config or {}).items() if isinstance(v, dict)}
+        _limiters.clear()
+
+def get_rate_limiter(provider: str, api_key: str = ""):
+    """
+    获取 (provider, api_key) 对应的共享限流器；该服务商未配置限额时返回 None。
+    """
+    provider = (provider or "").strip().lower()
+    conf = _limits_config.get(provider)
+    if not conf:
+        return None
+    key_hash = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:12]
+    key = (provider, key_hash)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(
+                name=f"{provider}#{key_hash}",
+                rpm=conf.get("rpm"),
+                tpm=conf.get("tpm"),
+                max_concurrency=conf.get("max_concurrency")
+            )
+            _limiters[key] = limiter
+        return limiter
+
+def get_rate_limit_stats() -> dict:
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.stats() for limiter in limiters}
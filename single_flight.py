@@ -0,0 +1,115 @@
+# single_flight.py
+# -*- coding: utf-8 -*-
+"""
+相同请求的在途合并（single-flight）：
+同一 key 的请求正在进行时，后到的调用方不再重复发出，而是等待在途请求的结果（或异常）。
+用于界面重复触发、多个项目共用同一提示词等场景下避免向服务商发出重复请求。
+线程与 asyncio 分别合并：同步调用在线程间合并，异步调用在同一事件循环内合并。
+"""
+import asyncio
+import threading
+import time
+
+# 发起请求的协程被取消时写入 future 的标记，等待方见到后重新发起
+_LEADER_CANCELLED = object()
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._async_flights = {}
+        self.coalesced = 0
+
+    def do(self, key, func, on_coalesced=None):
+        """
+        执行 func()；同 key 的调用已在进行时等待其结果。
+        on_coalesced(waited_seconds) 在本次调用被合并时回调。
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            started = time.monotonic()
+            flight.event.wait()
+            if on_coalesced is not None:
+                on_coalesced(time.monotonic() - started)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = func()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    async def ado(self, key, coro_func, on_coalesced=None):
+        """
+        do 的异步版本，coro_func() 返回协程。
+        发出请求的调用方被取消时不把取消传给等待方：等待方重新竞争，由其中一个重新发出请求。
+        """
+        loop = asyncio.get_running_loop()
+        flight_key = (id(loop), key)
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                future = self._async_flights.get(flight_key)
+                leader = future is None
+                if leader:
+                    future = self._async_flights[flight_key] = loop.create_future()
+                else:
+                    self.coalesced += 1
+            if leader:
+                break
+            try:
+                # shield：某个等待方被取消时不影响在途请求与其它等待方
+                result = await asyncio.shield(future)
+            except BaseException:
+                if on_coalesced is not None:
+                    on_coalesced(time.monotonic() - started)
+                raise
+            if result is not _LEADER_CANCELLED:
+                if on_coalesced is not None:
+                    on_coalesced(time.monotonic() - started)
+                return result
+            with self._lock:
+                self.coalesced -= 1
+        try:
+            result = await coro_func()
+        except asyncio.CancelledError:
+            self._finish(flight_key, future)
+            future.set_result(_LEADER_CANCELLED)
+            raise
+        except BaseException as e:
+            self._finish(flight_key, future)
+            future.set_exception(e)
+            future.exception()  # 没有等待方时避免 "exception was never retrieved" 警告
+            raise
+        self._finish(flight_key, future)
+        future.set_result(result)
+        return result
+
+    def _finish(self, flight_key, future):
+        """先移除在途记录再唤醒等待方，重新竞争的等待方可以立即成为新的发起方"""
+        with self._lock:
+            if self._async_flights.get(flight_key) is future:
+                self._async_flights.pop(flight_key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": len(self._flights) + len(self._async_flights), "coalesced": self.coalesced}
@@ -15,9 +15,17 @@ from novel_generator import (
     finalize_chapter,
     import_knowledge_file,
     clear_vector_store,
+    compact_vector_store,
     enrich_chapter_text
 )
 from consistency_checker import check_consistency
+from llm_metrics import format_metrics_summary, metrics_mark
+
+def log_llm_metrics(self, mark: int):
+    """在日志区输出本次操作期间按阶段汇总的 LLM 调用耗时与 token 数"""
+    summary = format_metrics_summary(since=mark)
+    if summary:
+        self.safe_log(summary)
 
 def generate_series_blueprint_ui(self):
     filepath = self.filepath_var.get().strip()
@@ -27,6 +35,7 @@ def generate_series_blueprint_ui(self):
 
     def task():
         self.disable_button_safe(self.btn_generate_blueprint)
+        mark = metrics_mark()
         try:
             interface_format = self.interface_format_var.get().strip()
             api_key = self.api_key_var.get().strip()
@@ -59,6 +68,7 @@ def generate_series_blueprint_ui(self):
         except Exception:
             self.handle_exception("生成系列蓝图时出错")
         finally:
+            log_llm_metrics(self, mark)
             self.enable_button_safe(self.btn_generate_blueprint)
     threading.Thread(target=task, daemon=True).start()
 
@@ -75,6 +85,7 @@ def generate_novel_architecture_ui(self):
             return
 
         self.disable_button_safe(self.btn_generate_architecture)
+        mark = metrics_mark()
         try:
             interface_format = self.interface_format_var.get().strip()
             api_key = self.api_key_var.get().strip()
@@ -109,6 +120,7 @@ def generate_novel_architecture_ui(self):
         except Exception:
             self.handle_exception("生成小说架构时出错")
         finally:
+            log_llm_metrics(self, mark)
             self.enable_button_safe(self.btn_generate_architecture)
     threading.Thread(target=task, daemon=True).start()
 
@@ -123,6 +135,7 @@ def generate_chapter_blueprint_ui(self):
             self.enable_button_safe(self.btn_generate_chapter)
             return
         self.disable_button_safe(self.btn_generate_directory)
+        mark = metrics_mark()
         try:
             interface_format = self.interface_format_var.get().strip()
             api_key = self.api_key_var.get().strip()
@@ -151,6 +164,7 @@ def generate_chapter_blueprint_ui(self):
         except Exception:
             self.handle_exception("生成章节蓝图时出错")
         finally:
+            log_llm_metrics(self, mark)
             self.enable_button_safe(self.btn_generate_directory)
     threading.Thread(target=task, daemon=True).start()
 
@@ -162,6 +176,7 @@ def generate_chapter_draft_ui(self):
 
     def task():
         self.disable_button_safe(self.btn_generate_chapter)
+        mark = metrics_mark()
         try:
             interface_format = self.interface_format_var.get().strip()
             api_key = self.api_key_var.get().strip()
@@ -306,6 +321,14 @@ def generate_chapter_draft_ui(self):
                 return
 
             self.safe_log("开始生成章节草稿...")
+            self.master.after(0, lambda: self.chapter_result.delete("0.0", "end"))
+
+            def on_draft_chunk(chunk):
+                def append():
+                    self.chapter_result.insert("end", chunk)
+                    self.chapter_result.see("end")
+                self.master.after(0, append)
+
             from novel_generator.chapter import generate_chapter_draft
             draft_text = generate_chapter_draft(
                 api_key=api_key,
@@ -328,7 +351,8 @@ def generate_chapter_draft_ui(self):
                 interface_format=interface_format,
                 max_tokens=max_tokens,
                 timeout=timeout_val,
-                custom_prompt_text=edited_prompt  # 使用用户编辑后的提示词
+                custom_prompt_text=edited_prompt,  # 使用用户编辑后的提示词
+                on_chunk=on_draft_chunk  # 流式显示草稿内容
             )
             if draft_text:
                 self.safe_log(f"✅ 第{chap_num}章草稿生成完成。请在左侧查看或编辑。")
@@ -338,6 +362,7 @@ def generate_chapter_draft_ui(self):
         except Exception:
             self.handle_exception("生成章节草稿时出错")
         finally:
+            log_llm_metrics(self, mark)
             self.enable_button_safe(self.btn_generate_chapter)
     threading.Thread(target=task, daemon=True).start()
 
@@ -353,6 +378,7 @@ def finalize_chapter_ui(self):
             return
 
         self.disable_button_safe(self.btn_finalize_chapter)
+        mark = metrics_mark()
         try:
             interface_format = self.interface_format_var.get().strip()
             api_key = self.api_key_var.get().strip()
@@ -422,6 +448,7 @@ def finalize_chapter_ui(self):
         except Exception:
             self.handle_exception("定稿章节时出错")
         finally:
+            log_llm_metrics(self, mark)
             self.enable_button_safe(self.btn_finalize_chapter)
     threading.Thread(target=task, daemon=True).start()
 
@@ -433,6 +460,7 @@ def do_consistency_check(self):
 
     def task():
         self.disable_button_safe(self.btn_check_consistency)
+        mark = metrics_mark()
         try:
             api_key = self.api_key_var.get().strip()
             base_url = self.base_url_var.get().strip()
@@ -463,13 +491,15 @@ def do_consistency_check(self):
                 interface_format=interface_format,
                 max_tokens=max_tokens,
                 timeout=timeout,
-                plot_arcs=""
+                plot_arcs="",
+                filepath=filepath
             )
             self.safe_log("审校结果：")
             self.safe_log(result)
         except Exception:
             self.handle_exception("审校时出错")
         finally:
+            log_llm_metrics(self, mark)
             self.enable_button_safe(self.btn_check_consistency)
     threading.Thread(target=task, daemon=True).start()
 
@@ -519,7 +549,8 @@ def import_knowledge_handler(self):
                         embedding_interface_format=emb_format,
                         embedding_model_name=emb_model,
                         file_path=temp_path,
-                        filepath=self.filepath_var.get().strip()
+                        filepath=self.filepath_var.get().strip(),
+                        source_name=os.path.basename(selected_file)
                     )
                     self.safe_log("✅ 知识库文件导入完成。")
                 finally:
@@ -556,6 +587,27 @@ def clear_vectorstore_handler(self):
             else:
                 self.log(f"未能清空向量库，请关闭程序后手动删除 {filepath} 下的 vectorstore 文件夹。")
 
+def compact_vectorstore_handler(self):
+    filepath = self.filepath_var.get().strip()
+    if not filepath:
+        messagebox.showwarning("警告", "请先配置保存文件路径。")
+        return
+
+    def task():
+        self.disable_button_safe(self.btn_compact_vectorstore)
+        try:
+            self.safe_log("开始整理向量库（去除重复片段）...")
+            stats = compact_vector_store(filepath)
+            if stats is None:
+                self.safe_log("未找到向量库或整理失败。")
+            else:
+                self.safe_log(f"✅ 向量库整理完成：共 {stats['before']} 段，删除重复 {stats['removed']} 段，剩余 {stats['after']} 段。")
+        except Exception:
+            self.handle_exception("整理向量库时出错")
+        finally:
+            self.enable_button_safe(self.btn_compact_vectorstore)
+    threading.Thread(target=task, daemon=True).start()
+
 def show_plot_arcs_ui(self):
     filepath = self.filepath_var.get().strip()
     if not filepath:
@@ -12,7 +12,7 @@ from llm_adapters import create_llm_adapter
 import inspect
 import importlib
 
-from config_manager import load_config, save_config, test_llm_config, test_embedding_config
+from config_manager import load_config, save_config, test_llm_config, test_embedding_config, apply_runtime_config
 from utils import read_file, save_string_to_txt, clear_file_content
 from tooltips import tooltips
 
@@ -55,6 +55,7 @@ class NovelGeneratorGUI:
         # --------------- 配置文件路径 ---------------
         self.config_file = "config.json"
         self.loaded_config = load_config(self.config_file)
+        apply_runtime_config(self.loaded_config)
 
         if self.loaded_config:
             last_llm = self.loaded_config.get("last_interface_format", "OpenAI")
@@ -132,6 +132,12 @@ def build_optional_buttons_area(self, start_row=2):
     )
     self.btn_clear_vectorstore.grid(row=0, column=2, padx=5, pady=5, sticky="ew")
 
+    self.btn_compact_vectorstore = ctk.CTkButton(
+        self.optional_btn_frame, text="整理向量库", command=self.compact_vectorstore_handler,
+        font=("Microsoft YaHei", 12), width=100
+    )
+    self.btn_compact_vectorstore.grid(row=1, column=2, padx=5, pady=5, sticky="ew")
+
     self.plot_arcs_btn = ctk.CTkButton(
         self.optional_btn_frame, text="查看剧情要点", command=self.show_plot_arcs_ui,
         font=("Microsoft YaHei", 12), width=100
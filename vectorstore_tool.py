@@ -0,0 +1,118 @@
+# vectorstore_tool.py
+# -*- coding: utf-8 -*-
+"""
+向量库维护工具（命令行）：
+    python vectorstore_tool.py migrate <项目目录>                  # 把 Chroma 向量库复制到 flat 后端，不重新嵌入
+    python vectorstore_tool.py benchmark <项目目录> --queries 50 -k 4
+benchmark 对项目向量库中已存在的每个后端分别测量：
+新进程中导入向量库模块与后端并打开向量库的耗时、逐条与批量检索的延迟、磁盘占用。
+检索向量取自向量库中随机抽样的片段，不请求 Embedding 接口。
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from novel_generator.vectorstore_utils import (
+    available_vector_backends,
+    get_vector_backend,
+    get_vectorstore_dir,
+    migrate_chroma_to_flat
+)
+
+# 在新进程中计时：导入向量库模块与后端依赖（chromadb 等）并打开向量库、读取片段数。
+# 不执行 novel_generator/__init__（会导入全部生成流程与 LLM SDK），只计向量库本身需要的导入
+_LOAD_SNIPPET = """
+import json, sys, time, types
+package = types.ModuleType("novel_generator")
+package.__path__ = [sys.argv[3]]
+sys.modules["novel_generator"] = package
+started = time.perf_counter()
+from novel_generator.vectorstore_utils import get_vector_backend
+count = get_vector_backend(sys.argv[1]).open_collection(sys.argv[2]).count()
+print(json.dumps({"load": time.perf_counter() - started, "count": count}))
+"""
+
+def measure_load(backend_name: str, store_dir: str) -> dict:
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.run(
+        [sys.executable, "-c", _LOAD_SNIPPET, backend_name, store_dir, os.path.join(repo_dir, "novel_generator")],
+        cwd=repo_dir, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def measure_queries(backend_name: str, store_dir: str, queries: int, k: int) -> dict:
+    """逐条检索 queries 次与一次批量检索的耗时（毫秒）"""
+    collection = get_vector_backend(backend_name).open_collection(store_dir)
+    ids = collection.get(include=[])["ids"]
+    if not len(ids):
+        return {}
+    sample = random.Random(0).choices(ids, k=queries)
+    vectors = np.asarray(collection.get(ids=sorted(set(sample)), include=["embeddings"])["embeddings"], dtype=np.float32)
+    vectors = vectors[np.random.default_rng(0).integers(0, vectors.shape[0], queries)]
+    collection.query(query_embeddings=vectors[:1].tolist(), n_results=k, include=["documents"])
+    latencies = []
+    for vector in vectors:
+        started = time.perf_counter()
+        collection.query(query_embeddings=[vector.tolist()], n_results=k, include=["documents", "distances"])
+        latencies.append((time.perf_counter() - started) * 1000)
+    started = time.perf_counter()
+    collection.query(query_embeddings=vectors.tolist(), n_results=k, include=["documents", "distances"])
+    batch = (time.perf_counter() - started) * 1000
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "batch_ms": batch
+    }
+
+def run_benchmark(project_dir: str, queries: int, k: int) -> list:
+    store_dir = get_vectorstore_dir(project_dir)
+    rows = []
+    for name in available_vector_backends(store_dir):
+        row = {"backend": name, "disk_mb": get_vector_backend(name).disk_usage(store_dir) / (1024 * 1024)}
+        row.update(measure_load(name, store_dir))
+        row.update(measure_queries(name, store_dir, queries, k))
+        rows.append(row)
+    return rows
+
+def format_benchmark(rows: list, queries: int) -> str:
+    lines = [f"{'backend':<8} {'segments':>9} {'disk(MB)':>9} {'load(s)':>8} {'p50(ms)':>8} {'p95(ms)':>8} {f'batch x{queries}(ms)':>16}"]
+    for row in rows:
+        lines.append(
+            f"{row['backend']:<8} {row['count']:>9} {row['disk_mb']:>9.2f} {row['load']:>8.3f} "
+            f"{row.get('p50_ms', 0):>8.2f} {row.get('p95_ms', 0):>8.2f} {row.get('batch_ms', 0):>16.2f}"
+        )
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="向量库迁移与基准测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate = subparsers.add_parser("migrate", help="把 Chroma 向量库迁移到 flat 后端")
+    migrate.add_argument("project_dir")
+    benchmark = subparsers.add_parser("benchmark", help="比较各后端的加载耗时、检索延迟与磁盘占用")
+    benchmark.add_argument("project_dir")
+    benchmark.add_argument("--queries", type=int, default=50)
+    benchmark.add_argument("-k", type=int, default=4)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "migrate":
+        stats = migrate_chroma_to_flat(args.project_dir)
+        if stats is None:
+            sys.exit(1)
+        logging.info(f"迁移完成：{stats['segments']} 个片段，维度 {stats['dim']}。"
+                     f"在 config.json 中设置 \"vector_store\": {{\"backend\": \"flat\"}} 后生效。")
+    else:
+        rows = run_benchmark(args.project_dir, args.queries, args.k)
+        if not rows:
+            logging.info("No vector store found.")
+            sys.exit(1)
+        print(format_benchmark(rows, args.queries))
+
+if __name__ == "__main__":
+    main()